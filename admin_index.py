@@ -0,0 +1,165 @@
+import discord
+from discord.ext import commands, tasks
+import asyncio
+import time
+from bot_logging import get_logger
+
+ADMIN_ROLE_NAME = "Admin"
+
+DEFAULT_MEMBER_CACHE_CONFIG = {
+    # "all" caches every member of every guild, "minimal" caches none and fetches admins when needed
+    "policy": "all",
+    # Admin lists older than this are fetched again, events don't reach members outside the cache
+    "refresh_minutes": 60
+}
+
+log = get_logger('admin_index')
+
+def member_cache_options(config):
+    """Keyword arguments for the bot constructor that apply the member cache policy"""
+    settings = {**DEFAULT_MEMBER_CACHE_CONFIG, **config.get('member_cache', {})}
+    if settings['policy'] == 'minimal':
+        return {'member_cache_flags': discord.MemberCacheFlags.none(), 'chunk_guilds_at_startup': False}
+    return {'member_cache_flags': discord.MemberCacheFlags.all(), 'chunk_guilds_at_startup': True}
+
+class AdminIndex(commands.Cog):
+    """IDs of the members holding the Admin role, per guild.
+
+    Every guild's list is built when the bot is ready and rebuilt in the background
+    every ``refresh_minutes``, from the member cache when the guild is chunked and
+    from the API otherwise, so looking up admins never waits on a crawl of the
+    members. Member and role events keep it current between refreshes. Member
+    updates are only dispatched for cached members, so with the minimal cache a
+    role change is seen when the member next interacts with the bot, or at the
+    next refresh.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = {**DEFAULT_MEMBER_CACHE_CONFIG, **bot.config.get('member_cache', {})}
+        # guild id -> set of admin member ids
+        self.admins = {}
+        self.built_at = {}
+        self.locks = {}
+        # Rebuilds started by role events, referenced until they finish
+        self.rebuilds = set()
+
+    async def cog_load(self):
+        self.refresh.change_interval(minutes=self.settings['refresh_minutes'])
+        self.refresh.start()
+
+    async def cog_unload(self):
+        self.refresh.cancel()
+
+    @tasks.loop(minutes=60)
+    async def refresh(self):
+        for guild in self.bot.guilds:
+            try:
+                await self.build(guild)
+            except discord.HTTPException:
+                log.exception("Could not fetch admins", extra={'event': 'admin_index.error', 'guild_id': guild.id})
+
+    @refresh.before_loop
+    async def before_refresh(self):
+        await self.bot.wait_until_ready()
+
+    def _is_admin(self, member):
+        return discord.utils.get(member.roles, name=ADMIN_ROLE_NAME) is not None
+
+    async def admins_for(self, guild):
+        """IDs of the guild's admins, only built here for a guild the refresh hasn't reached yet"""
+        admins = self.admins.get(guild.id)
+        if admins is not None:
+            return admins
+        return await self.build(guild)
+
+    async def build(self, guild):
+        """Build the guild's list from scratch, returns the admin IDs"""
+        requested_at = time.monotonic()
+        lock = self.locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            # Someone else may have built it while we waited
+            built_at = self.built_at.get(guild.id)
+            if built_at is not None and built_at >= requested_at:
+                return self.admins[guild.id]
+
+            admin_role = discord.utils.get(guild.roles, name=ADMIN_ROLE_NAME)
+            if admin_role is None:
+                admins = set()
+            elif guild.chunked:
+                admins = {member.id for member in admin_role.members}
+            else:
+                # Streamed page by page, the members aren't kept in the cache
+                admins = {member.id async for member in guild.fetch_members(limit=None) if admin_role in member.roles}
+            self.admins[guild.id] = admins
+            self.built_at[guild.id] = time.monotonic()
+            log.info("Built admin index", extra={
+                'event': 'admin_index.built',
+                'guild_id': guild.id,
+                'admins': len(admins),
+                'source': 'cache' if guild.chunked else 'api'
+            })
+            return admins
+
+    def forget(self, guild_id):
+        self.admins.pop(guild_id, None)
+        self.built_at.pop(guild_id, None)
+
+    def rebuild_soon(self, guild):
+        """Rebuild after the Admin role itself changed, the old list is used until the new one is in"""
+        async def rebuild():
+            try:
+                await self.build(guild)
+            except discord.HTTPException:
+                log.exception("Could not fetch admins", extra={'event': 'admin_index.error', 'guild_id': guild.id})
+
+        task = asyncio.create_task(rebuild())
+        self.rebuilds.add(task)
+        task.add_done_callback(self.rebuilds.discard)
+
+    def update_member(self, member):
+        admins = self.admins.get(member.guild.id)
+        if admins is None:
+            return
+        if self._is_admin(member):
+            admins.add(member.id)
+        else:
+            admins.discard(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        self.update_member(after)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction):
+        # Interactions carry the member's current roles even when the member isn't cached
+        if isinstance(interaction.user, discord.Member):
+            self.update_member(interaction.user)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload):
+        admins = self.admins.get(payload.guild_id)
+        if admins is not None:
+            admins.discard(payload.user.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        if role.name == ADMIN_ROLE_NAME:
+            self.rebuild_soon(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        # A role renamed to or from Admin changes who the admins are
+        if ADMIN_ROLE_NAME in (before.name, after.name) and before.name != after.name:
+            self.rebuild_soon(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if role.name == ADMIN_ROLE_NAME:
+            self.rebuild_soon(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.forget(guild.id)
+
+async def setup(bot):
+    await bot.add_cog(AdminIndex(bot))
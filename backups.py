@@ -0,0 +1,297 @@
+import discord
+from discord import app_commands
+from discord.ext import commands, tasks
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+from bot_logging import get_logger
+from latency import respond, defer_response
+from sharding import runs_first_shard
+from stock_store import StockStore
+from db_writer import connect_db, writer_enabled
+
+ADMIN_ROLE_NAME = "Admin"
+
+DEFAULT_BACKUP_CONFIG = {
+    "backup_dir": "backups",
+    "interval_hours": 6,
+    "keep": 7,
+    "pages_per_step": 64,
+    "step_sleep_seconds": 0.01
+}
+
+PRODUCT_DIRECTORY = 'products'
+# Hard links to the stock blocks being backed up, next to the stock so links always work
+PIN_DIRECTORY = f"{PRODUCT_DIRECTORY}.pin"
+
+log = get_logger('backups')
+
+class BackupError(Exception):
+    pass
+
+class Backups(commands.Cog):
+    """Online backups of the database and stock files, with retention and restore"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = {**DEFAULT_BACKUP_CONFIG, **bot.config.get('backups', {})}
+        self.backup_dir = self.settings['backup_dir']
+        self.lock = asyncio.Lock()
+
+    async def cog_load(self):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        # With the shards split across processes, one of them takes the scheduled backups
+        if not runs_first_shard(self.bot):
+            return
+        self.scheduler.change_interval(hours=self.settings['interval_hours'])
+        self.scheduler.start()
+
+    async def cog_unload(self):
+        self.scheduler.cancel()
+
+    @tasks.loop(hours=6)
+    async def scheduler(self):
+        try:
+            await self.create_backup()
+        except Exception:
+            log.exception("Scheduled backup failed", extra={'event': 'backup.error'})
+
+    @scheduler.before_loop
+    async def before_scheduler(self):
+        await self.bot.wait_until_ready()
+
+    def list_backups(self):
+        """Backup names, newest first"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        return sorted(
+            (name for name in os.listdir(self.backup_dir)
+             if name.startswith('backup_') and os.path.exists(os.path.join(self.backup_dir, name, 'manifest.json'))),
+            reverse=True
+        )
+
+    async def create_backup(self):
+        """Take a backup and apply the retention policy, returns the backup name"""
+        async with self.lock:
+            name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            path = os.path.join(self.backup_dir, name)
+            started = datetime.now()
+            # A sale holds its product's lock from taking the stock entries until the store gives
+            # them up, so with every lock held the pinned stock and the database snapshot agree
+            stores = sorted(StockStore.all(PRODUCT_DIRECTORY), key=lambda store: store.product_id)
+            held = []
+            try:
+                for store in stores:
+                    await store.sale_lock.acquire()
+                    held.append(store)
+                source = await asyncio.to_thread(self._pin, stores)
+            finally:
+                for store in held:
+                    store.sale_lock.release()
+            # The locks only cover pinning the snapshot, everything is copied after they are released
+            manifest = await asyncio.to_thread(self._copy_backup, source, path)
+            manifest['duration_seconds'] = round((datetime.now() - started).total_seconds(), 2)
+            with open(os.path.join(path, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=4)
+
+            removed = await asyncio.to_thread(self._apply_retention)
+            log.info("Backup created", extra={'event': 'backup.created', 'backup': name, 'removed': removed, **manifest})
+            return name
+
+    def _pin(self, stores):
+        """Pin the stock blocks and the database state to back up, returns the source connection.
+
+        Runs with every sale lock held, so it only hard-links blocks and opens a read transaction.
+        """
+        shutil.rmtree(PIN_DIRECTORY, ignore_errors=True)
+        for store in stores:
+            store.link_to(os.path.join(PIN_DIRECTORY, os.path.basename(store.path)))
+
+        # Read-only, so it is just another reader next to the writer process when that is enabled
+        source = sqlite3.connect(
+            f"file:{self.bot.db_path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False
+        )
+        try:
+            # The open read transaction fixes what the backup copies. Without it every write
+            # landing between two steps restarts the copy, which may then never finish under load
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1')
+        except Exception:
+            source.close()
+            raise
+        return source
+
+    def _copy_backup(self, source, path):
+        """Copy the product files, the pinned stock and the pinned database state into the backup"""
+        try:
+            os.makedirs(path)
+            if os.path.isdir(PRODUCT_DIRECTORY):
+                backup_products = os.path.join(path, PRODUCT_DIRECTORY)
+                shutil.copytree(PRODUCT_DIRECTORY, backup_products, ignore=shutil.ignore_patterns('stock_*', '*.tmp'))
+                if os.path.isdir(PIN_DIRECTORY):
+                    shutil.copytree(PIN_DIRECTORY, backup_products, dirs_exist_ok=True)
+        except BaseException:
+            source.close()
+            raise
+        finally:
+            shutil.rmtree(PIN_DIRECTORY, ignore_errors=True)
+        return self._copy_database(source, path)
+
+    def _copy_database(self, source, path):
+        target_path = os.path.join(path, os.path.basename(self.bot.db_path))
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(
+                target,
+                pages=self.settings['pages_per_step'],
+                sleep=self.settings['step_sleep_seconds']
+            )
+        finally:
+            target.close()
+            source.close()
+
+        return {
+            'created_at': datetime.now().isoformat(),
+            'database_bytes': os.path.getsize(target_path),
+            'stock_files': sorted(os.listdir(os.path.join(path, PRODUCT_DIRECTORY)))
+            if os.path.isdir(os.path.join(path, PRODUCT_DIRECTORY)) else []
+        }
+
+    def _apply_retention(self):
+        removed = []
+        for name in self.list_backups()[self.settings['keep']:]:
+            shutil.rmtree(os.path.join(self.backup_dir, name))
+            removed.append(name)
+        return removed
+
+    async def restore_backup(self, name):
+        """Verify a backup and copy it over the live database and stock files"""
+        if name not in self.list_backups():
+            raise BackupError(f"No backup named {name}")
+        # The restore writes the database file directly, under the writer's open batch and behind the
+        # caches of the other bot processes
+        if writer_enabled():
+            raise BackupError(
+                "Restoring isn't possible while the database writer is enabled. Stop the bots and the writer, "
+                "then restore with db_writer disabled."
+            )
+
+        path = os.path.join(self.backup_dir, name)
+        async with self.lock:
+            # No sale takes or commits stock from the moment the files are swapped until the counts match them
+            product_ids = {store.product_id for store in StockStore.all(PRODUCT_DIRECTORY)}
+            product_ids |= {store.product_id for store in StockStore.all(os.path.join(path, PRODUCT_DIRECTORY))}
+            held = []
+            try:
+                for product_id in sorted(product_ids):
+                    store = StockStore(product_id)
+                    await store.sale_lock.acquire()
+                    held.append(store)
+                await asyncio.to_thread(self._restore_backup, path)
+
+                # Stock counts follow the restored stock files
+                async with connect_db(self.bot.db_path) as db:
+                    async with db.execute('SELECT id FROM products') as cursor:
+                        product_ids = [row[0] for row in await cursor.fetchall()]
+                    for product_id in product_ids:
+                        stock = StockStore(product_id).count()
+                        await db.execute('UPDATE products SET stock = ? WHERE id = ?', (stock, product_id))
+                    await db.commit()
+            finally:
+                for store in held:
+                    store.sale_lock.release()
+
+        # In-memory indexes follow the database
+        product_manager = self.bot.get_cog('ProductManager')
+        await self.bot.load_blacklist()
+        await self.bot.redemptions.load_filter()
+        await product_manager.discounts.load()
+        await product_manager.stock_index.load()
+        await product_manager.reservations.load()
+        await product_manager.product_index.load()
+        log.warning("Backup restored", extra={'event': 'backup.restored', 'backup': name})
+
+    def _restore_backup(self, path):
+        # Copied before anything live is touched, a failed copy leaves the current files in place
+        backup_products = os.path.join(path, PRODUCT_DIRECTORY)
+        staging = f"{PRODUCT_DIRECTORY}.restore"
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.path.isdir(backup_products):
+            shutil.copytree(backup_products, staging)
+
+        backup_db = os.path.join(path, os.path.basename(self.bot.db_path))
+        try:
+            source = sqlite3.connect(f"file:{backup_db}?mode=ro", uri=True)
+            try:
+                result = source.execute('PRAGMA integrity_check').fetchall()
+                if result != [('ok',)]:
+                    raise BackupError(f"Integrity check failed: {result[0][0]}")
+
+                # Going through the backup API keeps the live file valid for connections that are open
+                target = sqlite3.connect(self.bot.db_path)
+                try:
+                    source.backup(target, pages=self.settings['pages_per_step'])
+                finally:
+                    target.close()
+            finally:
+                source.close()
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if os.path.isdir(staging):
+            # The live directory is moved aside and only deleted once the restored one is in its place
+            retired = f"{PRODUCT_DIRECTORY}.old"
+            shutil.rmtree(retired, ignore_errors=True)
+            if os.path.isdir(PRODUCT_DIRECTORY):
+                os.rename(PRODUCT_DIRECTORY, retired)
+            try:
+                os.rename(staging, PRODUCT_DIRECTORY)
+            except OSError:
+                if os.path.isdir(retired):
+                    os.rename(retired, PRODUCT_DIRECTORY)
+                raise
+            shutil.rmtree(retired, ignore_errors=True)
+
+    @app_commands.command(name="backup_now", description="[Admin] Take a backup of the database and stock files")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def backup_now(self, interaction: discord.Interaction):
+        await defer_response(interaction, ephemeral=True)
+        name = await self.create_backup()
+        await interaction.followup.send(f"Backup created: `{name}`", ephemeral=True)
+
+    @app_commands.command(name="backups", description="[Admin] List available backups")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def backups(self, interaction: discord.Interaction):
+        names = self.list_backups()
+        if not names:
+            await respond(interaction, "No backups found.", ephemeral=True)
+            return
+
+        embed = discord.Embed(title="Backups", color=discord.Color.blue())
+        for name in names[:25]:
+            with open(os.path.join(self.backup_dir, name, 'manifest.json')) as f:
+                manifest = json.load(f)
+            embed.add_field(
+                name=name,
+                value=f"Database: {manifest['database_bytes'] / 1024:.1f} KiB\n"
+                      f"Stock files: {len(manifest['stock_files'])}",
+                inline=False
+            )
+        await respond(interaction, embed=embed, ephemeral=True)
+
+    @app_commands.command(name="restore_backup", description="[Admin] Restore the database and stock files from a backup")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def restore_backup_command(self, interaction: discord.Interaction, name: str):
+        await defer_response(interaction, ephemeral=True)
+        try:
+            await self.restore_backup(name)
+        except BackupError as e:
+            await interaction.followup.send(f"Restore failed: {e}", ephemeral=True)
+            return
+        await interaction.followup.send(f"Restored backup `{name}`.", ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Backups(bot))
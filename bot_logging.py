@@ -0,0 +1,120 @@
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+try:
+    from pythonjsonlogger.json import JsonFormatter
+except ImportError:  # python-json-logger < 3
+    from pythonjsonlogger.jsonlogger import JsonFormatter
+
+LOGGER_NAME = 'credit_bot'
+
+DEFAULT_LOGGING_CONFIG = {
+    "level": "INFO",
+    "file": None,
+    "max_bytes": 5 * 1024 * 1024,
+    "backup_count": 3,
+    "discord_level": "WARNING",
+    "sample_rates": {}
+}
+
+def get_logger(name=None):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+class SamplingFilter(logging.Filter):
+    """Drops a share of high-volume records before they are queued.
+
+    Records are matched on their ``event`` field against the configured rates,
+    warnings and errors are never dropped.
+    """
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = dict(sample_rates)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample_rates.get(getattr(record, 'event', None))
+        if rate is None or rate >= 1:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps tracebacks out of the message field"""
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(config):
+    """Route all bot logs through a queue so the event loop never blocks on log I/O.
+
+    Returns the started QueueListener, stop it on shutdown to flush pending records.
+    """
+    log_config = {**DEFAULT_LOGGING_CONFIG, **config.get('logging', {})}
+
+    if log_config['file']:
+        target = logging.handlers.RotatingFileHandler(
+            log_config['file'],
+            maxBytes=log_config['max_bytes'],
+            backupCount=log_config['backup_count'],
+            encoding='utf-8'
+        )
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter(
+        '%(asctime)s %(levelname)s %(name)s %(message)s',
+        rename_fields={'levelname': 'level', 'name': 'logger'}
+    ))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(log_config['sample_rates']))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(log_config['level'])
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    # discord.py logs go through the same queue, bot.run is started without its own handler
+    discord_logger = logging.getLogger('discord')
+    discord_logger.setLevel(log_config['discord_level'])
+    discord_logger.addHandler(queue_handler)
+    discord_logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    listener.start()
+    return listener
+
+command_log = get_logger('commands')
+
+async def log_command_start(interaction):
+    interaction.extras['started_at'] = time.perf_counter()
+
+async def log_command_end(interaction):
+    started_at = interaction.extras.get('started_at')
+    if started_at is None or not interaction.command:
+        return
+    failed = interaction.command_failed
+    command_log.log(
+        logging.WARNING if failed else logging.INFO,
+        "Command failed" if failed else "Command completed",
+        extra={
+            'event': 'command.failed' if failed else 'command.completed',
+            'command': interaction.command.qualified_name,
+            'user_id': interaction.user.id,
+            'guild_id': interaction.guild_id,
+            'duration_ms': round((time.perf_counter() - started_at) * 1000, 2)
+        }
+    )
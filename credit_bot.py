@@ -6,10 +6,19 @@ import sqlite3
 import random
 import string
 import os
+import asyncio
 from datetime import datetime, timedelta
-import aiosqlite
 import io
 from dotenv import load_dotenv
+from bot_logging import setup_logging, get_logger, log_command_start, log_command_end
+from latency import respond
+from redemption import RedemptionEngine, parse_codes, MAX_BULK_CODES
+from partitions import TransactionArchive
+from ledger import CreditLedger, ACCOUNT_ADMIN
+from reports import SalesRollups
+from admin_index import member_cache_options
+from sharding import bot_base, shard_options, runs_first_shard
+from db_writer import connect_db, configure as configure_db_writer, writer_enabled
 
 # Load configuration
 load_dotenv()
@@ -21,27 +30,89 @@ with open('config.json', 'r') as f:
 if not config['token']:
     raise ValueError("No Discord token found. Please set DISCORD_TOKEN in your .env file.")
 
+log_listener = setup_logging(config)
+log = get_logger()
+
 ADMIN_ROLE_NAME = "Admin"
 
-class CreditBot(commands.Bot):
+class CreditTree(app_commands.CommandTree):
+    """Command tree that lets extensions hook into every app command invocation"""
+    def __init__(self, client):
+        super().__init__(client)
+        self.before_invoke_hooks = []
+        self.after_invoke_hooks = []
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Blacklisted users are turned away from memory, before any hook or database work
+        if interaction.user.id in self.client.blacklist:
+            # Autocomplete can only return choices, everything else gets told why nothing happens
+            if interaction.type is not discord.InteractionType.autocomplete:
+                await respond(interaction, "You are blacklisted from using this bot.", ephemeral=True)
+            return False
+        # Autocomplete requests go straight through, hooks only see real invocations
+        if interaction.type is not discord.InteractionType.application_command:
+            return True
+        for hook in self.before_invoke_hooks:
+            if await hook(interaction) is False:
+                # Let hooks that already ran release whatever they set up
+                await self.run_after_invoke_hooks(interaction)
+                return False
+        return True
+
+    async def run_after_invoke_hooks(self, interaction: discord.Interaction):
+        for hook in self.after_invoke_hooks:
+            try:
+                await hook(interaction)
+            except Exception as e:
+                log.exception("After invoke hook error", extra={'event': 'hook.error'})
+
+# AutoShardedBot when config['sharding'] enables it
+class CreditBot(bot_base(config)):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = True
         intents.members = True
         intents.guilds = True
-        super().__init__(command_prefix='!', intents=intents)
+        # The members intent stays on for member events and fetching admins, caching them is up to the policy
+        super().__init__(command_prefix='!', intents=intents, tree_cls=CreditTree,
+                         **member_cache_options(config), **shard_options(config))
         self.db_path = 'data/credit_system.db'
         self.products = {}
         self.config = config
+        # IDs of blacklisted users, mirrors users.is_blacklisted
+        self.blacklist = set()
+        # on_ready fires again after reconnects and, sharded, once all shards are up; startup work runs once
+        self.started = False
+        # With db_writer enabled, writes go to the writer process and reads are local
+        configure_db_writer(config)
         self.setup_database()
+        self.ledger = CreditLedger(self.db_path)
+        self.sales = SalesRollups(self.db_path)
+        self.redemptions = RedemptionEngine(self.db_path, self.ledger, use_filter=not writer_enabled())
+        self.transaction_archive = TransactionArchive(self.db_path, config.get('transaction_archive'))
+        self.tree.before_invoke_hooks.append(log_command_start)
+        self.tree.after_invoke_hooks.append(log_command_end)
 
     async def setup_hook(self):
-        # First load the product manager extension
-        try:
-            await self.load_extension('product_manager')
-            print("Loaded product_manager extension")
-        except Exception as e:
-            print(f"Failed to load product_manager: {e}")
+        await self.load_blacklist()
+        await self.ledger.open_balances()
+        await self.redemptions.load_filter()
+
+        # First load the product manager extension, then the admin tooling
+        for extension in ('product_manager', 'admin_index', 'sharding', 'profiler', 'maintenance', 'backups', 'reports', 'exports', 'latency', 'rate_limits', 'db_writer'):
+            try:
+                await self.load_extension(extension)
+                log.info("Loaded extension", extra={'extension': extension})
+            except Exception:
+                log.exception("Failed to load extension", extra={'extension': extension})
+
+    async def load_blacklist(self):
+        async with connect_db(self.db_path) as db:
+            async with db.execute('SELECT user_id FROM users WHERE is_blacklisted = 1') as cursor:
+                self.blacklist = {row[0] for row in await cursor.fetchall()}
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        await self.tree.run_after_invoke_hooks(interaction)
 
     def setup_database(self):
         # Create data directory if it doesn't exist
@@ -68,6 +139,10 @@ class CreditBot(commands.Bot):
                      name TEXT,
                      price INTEGER,
                      file_path TEXT)''')
+        # Stock counts came after the first release
+        columns = [row[1] for row in c.execute('PRAGMA table_info(products)')]
+        if 'stock' not in columns:
+            c.execute('ALTER TABLE products ADD COLUMN stock INTEGER DEFAULT 0')
                      
         # Create transactions table
         c.execute('''CREATE TABLE IF NOT EXISTS transactions
@@ -80,6 +155,8 @@ class CreditBot(commands.Bot):
                      discount_amount INTEGER DEFAULT 0,
                      discount_code TEXT,
                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_transactions_user
+                    ON transactions (user_id, timestamp)''')
 
         # Create discount_codes table
         c.execute('''CREATE TABLE IF NOT EXISTS discount_codes
@@ -90,6 +167,96 @@ class CreditBot(commands.Bot):
                      max_uses INTEGER DEFAULT 1,
                      uses_left INTEGER,
                      expiry_date DATETIME)''')
+
+        # Archive tables for swept codes, kept for audits
+        c.execute('''CREATE TABLE IF NOT EXISTS codes_archive
+                    (code TEXT PRIMARY KEY,
+                     credits INTEGER,
+                     archived_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS discount_codes_archive
+                    (code TEXT,
+                     discount_amount INTEGER,
+                     discount_type TEXT,
+                     max_uses INTEGER,
+                     uses_left INTEGER,
+                     expiry_date DATETIME,
+                     archived_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # Create credit ledger tables, every balance change is a transfer with two entries
+        c.execute('''CREATE TABLE IF NOT EXISTS ledger_transfers
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     reason TEXT,
+                     reference TEXT,
+                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS ledger_entries
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     transfer_id INTEGER REFERENCES ledger_transfers (id),
+                     account TEXT,
+                     user_id INTEGER,
+                     amount INTEGER)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_user
+                    ON ledger_entries (user_id, id)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_ledger_entries_transfer
+                    ON ledger_entries (transfer_id)''')
+
+        c.execute('''CREATE TABLE IF NOT EXISTS ledger_checkpoints
+                    (user_id INTEGER,
+                     entry_id INTEGER,
+                     balance INTEGER,
+                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                     PRIMARY KEY (user_id, entry_id))''')
+
+        # Create daily sales rollups, updated with every purchase
+        c.execute('''CREATE TABLE IF NOT EXISTS sales_daily
+                    (day TEXT,
+                     product_id INTEGER,
+                     orders INTEGER DEFAULT 0,
+                     units INTEGER DEFAULT 0,
+                     gross INTEGER DEFAULT 0,
+                     discounts INTEGER DEFAULT 0,
+                     revenue INTEGER DEFAULT 0,
+                     PRIMARY KEY (day, product_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sales_backfills
+                    (completed_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # Create stock digests, one per stock entry ever ingested
+        c.execute('''CREATE TABLE IF NOT EXISTS stock_digests
+                    (digest BLOB PRIMARY KEY,
+                     product_id INTEGER) WITHOUT ROWID''')
+
+        # Create rate limit overrides set by admins
+        c.execute('''CREATE TABLE IF NOT EXISTS rate_limit_overrides
+                    (command TEXT PRIMARY KEY,
+                     per_minute REAL,
+                     burst INTEGER)''')
+
+        # Create stock reservations, held between selecting a product and confirming
+        c.execute('''CREATE TABLE IF NOT EXISTS stock_reservations
+                    (id TEXT PRIMARY KEY,
+                     product_id INTEGER,
+                     user_id INTEGER,
+                     quantity INTEGER,
+                     expires_at REAL,
+                     order_id TEXT)''')
+        # Cart reservations share the order_id of their checkout, older rows are their own order
+        columns = [row[1] for row in c.execute('PRAGMA table_info(stock_reservations)')]
+        if 'order_id' not in columns:
+            c.execute('ALTER TABLE stock_reservations ADD COLUMN order_id TEXT')
+
+        # Create stock alerts waiting for the process that holds their guild
+        c.execute('''CREATE TABLE IF NOT EXISTS stock_alerts
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     guild_id INTEGER,
+                     message TEXT,
+                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # Create purchase nonces, one per confirmation that went through
+        c.execute('''CREATE TABLE IF NOT EXISTS purchase_nonces
+                    (nonce TEXT PRIMARY KEY,
+                     purchase_id TEXT,
+                     created_at REAL) WITHOUT ROWID''')
         
         conn.commit()
         conn.close()
@@ -98,10 +265,11 @@ bot = CreditBot()
 
 @bot.event
 async def on_ready():
-    print(f'Logged in as {bot.user.name}')
-    print(f'Bot ID: {bot.user.id}')
-    print('Connected to guilds:')
-    
+    log.info("Logged in", extra={'event': 'bot.ready', 'bot_name': bot.user.name, 'bot_id': bot.user.id})
+    if bot.started:
+        return
+    bot.started = True
+
     # Define all commands
     commands = [
         {
@@ -196,62 +364,101 @@ async def on_ready():
         }
     ]
 
-    try:
-        print("Starting to sync commands...")
-        # Register commands for each guild
-        for guild_id in config['guild_ids']:
-            guild = discord.Object(id=int(guild_id))
+    # With several processes sharing the shards, commands are synced by the one holding shard 0
+    if runs_first_shard(bot):
+        await sync_commands()
+
+    for guild in bot.guilds:
+        log.info("Connected to guild", extra={'guild_id': guild.id, 'guild_name': guild.name, 'shard_id': guild.shard_id})
+
+async def sync_commands():
+    log.info("Starting to sync commands")
+
+    async def sync_guild(guild_id):
+        guild = discord.Object(id=int(guild_id))
+        try:
             bot.tree.copy_global_to(guild=guild)
             synced = await bot.tree.sync(guild=guild)
-            print(f"Synced {len(synced)} commands to guild {guild_id}")
-            
-        print("Command sync complete!")
-    except Exception as e:
-        print(f"Error syncing commands: {e}")
+            log.info("Synced commands", extra={'guild_id': guild_id, 'count': len(synced)})
+        except Exception:
+            log.exception("Error syncing commands", extra={'guild_id': guild_id})
 
-    for guild in bot.guilds:
-        print(f'- {guild.name} (ID: {guild.id})')
+    # Guilds are synced concurrently, discord.py queues the requests within the rate limits
+    await asyncio.gather(*(sync_guild(guild_id) for guild_id in config['guild_ids']))
+    log.info("Command sync complete")
 
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    await bot.tree.run_after_invoke_hooks(interaction)
     if isinstance(error, app_commands.MissingRole):
-        await interaction.response.send_message(f"You need the '{ADMIN_ROLE_NAME}' role to use this command.", ephemeral=True)
+        await respond(interaction, f"You need the '{ADMIN_ROLE_NAME}' role to use this command.", ephemeral=True)
     elif isinstance(error, app_commands.CommandOnCooldown):
-        await interaction.response.send_message(f"This command is on cooldown. Try again in {error.retry_after:.2f} seconds.", ephemeral=True)
+        await respond(interaction, f"This command is on cooldown. Try again in {error.retry_after:.2f} seconds.", ephemeral=True)
     else:
-        await interaction.response.send_message(f"An error occurred: {str(error)}", ephemeral=True)
-        print(f"Command error: {str(error)}")
+        await respond(interaction, f"An error occurred: {str(error)}", ephemeral=True)
+        log.error(
+            "Command error",
+            exc_info=error,
+            extra={
+                'event': 'command.error',
+                'command': interaction.command.qualified_name if interaction.command else None,
+                'user_id': interaction.user.id
+            }
+        )
 
 # Admin commands
 @bot.tree.command(name="add_credits", description="[Admin] Add credits to a user")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def add_credits(interaction: discord.Interaction, user: discord.Member, amount: int):
-    async with aiosqlite.connect(bot.db_path) as db:
-        await db.execute('INSERT OR IGNORE INTO users (user_id, credits) VALUES (?, 0)', (user.id,))
-        await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?', (amount, user.id))
+    async with connect_db(bot.db_path) as db:
+        await bot.ledger.move(db, user.id, amount, 'admin_grant', str(interaction.user.id), ACCOUNT_ADMIN)
         await db.commit()
     
-    await interaction.response.send_message(f"Added {amount} credits to {user.mention}'s account!", ephemeral=True)
+    await respond(interaction, f"Added {amount} credits to {user.mention}'s account!", ephemeral=True)
 
 @bot.tree.command(name="check_balance", description="[Admin] Check a user's balance")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def check_balance(interaction: discord.Interaction, user: discord.Member):
-    async with aiosqlite.connect(bot.db_path) as db:
+    async with connect_db(bot.db_path) as db:
         async with db.execute('SELECT credits FROM users WHERE user_id = ?', (user.id,)) as cursor:
             result = await cursor.fetchone()
             credits = result[0] if result else 0
     
-    await interaction.response.send_message(f"{user.mention}'s balance: {credits} credits", ephemeral=True)
+    await respond(interaction, f"{user.mention}'s balance: {credits} credits", ephemeral=True)
+
+@bot.tree.command(name="verify_balance", description="[Admin] Check a user's balance against the credit ledger")
+@app_commands.checks.has_role(ADMIN_ROLE_NAME)
+async def verify_balance(interaction: discord.Interaction, user: discord.Member, repair: bool = False):
+    async with connect_db(bot.db_path) as db:
+        async with db.execute('SELECT credits FROM users WHERE user_id = ?', (user.id,)) as cursor:
+            result = await cursor.fetchone()
+            credits = result[0] if result else 0
+
+        ledger_balance = await bot.ledger.rebuild_balance(db, user.id)
+        if ledger_balance == credits:
+            await respond(
+                interaction, f"{user.mention}'s balance of {credits} credits matches the ledger.", ephemeral=True
+            )
+            return
+
+        message = f"{user.mention}'s balance is {credits} credits, but the ledger says {ledger_balance}."
+        if repair:
+            # The ledger is the source of truth, the materialized balance is rebuilt from it
+            await db.execute('UPDATE users SET credits = ? WHERE user_id = ?', (ledger_balance, user.id))
+            await db.commit()
+            message += f" Balance reset to {ledger_balance} credits."
+    
+    await respond(interaction, message, ephemeral=True)
 
 @bot.tree.command(name="generate_code", description="[Admin] Generate redeemable codes")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def generate_code(interaction: discord.Interaction, credits: int, amount: int = 1):
     if amount < 1 or amount > 50:  # Limit to 50 codes at once to prevent abuse
-        await interaction.response.send_message("Please generate between 1 and 50 codes at a time.", ephemeral=True)
+        await respond(interaction, "Please generate between 1 and 50 codes at a time.", ephemeral=True)
         return
         
     codes = []
-    async with aiosqlite.connect(bot.db_path) as db:
+    async with connect_db(bot.db_path) as db:
         for _ in range(amount):
             while True:
                 code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=12))
@@ -263,6 +470,8 @@ async def generate_code(interaction: discord.Interaction, credits: int, amount:
             codes.append(code)
             await db.execute('INSERT INTO codes (code, credits) VALUES (?, ?)', (code, credits))
         await db.commit()
+    # Codes must be in the redeem filter before anyone can try them, they are only shown below
+    bot.redemptions.add_codes(codes)
     
     # Format the response
     if amount == 1:
@@ -278,234 +487,215 @@ async def generate_code(interaction: discord.Interaction, credits: int, amount:
                 io.StringIO(file_content),
                 filename=f"generated_codes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
             )
-            await interaction.response.send_message(
-                f"Generated {amount} codes. Check the attached file.",
+            await respond(
+                interaction, f"Generated {amount} codes. Check the attached file.",
                 file=file,
                 ephemeral=True
             )
             return
     
-    await interaction.response.send_message(message, ephemeral=True)
+    await respond(interaction, message, ephemeral=True)
 
 @bot.tree.command(name="blacklist", description="[Admin] Blacklist a user")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def blacklist(interaction: discord.Interaction, user: discord.Member):
-    async with aiosqlite.connect(bot.db_path) as db:
-        await db.execute('INSERT OR REPLACE INTO users (user_id, is_blacklisted) VALUES (?, 1)', (user.id,))
+    async with connect_db(bot.db_path) as db:
+        # Upsert so the user's balance survives being blacklisted
+        await db.execute('''
+            INSERT INTO users (user_id, is_blacklisted) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET is_blacklisted = 1
+        ''', (user.id,))
         await db.commit()
+    bot.blacklist.add(user.id)
     
-    await interaction.response.send_message(f"{user.mention} has been blacklisted.", ephemeral=True)
+    await respond(interaction, f"{user.mention} has been blacklisted.", ephemeral=True)
 
 @bot.tree.command(name="unblacklist", description="[Admin] Remove a user from blacklist")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def unblacklist(interaction: discord.Interaction, user: discord.Member):
-    async with aiosqlite.connect(bot.db_path) as db:
-        # Check if user is blacklisted
-        async with db.execute('SELECT is_blacklisted FROM users WHERE user_id = ?', (user.id,)) as cursor:
-            result = await cursor.fetchone()
-            if not result or not result[0]:
-                await interaction.response.send_message(f"{user.mention} is not blacklisted.", ephemeral=True)
-                return
-        
+    # Check if user is blacklisted
+    if user.id not in bot.blacklist:
+        await respond(interaction, f"{user.mention} is not blacklisted.", ephemeral=True)
+        return
+
+    async with connect_db(bot.db_path) as db:
         # Remove blacklist
         await db.execute('UPDATE users SET is_blacklisted = 0 WHERE user_id = ?', (user.id,))
         await db.commit()
+    bot.blacklist.discard(user.id)
     
-    await interaction.response.send_message(f"{user.mention} has been removed from the blacklist.", ephemeral=True)
+    await respond(interaction, f"{user.mention} has been removed from the blacklist.", ephemeral=True)
 
 @bot.tree.command(name="blacklist_status", description="[Admin] Check if a user is blacklisted")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def blacklist_status(interaction: discord.Interaction, user: discord.Member):
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute('SELECT is_blacklisted FROM users WHERE user_id = ?', (user.id,)) as cursor:
-            result = await cursor.fetchone()
-            is_blacklisted = result[0] if result else False
-    
-    status = "is" if is_blacklisted else "is not"
-    await interaction.response.send_message(f"{user.mention} {status} blacklisted.", ephemeral=True)
+    status = "is" if user.id in bot.blacklist else "is not"
+    await respond(interaction, f"{user.mention} {status} blacklisted.", ephemeral=True)
 
 @bot.tree.command(name="purchase_info", description="[Admin] View details of a purchase by ID")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def purchase_info(interaction: discord.Interaction, purchase_id: str):
-    async with aiosqlite.connect(bot.db_path) as db:
-        # Get transaction details
-        query = '''
-            SELECT 
-                t.purchase_id,
-                t.amount,
-                t.timestamp,
-                p.name as product_name,
-                p.price,
-                u.user_id
-            FROM transactions t
-            JOIN products p ON t.product_id = p.id
-            JOIN users u ON t.user_id = u.user_id
-            WHERE t.purchase_id = ?
-        '''
-        
-        async with db.execute(query, (purchase_id,)) as cursor:
-            result = await cursor.fetchone()
-            
-            if not result:
-                await interaction.response.send_message(f"No purchase found with ID: {purchase_id}", ephemeral=True)
-                return
-            
-            purchase_id, amount, timestamp, product_name, price, user_id = result
-            
-            # Get user mention
-            user = interaction.guild.get_member(user_id)
-            user_mention = user.mention if user else f"User ID: {user_id}"
-            
-            # Format timestamp
-            dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-            formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
-            
-            # Create embed
-            embed = discord.Embed(
-                title=f"Purchase Information - {purchase_id}",
-                color=discord.Color.blue(),
-                timestamp=dt
-            )
-            
-            embed.add_field(name="Customer", value=user_mention, inline=False)
-            embed.add_field(name="Product", value=product_name, inline=True)
-            embed.add_field(name="Quantity", value=str(amount), inline=True)
-            embed.add_field(name="Price per Unit", value=f"{price} credits", inline=True)
-            embed.add_field(name="Total Cost", value=f"{price * amount} credits", inline=True)
-            embed.add_field(name="Purchase Time", value=formatted_time, inline=False)
-            
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+    # Older purchases live in the monthly archives
+    result = await bot.transaction_archive.find_purchase(purchase_id)
+    
+    if not result:
+        await respond(interaction, f"No purchase found with ID: {purchase_id}", ephemeral=True)
+        return
+    
+    purchase_id, amount, timestamp, product_name, price, user_id = result
+    
+    # Mention by ID, the customer doesn't have to be in the member cache
+    user_mention = f"<@{user_id}>"
+    
+    # Format timestamp
+    dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+    formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
+    
+    # Create embed
+    embed = discord.Embed(
+        title=f"Purchase Information - {purchase_id}",
+        color=discord.Color.blue(),
+        timestamp=dt
+    )
+    
+    embed.add_field(name="Customer", value=user_mention, inline=False)
+    embed.add_field(name="Product", value=product_name, inline=True)
+    embed.add_field(name="Quantity", value=str(amount), inline=True)
+    embed.add_field(name="Price per Unit", value=f"{price} credits", inline=True)
+    embed.add_field(name="Total Cost", value=f"{price * amount} credits", inline=True)
+    embed.add_field(name="Purchase Time", value=formatted_time, inline=False)
+    
+    await respond(interaction, embed=embed, ephemeral=True)
 
 @bot.tree.command(name="user_purchases", description="[Admin] View all purchases by a user")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def user_purchases(interaction: discord.Interaction, user: discord.Member):
-    async with aiosqlite.connect(bot.db_path) as db:
-        query = '''
-            SELECT 
-                t.purchase_id,
-                t.amount,
-                t.timestamp,
-                p.name as product_name,
-                p.price
-            FROM transactions t
-            JOIN products p ON t.product_id = p.id
-            WHERE t.user_id = ?
-            ORDER BY t.timestamp DESC
-            LIMIT 10
-        '''
+    purchases = await bot.transaction_archive.recent_purchases(user.id, 10)
+    
+    if not purchases:
+        await respond(interaction, f"No purchases found for {user.mention}", ephemeral=True)
+        return
+    
+    # Create embed
+    embed = discord.Embed(
+        title=f"Recent Purchases - {user.display_name}",
+        description="Last 10 purchases",
+        color=discord.Color.blue()
+    )
+    
+    for purchase in purchases:
+        purchase_id, amount, timestamp, product_name, price = purchase
+        dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
         
-        async with db.execute(query, (user.id,)) as cursor:
-            purchases = await cursor.fetchall()
-            
-            if not purchases:
-                await interaction.response.send_message(f"No purchases found for {user.mention}", ephemeral=True)
-                return
-            
-            # Create embed
-            embed = discord.Embed(
-                title=f"Recent Purchases - {user.display_name}",
-                description="Last 10 purchases",
-                color=discord.Color.blue()
-            )
-            
-            for purchase in purchases:
-                purchase_id, amount, timestamp, product_name, price = purchase
-                dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
-                
-                value = f"Product: {product_name}\n"
-                value += f"Quantity: {amount}\n"
-                value += f"Total Cost: {price * amount} credits\n"
-                value += f"Time: {formatted_time}"
-                
-                embed.add_field(
-                    name=f"Purchase ID: {purchase_id}",
-                    value=value,
-                    inline=False
-                )
-            
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+        value = f"Product: {product_name}\n"
+        value += f"Quantity: {amount}\n"
+        value += f"Total Cost: {price * amount} credits\n"
+        value += f"Time: {formatted_time}"
+        
+        embed.add_field(
+            name=f"Purchase ID: {purchase_id}",
+            value=value,
+            inline=False
+        )
+    
+    await respond(interaction, embed=embed, ephemeral=True)
 
 @bot.tree.command(name="my_purchases", description="View your purchase history")
 async def my_purchases(interaction: discord.Interaction):
-    async with aiosqlite.connect(bot.db_path) as db:
-        query = '''
-            SELECT 
-                t.purchase_id,
-                t.amount,
-                t.timestamp,
-                p.name as product_name,
-                p.price
-            FROM transactions t
-            JOIN products p ON t.product_id = p.id
-            WHERE t.user_id = ?
-            ORDER BY t.timestamp DESC
-            LIMIT 5
-        '''
+    purchases = await bot.transaction_archive.recent_purchases(interaction.user.id, 5)
+    
+    if not purchases:
+        await respond(interaction, "You haven't made any purchases yet!", ephemeral=True)
+        return
+    
+    # Create embed
+    embed = discord.Embed(
+        title="Your Recent Purchases",
+        description="Last 5 purchases",
+        color=discord.Color.green()
+    )
+    
+    for purchase in purchases:
+        purchase_id, amount, timestamp, product_name, price = purchase
+        dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
         
-        async with db.execute(query, (interaction.user.id,)) as cursor:
-            purchases = await cursor.fetchall()
-            
-            if not purchases:
-                await interaction.response.send_message("You haven't made any purchases yet!", ephemeral=True)
-                return
-            
-            # Create embed
-            embed = discord.Embed(
-                title="Your Recent Purchases",
-                description="Last 5 purchases",
-                color=discord.Color.green()
-            )
-            
-            for purchase in purchases:
-                purchase_id, amount, timestamp, product_name, price = purchase
-                dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                formatted_time = dt.strftime('%Y-%m-%d %I:%M:%S %p')
-                
-                value = f"Product: {product_name}\n"
-                value += f"Quantity: {amount}\n"
-                value += f"Total Cost: {price * amount} credits\n"
-                value += f"Time: {formatted_time}"
-                
-                embed.add_field(
-                    name=f"Purchase ID: {purchase_id}",
-                    value=value,
-                    inline=False
-                )
-            
-            embed.set_footer(text="Keep your Purchase IDs for reference if you need support!")
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+        value = f"Product: {product_name}\n"
+        value += f"Quantity: {amount}\n"
+        value += f"Total Cost: {price * amount} credits\n"
+        value += f"Time: {formatted_time}"
+        
+        embed.add_field(
+            name=f"Purchase ID: {purchase_id}",
+            value=value,
+            inline=False
+        )
+    
+    embed.set_footer(text="Keep your Purchase IDs for reference if you need support!")
+    await respond(interaction, embed=embed, ephemeral=True)
 
 # User commands
 @bot.tree.command(name="balance", description="Check your credit balance")
 async def balance(interaction: discord.Interaction):
-    async with aiosqlite.connect(bot.db_path) as db:
+    async with connect_db(bot.db_path) as db:
         async with db.execute('SELECT credits FROM users WHERE user_id = ?', (interaction.user.id,)) as cursor:
             result = await cursor.fetchone()
             credits = result[0] if result else 0
     
-    await interaction.response.send_message(f"Your balance: {credits} credits", ephemeral=True)
+    await respond(interaction, f"Your balance: {credits} credits", ephemeral=True)
+
+async def check_redeem_lockout(interaction: discord.Interaction):
+    """Turn away users locked out for too many invalid codes, returns False if they were"""
+    retry_after = bot.redemptions.attempts.retry_after(interaction.user.id)
+    if retry_after > 0:
+        await respond(
+            interaction, f"Too many invalid codes. Try again in {retry_after:.0f} seconds.",
+            ephemeral=True
+        )
+        return False
+    return True
 
 @bot.tree.command(name="redeem", description="Redeem a code for credits")
 async def redeem(interaction: discord.Interaction, code: str):
-    async with aiosqlite.connect(bot.db_path) as db:
-        # Check if code exists and is unused
-        async with db.execute('SELECT credits FROM codes WHERE code = ? AND is_used = 0', (code,)) as cursor:
-            result = await cursor.fetchone()
-            
-            if not result:
-                await interaction.response.send_message("Invalid or already used code!", ephemeral=True)
-                return
-                
-            credits = result[0]
-            
-            # Mark code as used and add credits to user
-            await db.execute('UPDATE codes SET is_used = 1 WHERE code = ?', (code,))
-            await db.execute('INSERT OR IGNORE INTO users (user_id, credits) VALUES (?, 0)', (interaction.user.id,))
-            await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?', (credits, interaction.user.id))
-            await db.commit()
+    if not await check_redeem_lockout(interaction):
+        return
+
+    credits = await bot.redemptions.redeem(interaction.user.id, code.strip().upper())
+    if credits is None:
+        await respond(interaction, "Invalid or already used code!", ephemeral=True)
+        return
     
-    await interaction.response.send_message(f"Successfully redeemed {credits} credits!", ephemeral=True)
+    await respond(interaction, f"Successfully redeemed {credits} credits!", ephemeral=True)
+
+@bot.tree.command(name="redeem_bulk", description="Redeem several codes at once")
+async def redeem_bulk(interaction: discord.Interaction, codes: str):
+    code_list = parse_codes(codes)
+    if not code_list:
+        await respond(interaction, "Please provide at least one code.", ephemeral=True)
+        return
+    if len(code_list) > MAX_BULK_CODES:
+        await respond(
+            interaction, f"Please redeem at most {MAX_BULK_CODES} codes at a time.",
+            ephemeral=True
+        )
+        return
+
+    if not await check_redeem_lockout(interaction):
+        return
+
+    credits, redeemed, rejected = await bot.redemptions.redeem_many(interaction.user.id, code_list)
+
+    message = f"Redeemed {len(redeemed)} of {len(code_list)} codes for {credits} credits."
+    if rejected:
+        message += f"\nInvalid or already used: {', '.join(rejected)}"
+        if len(message) > 2000:
+            message = message[:1997] + "..."
+    await respond(interaction, message, ephemeral=True)
+
+def discount_registry():
+    """The discount index kept by the product manager extension"""
+    return bot.get_cog('ProductManager').discounts
 
 @bot.tree.command(name="create_discount", description="[Admin] Create a discount code")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
@@ -519,16 +709,16 @@ async def create_discount(
 ):
     # Validate discount type
     if discount_type.upper() not in ['FIXED', 'PERCENT']:
-        await interaction.response.send_message(
-            "Discount type must be either 'FIXED' or 'PERCENT'",
+        await respond(
+            interaction, "Discount type must be either 'FIXED' or 'PERCENT'",
             ephemeral=True
         )
         return
 
     # For percentage discounts, validate the amount
     if discount_type.upper() == 'PERCENT' and (amount < 1 or amount > 100):
-        await interaction.response.send_message(
-            "Percentage discount must be between 1 and 100",
+        await respond(
+            interaction, "Percentage discount must be between 1 and 100",
             ephemeral=True
         )
         return
@@ -536,7 +726,7 @@ async def create_discount(
     # Calculate expiry date
     expiry_date = datetime.now().replace(microsecond=0) + timedelta(days=days_valid)
 
-    async with aiosqlite.connect(bot.db_path) as db:
+    async with connect_db(bot.db_path) as db:
         try:
             await db.execute('''
                 INSERT INTO discount_codes 
@@ -544,58 +734,56 @@ async def create_discount(
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (code.upper(), amount, discount_type.upper(), max_uses, max_uses, expiry_date))
             await db.commit()
+            discount_registry().add(code.upper(), amount, discount_type.upper(), max_uses, expiry_date)
 
             discount_text = f"{amount}% off" if discount_type.upper() == 'PERCENT' else f"{amount} credits off"
-            await interaction.response.send_message(
-                f"Created discount code: {code.upper()}\n"
+            await respond(
+                interaction, f"Created discount code: {code.upper()}\n"
                 f"Discount: {discount_text}\n"
                 f"Max uses: {max_uses}\n"
                 f"Expires: {expiry_date}",
                 ephemeral=True
             )
         except sqlite3.IntegrityError:
-            await interaction.response.send_message(
-                "A discount code with this name already exists!",
+            await respond(
+                interaction, "A discount code with this name already exists!",
                 ephemeral=True
             )
 
 @bot.tree.command(name="list_discounts", description="[Admin] List all discount codes")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def list_discounts(interaction: discord.Interaction):
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute('''
-            SELECT code, discount_amount, discount_type, uses_left, expiry_date
-            FROM discount_codes
-            WHERE expiry_date > CURRENT_TIMESTAMP
-            AND uses_left > 0
-        ''') as cursor:
-            codes = await cursor.fetchall()
+    codes = discount_registry().active()
 
     if not codes:
-        await interaction.response.send_message("No active discount codes found.", ephemeral=True)
+        await respond(interaction, "No active discount codes found.", ephemeral=True)
         return
 
     embed = discord.Embed(title="Active Discount Codes", color=discord.Color.blue())
     
-    for code, amount, type, uses, expiry in codes:
+    # Embeds hold at most 25 fields, the soonest to expire are shown first
+    for code, amount, type, uses, expiry in codes[:25]:
         discount = f"{amount}% off" if type == 'PERCENT' else f"{amount} credits off"
         embed.add_field(
             name=code,
             value=f"Discount: {discount}\nUses left: {uses}\nExpires: {expiry}",
             inline=False
         )
+    if len(codes) > 25:
+        embed.set_footer(text=f"Showing 25 of {len(codes)} active codes")
 
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await respond(interaction, embed=embed, ephemeral=True)
 
 @bot.tree.command(name="remove_discount", description="[Admin] Remove a discount code")
 @app_commands.checks.has_role(ADMIN_ROLE_NAME)
 async def remove_discount(interaction: discord.Interaction, code: str):
-    async with aiosqlite.connect(bot.db_path) as db:
+    async with connect_db(bot.db_path) as db:
         await db.execute('DELETE FROM discount_codes WHERE code = ?', (code.upper(),))
         await db.commit()
+    discount_registry().remove(code.upper())
 
-    await interaction.response.send_message(
-        f"Removed discount code: {code.upper()}",
+    await respond(
+        interaction, f"Removed discount code: {code.upper()}",
         ephemeral=True
     )
 
@@ -603,7 +791,8 @@ async def remove_discount(interaction: discord.Interaction, code: str):
 try:
     bot.run(config['token'], log_handler=None)
 except discord.LoginFailure as e:
-    print(f"Failed to login: {e}")
-    print("Please check if your token is valid and properly configured in config.json")
+    log.error("Failed to login, please check if your token is valid and properly configured", exc_info=e)
 except Exception as e:
-    print(f"An error occurred: {e}") 
\ No newline at end of file
+    log.error("An error occurred", exc_info=e)
+finally:
+    log_listener.stop() 
\ No newline at end of file
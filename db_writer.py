@@ -0,0 +1,510 @@
+from discord.ext import commands, tasks
+import aiosqlite
+import asyncio
+import base64
+import json
+import os
+import re
+import secrets
+import sqlite3
+from datetime import date, datetime
+from bot_logging import setup_logging, get_logger
+
+DEFAULT_DB_WRITER_CONFIG = {
+    # Off: every process writes to SQLite itself. On: writes go to the writer process over the socket
+    "enabled": False,
+    "socket_path": "data/db_writer.sock",
+    "db_path": "data/credit_system.db",
+    # Transactions committed together at most, a batch is committed early once nobody is waiting
+    "batch_size": 32,
+    # How long a transaction waits for its turn before failing like a locked SQLite database
+    "busy_timeout_seconds": 5.0,
+    # How often workers check for writes by other workers that their in-memory caches depend on
+    "sync_seconds": 5
+}
+
+# Table written by an INSERT, REPLACE, UPDATE or DELETE
+WRITTEN_TABLE = re.compile(
+    r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+["`\[]?(\w+)',
+    re.IGNORECASE
+)
+
+FIRST_KEYWORD = re.compile(r'\s*(\w+)')
+
+# Statements sqlite3 runs outside a transaction, they commit on their own instead of opening one
+AUTOCOMMIT_KEYWORDS = {'CREATE', 'ALTER', 'DROP'}
+
+log = get_logger('db_writer')
+
+_settings = dict(DEFAULT_DB_WRITER_CONFIG)
+
+def writer_settings(config):
+    return {**DEFAULT_DB_WRITER_CONFIG, **config.get('db_writer', {})}
+
+def configure(config):
+    """Pick direct or writer-routed connections for this process, call before the first connect_db"""
+    global _settings
+    _settings = writer_settings(config)
+
+def writer_enabled():
+    return _settings['enabled']
+
+def connect_db(db_path, **kwargs):
+    """An aiosqlite connection, or one whose writes go through the writer process when it's enabled"""
+    if _settings['enabled']:
+        return RemoteConnection(db_path, _settings['socket_path'])
+    return aiosqlite.connect(db_path, **kwargs)
+
+# JSON carries the values, with sqlite3's default adapters for dates and base64 for blobs
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'$bytes': base64.b64encode(bytes(value)).decode('ascii')}
+    return value
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['$bytes'])
+    return value
+
+def encode_params(params):
+    if isinstance(params, dict):
+        return {key: encode_value(value) for key, value in params.items()}
+    return [encode_value(value) for value in params]
+
+def decode_params(params):
+    if isinstance(params, dict):
+        return {key: decode_value(value) for key, value in params.items()}
+    return [decode_value(value) for value in params]
+
+async def send_request(reader, writer, request):
+    try:
+        writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+    except ConnectionError as e:
+        raise sqlite3.OperationalError(f"Lost the connection to the database writer: {e}") from e
+    if not line:
+        raise sqlite3.OperationalError("The database writer closed the connection")
+    reply = json.loads(line)
+    if 'error' in reply:
+        name, message = reply['error']
+        error = getattr(sqlite3, name, None)
+        if not (isinstance(error, type) and issubclass(error, sqlite3.Error)):
+            error = sqlite3.OperationalError
+        raise error(message)
+    return reply
+
+async def open_writer_connection(socket_path):
+    try:
+        return await asyncio.open_unix_connection(socket_path)
+    except OSError as e:
+        raise sqlite3.OperationalError(f"The database writer is unavailable: {e}") from e
+
+class RemoteCursor:
+    """Rows of a statement run by the writer, fetched in full with the reply"""
+    def __init__(self, reply=None):
+        reply = reply or {}
+        self.rows = [tuple(decode_value(value) for value in row) for row in reply.get('rows', [])]
+        self.lastrowid = reply.get('lastrowid')
+        self.rowcount = reply.get('rowcount', -1)
+        self.position = 0
+
+    async def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    async def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    async def close(self):
+        pass
+
+class StatementResult:
+    """Awaitable and async context manager, like what aiosqlite's execute returns"""
+    def __init__(self, coro):
+        self.coro = coro
+        self.cursor = None
+
+    def __await__(self):
+        return self.coro.__await__()
+
+    async def __aenter__(self):
+        self.cursor = await self.coro
+        return self.cursor
+
+    async def __aexit__(self, *exc_info):
+        await self.cursor.close()
+
+class RemoteConnection:
+    """Stands in for an aiosqlite connection in writer mode.
+
+    Transactions run in the writer process, which gives the connection its turn
+    at the first write and keeps it until commit or rollback, like SQLite's own
+    write lock. SELECTs outside a transaction are read locally, WAL lets them run
+    while the writer writes.
+    """
+    def __init__(self, db_path, socket_path):
+        self.db_path = db_path
+        self.socket_path = socket_path
+        self.reader = self.writer = None
+        self.local = None
+        self.in_transaction = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        # Closing the socket rolls back a transaction that was never committed
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.local:
+            await self.local.close()
+            self.local = None
+
+    async def request(self, **request):
+        # Connected on the first write, connections that only read never reach the writer
+        if self.writer is None:
+            self.reader, self.writer = await open_writer_connection(self.socket_path)
+        return await send_request(self.reader, self.writer, request)
+
+    def execute(self, sql, params=()):
+        return StatementResult(self._execute(sql, params, False))
+
+    def executemany(self, sql, seq_of_params):
+        return StatementResult(self._execute(sql, [encode_params(params) for params in seq_of_params], True))
+
+    async def _execute(self, sql, params, many):
+        match = FIRST_KEYWORD.match(sql)
+        keyword = match.group(1).upper() if match else ''
+        # Connections opened with isolation_level=None manage their transactions by hand
+        if keyword == 'BEGIN':
+            self.in_transaction = True
+            await self.request(op='begin')
+            return RemoteCursor()
+        if keyword in ('COMMIT', 'END'):
+            await self.commit()
+            return RemoteCursor()
+        if keyword == 'ROLLBACK':
+            await self.rollback()
+            return RemoteCursor()
+
+        if keyword == 'SELECT' and not self.in_transaction and not many:
+            if self.local is None:
+                self.local = await aiosqlite.connect(self.db_path)
+            return await self.local.execute(sql, params)
+        if keyword in AUTOCOMMIT_KEYWORDS and not self.in_transaction:
+            # Holds the turn only while the statement runs, a failed one leaves nothing open
+            reply = await self.request(op='execute', sql=sql, params=encode_params(params), many=False, autocommit=True)
+            return RemoteCursor(reply)
+
+        # The writer opens the transaction even if the statement fails, the caller still has to end it
+        self.in_transaction = True
+        reply = await self.request(op='execute', sql=sql, params=params if many else encode_params(params), many=many)
+        return RemoteCursor(reply)
+
+    async def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            await self.request(op='commit')
+
+    async def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            await self.request(op='rollback')
+
+async def fetch_versions(socket_path):
+    """Write counters per table from the writer, with a generation that changes when it restarts"""
+    reader, writer = await open_writer_connection(socket_path)
+    try:
+        return await send_request(reader, writer, {'op': 'versions'})
+    finally:
+        writer.close()
+
+class WriterSession:
+    """One client connection to the writer, holding the turn while its transaction is open"""
+    def __init__(self, service):
+        self.service = service
+        self.savepoint = None
+        self.tables = set()
+
+    async def begin(self):
+        if self.savepoint:
+            return
+        await self.service.acquire()
+        try:
+            self.savepoint = await self.service.open_savepoint()
+        except BaseException:
+            await self.service.end_turn()
+            raise
+
+    async def run(self, request):
+        op = request['op']
+        if op == 'begin':
+            await self.begin()
+            return {}
+        if op == 'execute':
+            if request.get('autocommit') and not self.savepoint:
+                await self.begin()
+                try:
+                    reply = await self.execute(request)
+                except BaseException:
+                    await self.rollback()
+                    raise
+                await self.commit()
+                return reply
+            await self.begin()
+            return await self.execute(request)
+        if op == 'commit':
+            await self.commit()
+            return {}
+        if op == 'rollback':
+            await self.rollback()
+            return {}
+        if op == 'versions':
+            return {'generation': self.service.generation, 'tables': self.service.versions}
+        raise sqlite3.ProgrammingError(f"Unknown operation {op}")
+
+    async def execute(self, request):
+        db = self.service.db
+        sql = request['sql']
+        if request['many']:
+            cursor = await db.executemany(sql, [decode_params(params) for params in request['params']])
+            rows = []
+        else:
+            cursor = await db.execute(sql, decode_params(request['params']))
+            rows = [[encode_value(value) for value in row] for row in await cursor.fetchall()]
+        match = WRITTEN_TABLE.match(sql)
+        if match:
+            self.tables.add(match.group(1).lower())
+        return {'rows': rows, 'lastrowid': cursor.lastrowid, 'rowcount': cursor.rowcount}
+
+    async def commit(self):
+        if self.savepoint:
+            await self.service.db.execute(f'RELEASE {self.savepoint}')
+            self.savepoint = None
+            committed = self.service.add_to_batch(self.tables)
+            self.tables = set()
+            await self.service.end_turn()
+            # Answered once the batch holding this transaction is committed
+            await committed
+
+    async def rollback(self):
+        if self.savepoint:
+            db = self.service.db
+            await db.execute(f'ROLLBACK TO {self.savepoint}')
+            await db.execute(f'RELEASE {self.savepoint}')
+            self.savepoint = None
+            self.tables = set()
+            await self.service.end_turn()
+
+class WriterService:
+    """Owns the database's only write connection and serves it over a Unix socket.
+
+    Clients take turns: each transaction runs in its own savepoint inside a
+    shared outer transaction, and the outer transaction is committed once
+    ``batch_size`` transactions are in it or nobody is waiting for a turn. Under
+    load many purchases share one commit, alone each one commits right away.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.db = None
+        self.turn = asyncio.Lock()
+        self.waiting = 0
+        self.in_batch = False
+        self.batch = []
+        self.flush_task = None
+        self.savepoints = 0
+        # table -> number of committed transactions that wrote to it
+        self.versions = {}
+        self.generation = secrets.token_hex(4)
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.turn.acquire(), self.settings['busy_timeout_seconds'])
+        except asyncio.TimeoutError:
+            raise sqlite3.OperationalError("database is locked")
+        finally:
+            self.waiting -= 1
+
+    async def open_savepoint(self):
+        if not self.in_batch:
+            await self.db.execute('BEGIN IMMEDIATE')
+            self.in_batch = True
+        self.savepoints += 1
+        savepoint = f"client_{self.savepoints}"
+        await self.db.execute(f'SAVEPOINT {savepoint}')
+        return savepoint
+
+    def add_to_batch(self, tables):
+        committed = asyncio.get_running_loop().create_future()
+        self.batch.append((committed, tables))
+        return committed
+
+    async def end_turn(self):
+        try:
+            if self.in_batch and (not self.waiting or len(self.batch) >= self.settings['batch_size']):
+                await self.flush()
+        finally:
+            self.turn.release()
+        if self.in_batch:
+            # Left for the next turn to commit, but the waiter may time out before it gets one
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_when_free())
+
+    async def flush_when_free(self):
+        # Queues behind the waiters, whatever is still uncommitted when its turn comes gets committed
+        async with self.turn:
+            if self.in_batch:
+                await self.flush()
+
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        self.in_batch = False
+        try:
+            if not self.db.in_transaction:
+                raise sqlite3.OperationalError("The batch was rolled back by an earlier error")
+            await self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            log.exception("Could not commit batch", extra={'event': 'db_writer.commit_failed', 'transactions': len(batch)})
+            if self.db.in_transaction:
+                await self.db.execute('ROLLBACK')
+            for committed, _ in batch:
+                committed.set_exception(type(e)(str(e)))
+            return
+
+        for committed, tables in batch:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            committed.set_result(None)
+        if len(batch) > 1:
+            log.debug("Committed batch", extra={'event': 'db_writer.batch', 'transactions': len(batch)})
+
+    async def handle(self, reader, writer):
+        session = WriterSession(self)
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                try:
+                    reply = await session.run(request)
+                except sqlite3.Error as e:
+                    reply = {'error': [type(e).__name__, str(e)]}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # A worker that went away mid-transaction leaves nothing behind
+            try:
+                await session.rollback()
+            except sqlite3.Error:
+                log.exception("Could not roll back abandoned transaction", extra={'event': 'db_writer.error'})
+            writer.close()
+
+    async def serve(self):
+        self.db = await aiosqlite.connect(self.settings['db_path'], isolation_level=None)
+        # Workers read through WAL while the writer writes
+        await self.db.execute('PRAGMA journal_mode=WAL')
+        server = await asyncio.start_unix_server(self.handle, path=self.settings['socket_path'], backlog=1024)
+        os.chmod(self.settings['socket_path'], 0o600)
+        log.info("Database writer listening", extra={
+            'event': 'db_writer.started',
+            'socket_path': self.settings['socket_path'],
+            'generation': self.generation
+        })
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.db.close()
+
+class WriterSync(commands.Cog):
+    """Reloads in-memory caches after other workers wrote to the tables behind them"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = writer_settings(bot.config)
+        self.seen = None
+
+    async def cog_load(self):
+        if self.settings['enabled']:
+            self.poll.change_interval(seconds=self.settings['sync_seconds'])
+            self.poll.start()
+
+    async def cog_unload(self):
+        self.poll.cancel()
+
+    def reloads(self):
+        product_manager = self.bot.get_cog('ProductManager')
+        return {
+            'users': self.bot.load_blacklist,
+            'discount_codes': product_manager.discounts.load,
+            'products': product_manager.product_index.load,
+            # Other processes' holds, so menus show what is actually free
+            'stock_reservations': product_manager.reservations.load
+        }
+
+    @tasks.loop(seconds=5)
+    async def poll(self):
+        try:
+            versions = await fetch_versions(self.settings['socket_path'])
+        except sqlite3.Error as e:
+            log.warning("Could not reach the database writer", extra={'event': 'db_writer.unreachable', 'error': str(e)})
+            return
+
+        seen, self.seen = self.seen, versions
+        if seen is None:
+            return
+        restarted = seen['generation'] != versions['generation']
+        for table, reload in self.reloads().items():
+            if restarted or seen['tables'].get(table) != versions['tables'].get(table):
+                try:
+                    await reload()
+                except Exception:
+                    log.exception("Could not reload cache", extra={'event': 'db_writer.sync_error', 'table': table})
+
+async def setup(bot):
+    await bot.add_cog(WriterSync(bot))
+
+def main():
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+    log_listener = setup_logging(config)
+    try:
+        asyncio.run(WriterService(writer_settings(config)).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import discord
+import asyncio
+import gzip
+import tempfile
+
+# Parts are kept in memory up to this size, then spooled to a temp file on disk
+SPOOL_MAX_BYTES = 1024 * 1024
+# Orders larger than this are gzipped before they are sent
+COMPRESS_THRESHOLD_BYTES = 2 * 1024 * 1024
+# Discord's upload limit for accounts without Nitro
+DM_UPLOAD_LIMIT = 10 * 1024 * 1024
+# Room left under the limit for data still buffered in the compressor
+PART_MARGIN_BYTES = 512 * 1024
+MAX_FILES_PER_MESSAGE = 10
+
+class CombinedOrder:
+    """Entries taken for several products, delivered as one order with a heading per product"""
+    def __init__(self, sections):
+        # (heading, taken entries) pairs in delivery order
+        self.sections = sections
+
+    def size(self):
+        return sum(len(heading.encode('utf-8')) + taken.size() for heading, taken in self.sections)
+
+    def lines(self):
+        for heading, taken in self.sections:
+            yield heading
+            yield from taken.lines()
+
+def _order_lines(header, reservation):
+    yield header
+    yield from reservation.lines()
+
+def _build_parts(reservation, header, limit):
+    """Split the order into files under ``limit`` bytes, returns (spooled file, extension) pairs"""
+    compress = reservation.size() > COMPRESS_THRESHOLD_BYTES
+    parts = []
+    raw = stream = None
+    written = 0
+
+    for line in _order_lines(header, reservation):
+        data = line.encode('utf-8')
+        if raw is None:
+            full = False
+        elif compress:
+            # Gzip parts are cut on the compressed size written so far
+            full = raw.tell() >= limit - PART_MARGIN_BYTES
+        else:
+            full = written + len(data) > limit
+        if raw is None or full:
+            if raw is not None:
+                _close_part(raw, stream, parts)
+            raw = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            stream = gzip.GzipFile(fileobj=raw, mode='wb') if compress else raw
+            written = 0
+        stream.write(data)
+        written += len(data)
+    _close_part(raw, stream, parts)
+
+    extension = 'txt.gz' if compress else 'txt'
+    return [(part, extension) for part in parts]
+
+def _close_part(raw, stream, parts):
+    # Closing the gzip stream writes its trailer but leaves the spooled file open
+    if stream is not raw:
+        stream.close()
+    raw.seek(0)
+    parts.append(raw)
+
+async def send_order(user, purchase_id, product_name, quantity, reservation, limit=DM_UPLOAD_LIMIT):
+    """DM a large order as attachments, split over several files and messages when needed"""
+    header = f"Purchase ID: {purchase_id}\nProduct: {product_name} (Quantity: {quantity})\n\n"
+    await send_attachments(user, purchase_id, header, reservation, limit)
+
+async def send_attachments(user, purchase_id, header, reservation, limit=DM_UPLOAD_LIMIT):
+    """DM ``header`` and the taken entries as files named after the purchase"""
+    parts = await asyncio.to_thread(_build_parts, reservation, header, limit)
+    try:
+        for start in range(0, len(parts), MAX_FILES_PER_MESSAGE):
+            batch = parts[start:start + MAX_FILES_PER_MESSAGE]
+            files = [
+                discord.File(
+                    part,
+                    filename=f"purchase_{purchase_id}.{extension}" if len(parts) == 1
+                    else f"purchase_{purchase_id}_part{start + index}.{extension}"
+                )
+                for index, (part, extension) in enumerate(batch, start=1)
+            ]
+            if len(parts) == 1:
+                content = "Your purchase details are in the attached file:"
+            else:
+                content = (f"Your purchase details are in the attached files "
+                           f"({start + 1}-{start + len(batch)} of {len(parts)}):")
+            await user.send(content, files=files)
+    finally:
+        for part, _ in parts:
+            part.close()
@@ -0,0 +1,118 @@
+import heapq
+from datetime import datetime
+from db_writer import connect_db
+
+def parse_expiry(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+class DiscountRegistry:
+    """In-memory index of active discount codes.
+
+    Lookups never touch the database, a min-heap on expiry drops codes as they
+    run out. Consumption goes through a conditional UPDATE so the database stays
+    the source of truth for the remaining uses, the index follows it after commit.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # code -> [discount_amount, discount_type, uses_left, expiry_date]
+        self.codes = {}
+        self.expiry_heap = []
+
+    async def load(self):
+        codes = {}
+        async with connect_db(self.db_path) as db:
+            async with db.execute('''
+                SELECT code, discount_amount, discount_type, uses_left, expiry_date
+                FROM discount_codes
+                WHERE uses_left > 0
+            ''') as cursor:
+                async for code, amount, discount_type, uses_left, expiry_date in cursor:
+                    codes[code] = [amount, discount_type, uses_left, parse_expiry(expiry_date)]
+
+        self.codes = codes
+        self.expiry_heap = [(entry[3], code) for code, entry in codes.items()]
+        heapq.heapify(self.expiry_heap)
+        self.expire()
+
+    def expire(self, now=None):
+        now = now or datetime.now()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expiry_date, code = heapq.heappop(self.expiry_heap)
+            entry = self.codes.get(code)
+            # Skip heap entries left behind by a code that was removed and created again
+            if entry and entry[3] == expiry_date:
+                del self.codes[code]
+
+    def add(self, code, amount, discount_type, uses_left, expiry_date):
+        expiry_date = parse_expiry(expiry_date)
+        self.codes[code] = [amount, discount_type, uses_left, expiry_date]
+        heapq.heappush(self.expiry_heap, (expiry_date, code))
+
+    def remove(self, code):
+        # The heap entry is discarded lazily once it reaches the top
+        self.codes.pop(code, None)
+
+    def get(self, code):
+        """Return (discount_amount, discount_type, uses_left) for a usable code, or None"""
+        self.expire()
+        entry = self.codes.get(code)
+        if not entry or entry[2] <= 0:
+            return None
+        return entry[0], entry[1], entry[2]
+
+    def active(self):
+        """All usable codes as (code, discount_amount, discount_type, uses_left, expiry_date), soonest expiry first"""
+        self.expire()
+        return sorted(
+            ((code, *entry) for code, entry in self.codes.items() if entry[2] > 0),
+            key=lambda row: row[4]
+        )
+
+    async def consume(self, db, code):
+        """Use up one use of a code inside the caller's transaction.
+
+        Returns the updated row to pass to apply() once the transaction has
+        committed, or None without changing anything if the code is exhausted,
+        expired or gone.
+        """
+        now = datetime.now().replace(microsecond=0)
+        async with db.execute('''
+            UPDATE discount_codes
+            SET uses_left = uses_left - 1
+            WHERE code = ? AND uses_left > 0 AND expiry_date > ?
+            RETURNING discount_amount, discount_type, uses_left, expiry_date
+        ''', (code, now)) as cursor:
+            result = await cursor.fetchone()
+
+        if not result:
+            # Nothing was written, the code is unusable whatever the caller does next
+            self.remove(code)
+            return None
+        return result
+
+    async def release(self, db, code):
+        """Give back a use taken by consume() after the purchase was rolled back.
+
+        Returns the updated row to pass to apply() once the transaction has committed.
+        """
+        async with db.execute('''
+            UPDATE discount_codes
+            SET uses_left = uses_left + 1
+            WHERE code = ?
+            RETURNING discount_amount, discount_type, uses_left, expiry_date
+        ''', (code,)) as cursor:
+            return await cursor.fetchone()
+
+    def apply(self, code, row):
+        """Bring the index in line with a row from consume() or release() after its commit"""
+        amount, discount_type, uses_left, expiry_date = row
+        if uses_left <= 0:
+            self.remove(code)
+            return
+        entry = self.codes.get(code)
+        if entry:
+            entry[2] = uses_left
+        else:
+            self.add(code, amount, discount_type, uses_left, expiry_date)
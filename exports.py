@@ -0,0 +1,175 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+import aiosqlite
+import asyncio
+import csv
+import gzip
+import io
+import tempfile
+from datetime import datetime, timedelta
+from bot_logging import get_logger
+from latency import respond, defer_response
+from reports import parse_day
+
+ADMIN_ROLE_NAME = "Admin"
+
+FETCH_SIZE = 500
+# Parts are spooled in memory up to this size, then moved to a temp file on disk
+SPOOL_MAX_BYTES = 1024 * 1024
+# Room left under the upload limit for data still buffered in the compressor
+PART_MARGIN_BYTES = 1024 * 1024
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+EXPORTS = {
+    'transactions': {
+        'header': ['id', 'purchase_id', 'user_id', 'product_id', 'amount', 'original_cost',
+                   'discount_amount', 'discount_code', 'timestamp'],
+        'query': '''
+            SELECT id, purchase_id, user_id, product_id, amount, original_cost,
+                   discount_amount, discount_code, timestamp
+            FROM {schema}.transactions
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY id
+        '''
+    },
+    'users': {
+        'header': ['user_id', 'credits', 'is_blacklisted'],
+        'query': 'SELECT user_id, credits, is_blacklisted FROM users ORDER BY user_id'
+    },
+    'codes': {
+        'header': ['code', 'credits', 'is_used', 'archived_at'],
+        'query': '''
+            SELECT code, credits, is_used, NULL FROM codes
+            UNION ALL
+            SELECT code, credits, 1, archived_at FROM codes_archive
+            WHERE archived_at >= ? AND archived_at < ?
+        '''
+    }
+}
+
+log = get_logger('exports')
+
+class GzipCsvParts:
+    """Writes CSV rows into gzip files that each stay under an upload size limit"""
+    def __init__(self, header, limit):
+        self.header = header
+        self.limit = max(limit - PART_MARGIN_BYTES, limit // 2)
+        self.parts = []
+        self.rows = 0
+        self._open()
+
+    def _open(self):
+        self.raw = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        self.text = io.TextIOWrapper(
+            gzip.GzipFile(fileobj=self.raw, mode='wb'),
+            encoding='utf-8',
+            newline=''
+        )
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(self.header)
+
+    def _close_part(self):
+        # Closing the wrapper finishes the gzip stream but leaves the spooled file open
+        self.text.close()
+        self.raw.seek(0)
+        self.parts.append(self.raw)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.rows += len(rows)
+        if self.raw.tell() >= self.limit:
+            self._close_part()
+            self._open()
+
+    def finish(self):
+        self._close_part()
+        return self.parts
+
+class Exports(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def stream_query(self, db, query, params, parts):
+        async with db.execute(query, params) as cursor:
+            while True:
+                rows = await cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                # Compression is CPU bound, keep it off the event loop
+                await asyncio.to_thread(parts.write_rows, rows)
+
+    async def export(self, table, start, end, limit):
+        export = EXPORTS[table]
+        parts = GzipCsvParts(export['header'], limit)
+        params = (start, end) if '?' in export['query'] else ()
+        try:
+            if table == 'transactions':
+                archive = self.bot.transaction_archive
+                # Oldest archived months first so the export stays in order
+                for path in reversed(archive.partitions()):
+                    async with archive.connect() as db:
+                        await archive.attach(db, path)
+                        await self.stream_query(db, export['query'].format(schema='part'), params, parts)
+                async with aiosqlite.connect(self.bot.db_path) as db:
+                    await self.stream_query(db, export['query'].format(schema='main'), params, parts)
+            else:
+                async with aiosqlite.connect(self.bot.db_path) as db:
+                    await self.stream_query(db, export['query'], params, parts)
+            files = await asyncio.to_thread(parts.finish)
+        except Exception:
+            for part in parts.parts:
+                part.close()
+            raise
+        return files, parts.rows
+
+    @app_commands.command(name="export", description="[Admin] Export transactions, users or codes as gzipped CSV")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def export_command(
+        self,
+        interaction: discord.Interaction,
+        table: str,
+        start_date: str = None,
+        end_date: str = None
+    ):
+        table = table.lower()
+        if table not in EXPORTS:
+            await respond(
+                interaction, f"Table must be one of: {', '.join(EXPORTS)}", ephemeral=True
+            )
+            return
+        try:
+            start_day = parse_day(start_date) if start_date else datetime(1970, 1, 1).date()
+            end_day = parse_day(end_date) if end_date else datetime.utcnow().date()
+        except ValueError:
+            await respond(interaction, "Dates must be in the format YYYY-MM-DD", ephemeral=True)
+            return
+
+        await defer_response(interaction, ephemeral=True)
+        limit = interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT
+        # The end date is inclusive
+        files, rows = await self.export(
+            table, start_day.isoformat(), (end_day + timedelta(days=1)).isoformat(), limit
+        )
+
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        try:
+            for index, part in enumerate(files, start=1):
+                suffix = f"_part{index}" if len(files) > 1 else ""
+                await interaction.followup.send(
+                    f"Export of {table} ({rows} rows), part {index}/{len(files)}" if len(files) > 1
+                    else f"Export of {table} ({rows} rows)",
+                    file=discord.File(part, filename=f"{table}_{stamp}{suffix}.csv.gz"),
+                    ephemeral=True
+                )
+        finally:
+            for part in files:
+                part.close()
+
+        log.info("Exported table", extra={
+            'event': 'exports.completed', 'table': table, 'rows': rows, 'parts': len(files),
+            'user_id': interaction.user.id
+        })
+
+async def setup(bot):
+    await bot.add_cog(Exports(bot))
@@ -0,0 +1,88 @@
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from db_writer import connect_db
+
+# How long a confirmation's result is kept in memory, well past the confirm view's timeout
+NONCE_TTL_SECONDS = 600
+# Rows only need to outlive Discord's retries and buttons on old messages
+NONCE_RETENTION_DAYS = 7
+
+class ConfirmNonces:
+    """Makes each purchase confirmation go through at most once.
+
+    Every confirm view gets a nonce. ``begin`` claims it in memory before the
+    callback awaits anything, so a double click or a retried interaction
+    can't start a second purchase. The purchase transaction also records the
+    nonce in ``purchase_nonces``, whose primary key stops a second commit when
+    the memory is gone. Results are kept for ``ttl`` seconds so repeats get the
+    first answer back.
+    """
+    def __init__(self, db_path, ttl=NONCE_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl = ttl
+        # nonce -> [expires_at, result], the result is None while the purchase runs.
+        # Every entry lives for the same ttl, so insertion order is expiry order
+        self.seen = OrderedDict()
+
+    def new(self):
+        return secrets.token_hex(16)
+
+    def _evict(self, now):
+        while self.seen:
+            nonce, entry = next(iter(self.seen.items()))
+            if entry[0] > now:
+                break
+            del self.seen[nonce]
+
+    def begin(self, nonce):
+        """Claim a nonce, False if a confirmation with it already started"""
+        now = time.time()
+        self._evict(now)
+        if nonce in self.seen:
+            return False
+        self.seen[nonce] = [now + self.ttl, None]
+        return True
+
+    def result(self, nonce):
+        """What the first confirmation answered, None while it is still running"""
+        entry = self.seen.get(nonce)
+        return entry[1] if entry else None
+
+    def finish(self, nonce, result):
+        entry = self.seen.get(nonce)
+        if entry:
+            entry[1] = result
+
+    def forget(self, nonce):
+        """Drop a nonce whose purchase didn't go through, so trying again isn't mistaken for a repeat"""
+        self.seen.pop(nonce, None)
+
+    async def record(self, db, nonce, purchase_id):
+        """Record the nonce inside the caller's transaction, False if it was recorded before"""
+        try:
+            await db.execute(
+                'INSERT INTO purchase_nonces (nonce, purchase_id, created_at) VALUES (?, ?, ?)',
+                (nonce, purchase_id, time.time())
+            )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    async def find(self, nonce):
+        """Purchase ID recorded for a nonce, None if there is none"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('SELECT purchase_id FROM purchase_nonces WHERE nonce = ?', (nonce,)) as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def prune(self):
+        """Delete recorded nonces past retention, returns how many were deleted"""
+        async with connect_db(self.db_path) as db:
+            cursor = await db.execute(
+                'DELETE FROM purchase_nonces WHERE created_at < ?',
+                (time.time() - NONCE_RETENTION_DAYS * 86400,)
+            )
+            await db.commit()
+            return cursor.rowcount
@@ -0,0 +1,254 @@
+import discord
+from discord import app_commands
+from discord.ext import commands, tasks
+import asyncio
+import time
+from collections import deque
+from bot_logging import get_logger
+
+ADMIN_ROLE_NAME = "Admin"
+
+DEFAULT_LATENCY_CONFIG = {
+    # Defer up front when the command is expected to take longer than this to answer
+    "defer_at_seconds": 2.0,
+    # Defer anything still unanswered this long after Discord created the interaction
+    "watchdog_seconds": 2.5,
+    "window": 50,
+    "min_samples": 5,
+    "metrics_interval_minutes": 15
+}
+
+# Discord answers with this code once the 3 second response deadline has passed
+UNKNOWN_INTERACTION = 10062
+COMPONENTS = 'components'
+
+log = get_logger('latency')
+
+class CommandLatency:
+    """Rolling window of recent durations for one command, plus defer and timeout counters"""
+    __slots__ = ('samples', 'invocations', 'deferred', 'timeouts')
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.invocations = 0
+        self.deferred = 0
+        self.timeouts = 0
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def reset_counters(self):
+        self.invocations = self.deferred = self.timeouts = 0
+
+def _response_lock(interaction):
+    # Serializes the watchdog's defer with the command's own answer
+    lock = interaction.extras.get('response_lock')
+    if lock is None:
+        lock = interaction.extras['response_lock'] = asyncio.Lock()
+    return lock
+
+async def _track(interaction, coro):
+    try:
+        return await coro
+    except discord.NotFound as e:
+        stats = interaction.extras.get('latency_stats')
+        if e.code == UNKNOWN_INTERACTION and stats:
+            stats.timeouts += 1
+        raise
+
+async def respond(interaction, content=None, **kwargs):
+    """Answer an interaction, as a followup once it was deferred or answered.
+
+    Commands and component callbacks answer through this instead of
+    ``interaction.response.send_message``, so they keep working after an
+    automatic defer.
+    """
+    async with _response_lock(interaction):
+        if interaction.response.is_done():
+            kwargs.pop('delete_after', None)
+            return await interaction.followup.send(content, **kwargs)
+        return await _track(interaction, interaction.response.send_message(content, **kwargs))
+
+async def edit_response(interaction, **kwargs):
+    """Edit the message a component belongs to, through the original response once deferred"""
+    async with _response_lock(interaction):
+        if interaction.response.is_done():
+            kwargs.pop('delete_after', None)
+            return await interaction.edit_original_response(**kwargs)
+        return await _track(interaction, interaction.response.edit_message(**kwargs))
+
+async def defer_response(interaction, **kwargs):
+    """Defer an interaction, a no-op if it was already deferred or answered"""
+    async with _response_lock(interaction):
+        if interaction.response.is_done():
+            return
+        await _track(interaction, interaction.response.defer(**kwargs))
+
+async def auto_defer(interaction):
+    """Defer an interaction nothing has answered yet, returns whether it did"""
+    stats = interaction.extras['latency_stats']
+    async with _response_lock(interaction):
+        if interaction.response.is_done():
+            return False
+        try:
+            if interaction.type is discord.InteractionType.component:
+                # Acknowledge without a visible "thinking" state, the callback's reply becomes a followup
+                await interaction.response.defer()
+            else:
+                # The deferred message becomes the command's reply, so it takes the command's visibility
+                ephemeral = interaction.command.extras.get('ephemeral', True)
+                await interaction.response.defer(ephemeral=ephemeral, thinking=True)
+        except discord.NotFound as e:
+            if e.code != UNKNOWN_INTERACTION:
+                raise
+            stats.timeouts += 1
+            return False
+    stats.deferred += 1
+    return True
+
+class Latency(commands.Cog):
+    """Per-command latency tracking with automatic defers ahead of Discord's response deadline"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = {**DEFAULT_LATENCY_CONFIG, **bot.config.get('latency', {})}
+        self.stats = {}
+        self.watchdogs = set()
+
+    async def cog_load(self):
+        # First in line so the timing covers the other hooks too
+        self.bot.tree.before_invoke_hooks.insert(0, self.before_invoke)
+        self.bot.tree.after_invoke_hooks.append(self.after_invoke)
+        self.metrics.change_interval(minutes=self.settings['metrics_interval_minutes'])
+        self.metrics.start()
+
+    async def cog_unload(self):
+        self.bot.tree.before_invoke_hooks.remove(self.before_invoke)
+        self.bot.tree.after_invoke_hooks.remove(self.after_invoke)
+        self.metrics.cancel()
+        for watchdog in self.watchdogs:
+            watchdog.cancel()
+
+    def stats_for(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CommandLatency(self.settings['window'])
+        return stats
+
+    def age(self, interaction):
+        return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+    def start_watchdog(self, interaction):
+        async def watchdog():
+            await asyncio.sleep(max(0, self.settings['watchdog_seconds'] - self.age(interaction)))
+            if await auto_defer(interaction):
+                log.info("Deferred slow interaction", extra={
+                    'event': 'latency.watchdog_defer',
+                    'command': interaction.extras.get('latency_command', COMPONENTS),
+                    'user_id': interaction.user.id
+                })
+
+        task = asyncio.create_task(watchdog())
+        self.watchdogs.add(task)
+        task.add_done_callback(self.watchdogs.discard)
+        return task
+
+    async def before_invoke(self, interaction: discord.Interaction):
+        name = interaction.command.qualified_name
+        stats = self.stats_for(name)
+        stats.invocations += 1
+        interaction.extras['latency_stats'] = stats
+        interaction.extras['latency_command'] = name
+        interaction.extras['latency_started'] = time.perf_counter()
+
+        expected = stats.percentile(0.9) if len(stats.samples) >= self.settings['min_samples'] else 0.0
+        if self.age(interaction) + expected >= self.settings['defer_at_seconds']:
+            await auto_defer(interaction)
+        else:
+            interaction.extras['latency_watchdog'] = self.start_watchdog(interaction)
+
+    async def after_invoke(self, interaction: discord.Interaction):
+        started = interaction.extras.pop('latency_started', None)
+        watchdog = interaction.extras.pop('latency_watchdog', None)
+        if watchdog:
+            watchdog.cancel()
+        if started is not None:
+            self.stats_for(interaction.extras['latency_command']).samples.append(time.perf_counter() - started)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction: discord.Interaction):
+        # Component callbacks aren't tree commands, they only get the deadline watchdog.
+        # It defers through the same lock the callback answers through, whichever is first wins
+        if interaction.type is not discord.InteractionType.component:
+            return
+        stats = self.stats_for(COMPONENTS)
+        stats.invocations += 1
+        interaction.extras['latency_stats'] = stats
+        self.start_watchdog(interaction)
+
+    def snapshot(self):
+        rows = []
+        for name, stats in sorted(self.stats.items()):
+            invocations = stats.invocations or 1
+            rows.append({
+                'command': name,
+                'invocations': stats.invocations,
+                'p50_ms': round(stats.percentile(0.5) * 1000, 1),
+                'p90_ms': round(stats.percentile(0.9) * 1000, 1),
+                'defer_rate': round(stats.deferred / invocations, 3),
+                'timeout_rate': round(stats.timeouts / invocations, 3)
+            })
+        return rows
+
+    @tasks.loop(minutes=15)
+    async def metrics(self):
+        for row in self.snapshot():
+            if row['invocations']:
+                log.info("Command latency", extra={'event': 'latency.metrics', **row})
+        for stats in self.stats.values():
+            stats.reset_counters()
+        shard_health = self.bot.get_cog('ShardHealth')
+        if shard_health:
+            for row in shard_health.snapshot():
+                log.info("Shard health", extra={'event': 'latency.shards', **row})
+
+    def shard_summary(self):
+        shard_health = self.bot.get_cog('ShardHealth')
+        if not shard_health:
+            return ""
+        lines = [
+            f"Shard {row['shard_id']}: {'ready' if row['ready'] else 'down'}, "
+            f"{row['latency_ms'] if row['latency_ms'] is not None else '?'} ms, {row['disconnects']} disconnects"
+            for row in shard_health.snapshot()
+        ]
+        return "\n" + "\n".join(lines) if lines else ""
+
+    @app_commands.command(name="latency", description="[Admin] Show command latency, defer and timeout rates")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def latency(self, interaction: discord.Interaction):
+        rows = self.snapshot()
+        if not rows:
+            await respond(interaction, "No commands have been run yet.", ephemeral=True)
+            return
+
+        embed = discord.Embed(
+            title="Command Latency",
+            description=f"Since the last metrics flush (every {self.settings['metrics_interval_minutes']} minutes)"
+                        + self.shard_summary(),
+            color=discord.Color.blue()
+        )
+        for row in rows[:25]:
+            embed.add_field(
+                name=row['command'],
+                value=f"Runs: {row['invocations']}\n"
+                      f"p50 / p90: {row['p50_ms']} / {row['p90_ms']} ms\n"
+                      f"Deferred: {row['defer_rate']:.0%}\n"
+                      f"Timed out: {row['timeout_rate']:.0%}",
+                inline=True
+            )
+        await respond(interaction, embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Latency(bot))
@@ -0,0 +1,163 @@
+from bot_logging import get_logger
+from db_writer import connect_db
+
+# Counter accounts for the other side of every user credit movement
+ACCOUNT_ADMIN = 'system:admin'
+ACCOUNT_CODES = 'system:codes'
+ACCOUNT_SALES = 'system:sales'
+ACCOUNT_OPENING = 'system:opening'
+
+log = get_logger('ledger')
+
+def user_account(user_id):
+    return f"user:{user_id}"
+
+class CreditLedger:
+    """Append-only double-entry ledger behind ``users.credits``.
+
+    Every change to a balance is a transfer with two entries that sum to zero,
+    one on the user's account and one on a system account. ``users.credits``
+    stays as the materialized balance, and checkpoints let a balance be
+    rebuilt from the last checkpoint plus the entries after it.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    async def move(self, db, user_id, amount, reason, reference=None, counter_account=ACCOUNT_ADMIN):
+        """Change a user's balance inside the caller's transaction, returns the new balance"""
+        await db.execute('INSERT OR IGNORE INTO users (user_id, credits) VALUES (?, 0)', (user_id,))
+        async with db.execute(
+            'UPDATE users SET credits = credits + ? WHERE user_id = ? RETURNING credits',
+            (amount, user_id)
+        ) as cursor:
+            balance = (await cursor.fetchone())[0]
+
+        cursor = await db.execute(
+            'INSERT INTO ledger_transfers (reason, reference) VALUES (?, ?)',
+            (reason, reference)
+        )
+        transfer_id = cursor.lastrowid
+        await db.executemany(
+            'INSERT INTO ledger_entries (transfer_id, account, user_id, amount) VALUES (?, ?, ?, ?)',
+            [
+                (transfer_id, user_account(user_id), user_id, amount),
+                (transfer_id, counter_account, None, -amount)
+            ]
+        )
+        return balance
+
+    async def open_balances(self):
+        """Record an opening transfer for balances that predate the ledger"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('''
+                SELECT user_id, credits FROM users u
+                WHERE credits != 0
+                AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.user_id = u.user_id)
+            ''') as cursor:
+                balances = await cursor.fetchall()
+
+            for user_id, credits in balances:
+                cursor = await db.execute(
+                    'INSERT INTO ledger_transfers (reason) VALUES (?)',
+                    ('opening_balance',)
+                )
+                await db.executemany(
+                    'INSERT INTO ledger_entries (transfer_id, account, user_id, amount) VALUES (?, ?, ?, ?)',
+                    [
+                        (cursor.lastrowid, user_account(user_id), user_id, credits),
+                        (cursor.lastrowid, ACCOUNT_OPENING, None, -credits)
+                    ]
+                )
+            await db.commit()
+
+        if balances:
+            log.info("Opened ledger balances", extra={'event': 'ledger.opened', 'count': len(balances)})
+
+    async def rebuild_balance(self, db, user_id):
+        """Balance from the latest checkpoint plus the entries written after it"""
+        async with db.execute('''
+            SELECT entry_id, balance FROM ledger_checkpoints
+            WHERE user_id = ?
+            ORDER BY entry_id DESC LIMIT 1
+        ''', (user_id,)) as cursor:
+            checkpoint = await cursor.fetchone()
+        entry_id, balance = checkpoint if checkpoint else (0, 0)
+
+        async with db.execute(
+            'SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE user_id = ? AND id > ?',
+            (user_id, entry_id)
+        ) as cursor:
+            tail = (await cursor.fetchone())[0]
+        return balance + tail
+
+    async def checkpoint(self, min_entries=20):
+        """Checkpoint every user with at least ``min_entries`` entries since their last checkpoint"""
+        async with connect_db(self.db_path) as db:
+            cursor = await db.execute('''
+                INSERT INTO ledger_checkpoints (user_id, entry_id, balance)
+                SELECT
+                    e.user_id,
+                    MAX(e.id),
+                    COALESCE(c.balance, 0) + SUM(e.amount)
+                FROM ledger_entries e
+                LEFT JOIN ledger_checkpoints c ON c.user_id = e.user_id
+                    AND c.entry_id = (SELECT MAX(entry_id) FROM ledger_checkpoints WHERE user_id = e.user_id)
+                WHERE e.user_id IS NOT NULL
+                AND e.id > COALESCE(c.entry_id, 0)
+                GROUP BY e.user_id
+                HAVING COUNT(*) >= ?
+            ''', (min_entries,))
+            created = cursor.rowcount
+            # Only the latest checkpoint per user is ever read
+            await db.execute('''
+                DELETE FROM ledger_checkpoints
+                WHERE entry_id < (SELECT MAX(entry_id) FROM ledger_checkpoints c WHERE c.user_id = ledger_checkpoints.user_id)
+            ''')
+            await db.commit()
+        return created
+
+    async def reconcile(self):
+        """Compare every materialized balance with the ledger.
+
+        Returns a list of (user_id, materialized balance, ledger balance) for users that drifted,
+        plus the ids of transfers whose entries don't sum to zero.
+        """
+        async with connect_db(self.db_path) as db:
+            # One statement reads one snapshot, a transfer committed mid-check can't show up on only one side.
+            # Each balance is the user's latest checkpoint plus the entries after it, as in rebuild_balance()
+            async with db.execute('''
+                WITH checkpoints AS (
+                    SELECT c.user_id, c.entry_id, c.balance FROM ledger_checkpoints c
+                    WHERE c.entry_id = (SELECT MAX(entry_id) FROM ledger_checkpoints WHERE user_id = c.user_id)
+                ), tails AS (
+                    SELECT e.user_id, SUM(e.amount) AS amount
+                    FROM ledger_entries e
+                    LEFT JOIN checkpoints c ON c.user_id = e.user_id
+                    WHERE e.user_id IS NOT NULL
+                    AND e.id > COALESCE(c.entry_id, 0)
+                    GROUP BY e.user_id
+                )
+                SELECT u.user_id, u.credits, COALESCE(c.balance, 0) + COALESCE(t.amount, 0)
+                FROM users u
+                LEFT JOIN checkpoints c ON c.user_id = u.user_id
+                LEFT JOIN tails t ON t.user_id = u.user_id
+                WHERE COALESCE(c.balance, 0) + COALESCE(t.amount, 0) != COALESCE(u.credits, 0)
+            ''') as cursor:
+                drifted = [tuple(row) for row in await cursor.fetchall()]
+
+            async with db.execute('''
+                SELECT transfer_id FROM ledger_entries
+                GROUP BY transfer_id
+                HAVING SUM(amount) != 0
+            ''') as cursor:
+                unbalanced = [row[0] for row in await cursor.fetchall()]
+
+        if drifted or unbalanced:
+            log.warning("Ledger reconciliation found drift", extra={
+                'event': 'ledger.drift',
+                'drifted_users': [user_id for user_id, _, _ in drifted],
+                'unbalanced_transfers': unbalanced
+            })
+        else:
+            log.info("Ledger reconciled", extra={'event': 'ledger.reconciled'})
+        return drifted, unbalanced
@@ -0,0 +1,168 @@
+import discord
+from discord import app_commands
+from discord.ext import commands, tasks
+import asyncio
+from datetime import datetime, time
+from bot_logging import get_logger
+from latency import defer_response
+from sharding import runs_first_shard
+from db_writer import connect_db
+
+ADMIN_ROLE_NAME = "Admin"
+
+DEFAULT_MAINTENANCE_CONFIG = {
+    "interval_minutes": 60,
+    "batch_size": 500,
+    "batch_pause_seconds": 0.05,
+    "checkpoint_min_entries": 20,
+    "reconcile_hour": 3
+}
+
+log = get_logger('maintenance')
+
+# Each sweep moves rows matching `condition` from `table` into `archive`, one batch per transaction
+SWEEPS = {
+    'codes': {
+        'table': 'codes',
+        'archive': 'codes_archive',
+        'columns': 'code, credits',
+        'condition': 'is_used = 1'
+    },
+    'discount_codes': {
+        'table': 'discount_codes',
+        'archive': 'discount_codes_archive',
+        'columns': 'code, discount_amount, discount_type, max_uses, uses_left, expiry_date',
+        'condition': 'uses_left <= 0 OR expiry_date <= :now'
+    }
+}
+
+class Maintenance(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = {**DEFAULT_MAINTENANCE_CONFIG, **bot.config.get('maintenance', {})}
+        self.lock = asyncio.Lock()
+
+    async def cog_load(self):
+        # With the shards split across processes, one of them does the housekeeping
+        if not runs_first_shard(self.bot):
+            return
+        self.sweeper.change_interval(minutes=self.settings['interval_minutes'])
+        self.sweeper.start()
+        self.reconciler.change_interval(time=time(hour=self.settings['reconcile_hour']))
+        self.reconciler.start()
+
+    async def cog_unload(self):
+        self.sweeper.cancel()
+        self.reconciler.cancel()
+
+    @tasks.loop(minutes=60)
+    async def sweeper(self):
+        try:
+            await self.run_maintenance()
+        except Exception:
+            log.exception("Maintenance run failed", extra={'event': 'maintenance.error'})
+
+    @tasks.loop(time=time(hour=3))
+    async def reconciler(self):
+        try:
+            await self.bot.ledger.reconcile()
+        except Exception:
+            log.exception("Ledger reconciliation failed", extra={'event': 'ledger.error'})
+
+    @sweeper.before_loop
+    @reconciler.before_loop
+    async def before_sweeper(self):
+        await self.bot.wait_until_ready()
+
+    async def run_maintenance(self):
+        """Run every maintenance job once, returns a dict of job name to rows affected"""
+        async with self.lock:
+            results = {}
+            for name in SWEEPS:
+                results[name] = await self.sweep(name)
+            results['transactions'] = await self.bot.transaction_archive.roll()
+            results['ledger_checkpoints'] = await self.bot.ledger.checkpoint(self.settings['checkpoint_min_entries'])
+            product_manager = self.bot.get_cog('ProductManager')
+            if product_manager:
+                results['purchase_nonces'] = await product_manager.confirmations.prune()
+            log.info("Maintenance sweep finished", extra={'event': 'maintenance.swept', **results})
+            return results
+
+    async def sweep(self, name):
+        """Move matching rows into the archive table in small batches, returns how many were moved"""
+        sweep = SWEEPS[name]
+        batch = (
+            f"SELECT rowid FROM {sweep['table']} "
+            f"WHERE ({sweep['condition']}) ORDER BY rowid LIMIT :batch_size"
+        )
+        params = {
+            'now': datetime.now().replace(microsecond=0),
+            'batch_size': self.settings['batch_size']
+        }
+        total = 0
+
+        async with connect_db(self.bot.db_path, isolation_level=None) as db:
+            while True:
+                # One short write transaction per batch so purchases can interleave
+                await db.execute('BEGIN IMMEDIATE')
+                try:
+                    await db.execute(
+                        f"INSERT OR REPLACE INTO {sweep['archive']} ({sweep['columns']}) "
+                        f"SELECT {sweep['columns']} FROM {sweep['table']} WHERE rowid IN ({batch})",
+                        params
+                    )
+                    cursor = await db.execute(
+                        f"DELETE FROM {sweep['table']} WHERE rowid IN ({batch})",
+                        params
+                    )
+                    moved = cursor.rowcount
+                    await db.execute('COMMIT')
+                except Exception:
+                    await db.execute('ROLLBACK')
+                    raise
+
+                total += moved
+                if moved < self.settings['batch_size']:
+                    return total
+                await asyncio.sleep(self.settings['batch_pause_seconds'])
+
+    @app_commands.command(name="sweep", description="[Admin] Archive used codes, expired discounts and old transactions now")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def sweep_now(self, interaction: discord.Interaction):
+        await defer_response(interaction, ephemeral=True)
+        results = await self.run_maintenance()
+
+        embed = discord.Embed(title="Maintenance Sweep", color=discord.Color.blue())
+        embed.add_field(name="Used codes archived", value=str(results['codes']), inline=True)
+        embed.add_field(name="Discount codes archived", value=str(results['discount_codes']), inline=True)
+        embed.add_field(name="Transactions partitioned", value=str(results['transactions']), inline=True)
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="reconcile", description="[Admin] Check every balance against the credit ledger")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def reconcile(self, interaction: discord.Interaction):
+        await defer_response(interaction, ephemeral=True)
+        drifted, unbalanced = await self.bot.ledger.reconcile()
+
+        if not drifted and not unbalanced:
+            await interaction.followup.send("All balances match the ledger.", ephemeral=True)
+            return
+
+        embed = discord.Embed(title="Ledger Drift", color=discord.Color.red())
+        for user_id, credits, ledger_balance in drifted[:20]:
+            embed.add_field(
+                name=f"User ID: {user_id}",
+                value=f"Balance: {credits}\nLedger: {ledger_balance}",
+                inline=True
+            )
+        if unbalanced:
+            embed.add_field(
+                name="Unbalanced transfers",
+                value=", ".join(map(str, unbalanced[:50])),
+                inline=False
+            )
+        embed.set_footer(text=f"{len(drifted)} drifted balances. Use /verify_balance with repair to fix one.")
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Maintenance(bot))
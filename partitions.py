@@ -0,0 +1,225 @@
+import aiosqlite
+import asyncio
+import glob
+import os
+from bot_logging import get_logger
+from db_writer import writer_enabled
+
+DEFAULT_ARCHIVE_CONFIG = {
+    "archive_dir": "data/archive",
+    "max_age_days": 90,
+    "batch_size": 500,
+    "batch_pause_seconds": 0.05
+}
+
+PARTITION_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS part.transactions
+        (id INTEGER PRIMARY KEY,
+         purchase_id TEXT,
+         user_id INTEGER,
+         product_id INTEGER,
+         amount INTEGER,
+         original_cost INTEGER,
+         discount_amount INTEGER DEFAULT 0,
+         discount_code TEXT,
+         timestamp DATETIME)''',
+    # Not unique: new ids are checked against the main table and every archive when generated,
+    # and a batch copied again after a crash is skipped by the id primary key instead
+    'CREATE INDEX IF NOT EXISTS part.idx_transactions_purchase ON transactions (purchase_id)',
+    'CREATE INDEX IF NOT EXISTS part.idx_transactions_user ON transactions (user_id, timestamp)'
+]
+
+TRANSACTION_COLUMNS = 'id, purchase_id, user_id, product_id, amount, original_cost, discount_amount, discount_code, timestamp'
+
+log = get_logger('partitions')
+
+class TransactionArchive:
+    """Monthly archive databases for old transactions.
+
+    Transactions older than ``max_age_days`` are moved out of the main database
+    into one file per month. Lookups check the main database first and then
+    attach archive files read-only, newest first, until they have enough rows.
+    """
+    def __init__(self, db_path, settings=None):
+        self.db_path = db_path
+        self.settings = {**DEFAULT_ARCHIVE_CONFIG, **(settings or {})}
+        self.archive_dir = self.settings['archive_dir']
+
+    def partition_path(self, month):
+        return os.path.join(self.archive_dir, f"transactions_{month}.db")
+
+    def partitions(self):
+        """Archive files, newest month first"""
+        return sorted(glob.glob(os.path.join(self.archive_dir, 'transactions_*.db')), reverse=True)
+
+    def connect(self):
+        # URI filenames let us attach archives with mode=ro
+        return aiosqlite.connect(self.db_path, uri=True)
+
+    async def attach(self, db, path, alias='part'):
+        await db.execute(f"ATTACH DATABASE ? AS {alias}", (f"file:{path}?mode=ro",))
+
+    async def roll(self):
+        """Move transactions past the age limit into their monthly archive, returns how many were moved"""
+        # Archiving attaches the archive files to a connection of its own, which the writer process can't
+        # do inside its batches. With the writer on, transactions stay in the main database
+        if writer_enabled():
+            log.warning("Skipped rolling transactions, the database writer is enabled", extra={
+                'event': 'partitions.skipped'
+            })
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        cutoff = f"-{int(self.settings['max_age_days'])} days"
+        batch_size = self.settings['batch_size']
+        total = 0
+
+        async with aiosqlite.connect(self.db_path, isolation_level=None) as db:
+            async with db.execute('''
+                SELECT DISTINCT strftime('%Y_%m', timestamp)
+                FROM transactions
+                WHERE timestamp < datetime('now', ?)
+            ''', (cutoff,)) as cursor:
+                months = [row[0] for row in await cursor.fetchall()]
+
+            for month in months:
+                await db.execute("ATTACH DATABASE ? AS part", (self.partition_path(month),))
+                try:
+                    for statement in PARTITION_SCHEMA:
+                        await db.execute(statement)
+
+                    batch = '''
+                        SELECT id FROM main.transactions
+                        WHERE strftime('%Y_%m', timestamp) = :month
+                        AND timestamp < datetime('now', :cutoff)
+                        ORDER BY id LIMIT :batch_size
+                    '''
+                    params = {'month': month, 'cutoff': cutoff, 'batch_size': batch_size}
+                    while True:
+                        # A transaction across two WAL databases isn't atomic, a crash can commit one file
+                        # and not the other. So the copy commits first, and only rows the archive holds are
+                        # deleted afterwards; rows left in both are skipped by the next copy and deleted then.
+                        # Short transactions so purchases aren't kept waiting on the write lock
+                        await db.execute('BEGIN IMMEDIATE')
+                        try:
+                            await db.execute(
+                                f"INSERT OR IGNORE INTO part.transactions ({TRANSACTION_COLUMNS}) "
+                                f"SELECT {TRANSACTION_COLUMNS} FROM main.transactions WHERE id IN ({batch})",
+                                params
+                            )
+                            await db.execute('COMMIT')
+                        except Exception:
+                            await db.execute('ROLLBACK')
+                            raise
+
+                        await db.execute('BEGIN IMMEDIATE')
+                        try:
+                            cursor = await db.execute(
+                                f"DELETE FROM main.transactions WHERE id IN ({batch}) "
+                                "AND id IN (SELECT id FROM part.transactions)",
+                                params
+                            )
+                            moved = cursor.rowcount
+                            await db.execute('COMMIT')
+                        except Exception:
+                            await db.execute('ROLLBACK')
+                            raise
+
+                        total += moved
+                        if moved < batch_size:
+                            break
+                        await asyncio.sleep(self.settings['batch_pause_seconds'])
+                finally:
+                    await db.execute("DETACH DATABASE part")
+
+        if total:
+            log.info("Rolled transactions into archives", extra={
+                'event': 'partitions.rolled', 'count': total, 'months': months
+            })
+        return total
+
+    async def purchase_id_taken(self, purchase_id):
+        """Whether a purchase uses the ID, alone or with a cart's -<line> suffix, in any partition"""
+        query = 'SELECT 1 FROM {schema}.transactions WHERE purchase_id = ? OR purchase_id GLOB ?'
+        params = (purchase_id, f"{purchase_id}-*")
+        # Main first: a roll copies rows into the archive before deleting them, so a row missing
+        # here is already in its archive by the time those are checked
+        async with self.connect() as db:
+            async with db.execute(query.format(schema='main'), params) as cursor:
+                if await cursor.fetchone():
+                    return True
+
+            for path in self.partitions():
+                await self.attach(db, path)
+                try:
+                    async with db.execute(query.format(schema='part'), params) as cursor:
+                        taken = await cursor.fetchone() is not None
+                finally:
+                    await db.execute("DETACH DATABASE part")
+                if taken:
+                    return True
+        return False
+
+    async def find_purchase(self, purchase_id):
+        """Return (purchase_id, amount, timestamp, product_name, price, user_id) or None"""
+        query = '''
+            SELECT
+                t.purchase_id,
+                t.amount,
+                t.timestamp,
+                p.name as product_name,
+                p.price,
+                u.user_id
+            FROM {schema}.transactions t
+            JOIN main.products p ON t.product_id = p.id
+            JOIN main.users u ON t.user_id = u.user_id
+            WHERE t.purchase_id = ?
+        '''
+        async with self.connect() as db:
+            async with db.execute(query.format(schema='main'), (purchase_id,)) as cursor:
+                result = await cursor.fetchone()
+            if result:
+                return result
+
+            for path in self.partitions():
+                await self.attach(db, path)
+                try:
+                    async with db.execute(query.format(schema='part'), (purchase_id,)) as cursor:
+                        result = await cursor.fetchone()
+                finally:
+                    await db.execute("DETACH DATABASE part")
+                if result:
+                    return result
+        return None
+
+    async def recent_purchases(self, user_id, limit):
+        """Return the user's latest purchases across all partitions as
+        (purchase_id, amount, timestamp, product_name, price), newest first"""
+        query = '''
+            SELECT
+                t.purchase_id,
+                t.amount,
+                t.timestamp,
+                p.name as product_name,
+                p.price
+            FROM {schema}.transactions t
+            JOIN main.products p ON t.product_id = p.id
+            WHERE t.user_id = ?
+            ORDER BY t.timestamp DESC
+            LIMIT ?
+        '''
+        async with self.connect() as db:
+            async with db.execute(query.format(schema='main'), (user_id, limit)) as cursor:
+                purchases = list(await cursor.fetchall())
+
+            for path in self.partitions():
+                if len(purchases) >= limit:
+                    break
+                await self.attach(db, path)
+                try:
+                    async with db.execute(query.format(schema='part'), (user_id, limit - len(purchases))) as cursor:
+                        purchases.extend(await cursor.fetchall())
+                finally:
+                    await db.execute("DETACH DATABASE part")
+
+        purchases.sort(key=lambda row: row[2], reverse=True)
+        return purchases[:limit]
@@ -0,0 +1,88 @@
+import aiosqlite
+import bisect
+
+# Discord shows at most 25 autocomplete choices
+MAX_SUGGESTIONS = 25
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class ProductIndex:
+    """Product names in memory, for autocomplete without a database query.
+
+    Prefix matches come from a sorted list of lowercased names searched with
+    bisect, matches further inside a name from a trigram index. Both are
+    updated in place when a product is added or removed.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.names = {}
+        # (lowercased name, product id), sorted
+        self.sorted = []
+        # trigram -> ids of products whose name contains it
+        self.trigrams = {}
+
+    async def load(self):
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute('SELECT id, name FROM products') as cursor:
+                rows = await cursor.fetchall()
+
+        self.names = {}
+        self.sorted = []
+        self.trigrams = {}
+        for product_id, name in rows:
+            self.add(product_id, name or '')
+
+    def add(self, product_id, name):
+        self.remove(product_id)
+        key = name.lower()
+        self.names[product_id] = name
+        bisect.insort(self.sorted, (key, product_id))
+        for trigram in _trigrams(key):
+            self.trigrams.setdefault(trigram, set()).add(product_id)
+
+    def remove(self, product_id):
+        name = self.names.pop(product_id, None)
+        if name is None:
+            return
+        key = name.lower()
+        del self.sorted[bisect.bisect_left(self.sorted, (key, product_id))]
+        for trigram in _trigrams(key):
+            ids = self.trigrams[trigram]
+            ids.discard(product_id)
+            if not ids:
+                del self.trigrams[trigram]
+
+    def search(self, query, limit=MAX_SUGGESTIONS):
+        """Up to ``limit`` (product id, name) pairs, names starting with the query first"""
+        query = query.strip().lower()
+        found = []
+        start = bisect.bisect_left(self.sorted, (query,))
+        for key, product_id in self.sorted[start:start + limit]:
+            if not key.startswith(query):
+                break
+            found.append(product_id)
+
+        trigrams = _trigrams(query)
+        if len(found) < limit and trigrams:
+            # Smallest posting list first, so the intersection stays small
+            postings = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams), key=len)
+            candidates = set.intersection(*postings) - set(found)
+            contained = sorted(
+                (self.names[product_id].lower(), product_id) for product_id in candidates
+                if query in self.names[product_id].lower()
+            )
+            found += [product_id for _, product_id in contained[:limit - len(found)]]
+
+        return [(product_id, self.names[product_id]) for product_id in found]
+
+    def resolve(self, value):
+        """Product id for an autocomplete choice or a typed name, None if there is no such product"""
+        value = value.strip()
+        if value.isdigit() and int(value) in self.names:
+            return int(value)
+        key = value.lower()
+        index = bisect.bisect_left(self.sorted, (key,))
+        if index < len(self.sorted) and self.sorted[index][0] == key:
+            return self.sorted[index][1]
+        return None
@@ -1,91 +1,186 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 import os
 import shutil
-import aiosqlite
 import json
 import random
 import math
 import string
-import io
+import asyncio
+import time
+from bot_logging import get_logger
+from latency import respond, edit_response, defer_response
+from discounts import DiscountRegistry
+from ledger import ACCOUNT_SALES
+from delivery import send_order, send_attachments, CombinedOrder
+from stock_index import StockIndex
+from stock_store import StockStore, StockConflict, read_entries, migrate_stock_files
+from reservations import StockReservations, RESERVATION_SECONDS
+from product_index import ProductIndex
+from idempotency import ConfirmNonces
+from product_views import (PurchaseSelect, PurchaseConfirm, CartConfirm, RestockSelect, RemoveProductSelect,
+                           ManageStockSelect, stock_page_view, DYNAMIC_ITEMS)
+from db_writer import connect_db, writer_enabled
+from sharding import splits_shards, holds_guild
+from rate_limits import write_slot
 
 ADMIN_ROLE_NAME = "Admin"
 
+log = get_logger('products')
+
+# A select menu holds at most 25 options, which caps the number of products in a cart
+MAX_CART_PRODUCTS = 25
+
+def split_discount(costs, discount):
+    """Share a discount over line items in proportion to their cost, never more than a line costs"""
+    total = sum(costs)
+    if not total:
+        return [0] * len(costs)
+    shares = [discount * cost // total for cost in costs]
+    # Credits lost to rounding down go to the first lines with room for them
+    leftover = discount - sum(shares)
+    for i, cost in enumerate(costs):
+        extra = min(leftover, cost - shares[i])
+        shares[i] += extra
+        leftover -= extra
+    return shares
+
+# Discount codes travel in purchase custom_ids, which are at most 100 characters
+MAX_DISCOUNT_CODE_LENGTH = 40
+
+def more_products_hint(count):
+    if count <= 25:
+        return ""
+    return f"\nShowing 25 of {count} products, use the `product` option to search all of them."
+
 class ProductManager(commands.Cog):
+    cart = app_commands.Group(name="cart", description="Collect several products and buy them in one checkout")
+
     def __init__(self, bot):
         self.bot = bot
         self.guild_ids = [int(guild_id) for guild_id in bot.config['guild_ids']]
+        self.discounts = DiscountRegistry(bot.db_path)
+        self.stock_index = StockIndex(bot.db_path, use_filter=not writer_enabled())
+        self.reservations = StockReservations(bot.db_path)
+        self.product_index = ProductIndex(bot.db_path)
+        self.confirmations = ConfirmNonces(bot.db_path)
+        # user id -> {product id: quantity}, in the order products were added
+        self.carts = {}
+        # Stock alerts being sent in the background, referenced until they finish
+        self.alerts = set()
         self.ensure_product_directory()
 
-    def ensure_product_directory(self):
-        if not os.path.exists('products'):
-            os.makedirs('products')
+    async def cog_load(self):
+        await self.discounts.load()
+        # Plain text stock files from before the block store are converted once
+        migrated = await asyncio.to_thread(migrate_stock_files)
+        if migrated:
+            log.info("Migrated stock files", extra={'event': 'stock.migrated', 'product_ids': migrated})
+        await self.stock_index.load()
+        await self.reservations.prune()
+        await self.reservations.load()
+        await self.product_index.load()
+        # Menus are routed by custom_id, so ones sent before a restart still work
+        self.bot.add_dynamic_items(*DYNAMIC_ITEMS)
+        self.expire_reservations.start()
+        # Alerts for guilds on another process's shards are queued in the database
+        if splits_shards(self.bot):
+            self.deliver_stock_alerts.start()
 
-    async def count_lines_in_file(self, file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return sum(1 for line in f if line.strip())
-        except:
-            return 0
+    async def cog_unload(self):
+        self.expire_reservations.cancel()
+        self.deliver_stock_alerts.cancel()
+        self.bot.remove_dynamic_items(*DYNAMIC_ITEMS)
 
-    async def get_and_remove_lines(self, file_path, num_lines):
-        """Get lines from file but don't remove them until confirmed"""
+    @tasks.loop(seconds=1)
+    async def expire_reservations(self):
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-
-            # Filter out empty lines
-            lines = [line for line in lines if line.strip()]
-            
-            if len(lines) < num_lines:
-                return None, None
+            await self.reservations.tick()
+        except Exception:
+            log.exception("Could not expire reservations", extra={'event': 'reservations.error'})
 
-            # Get the lines we want to send
-            lines_to_send = lines[:num_lines]
-            remaining_lines = lines[num_lines:]
+    @tasks.loop(seconds=30)
+    async def deliver_stock_alerts(self):
+        """Send the queued alerts for the guilds this process holds"""
+        guild_ids = [guild_id for guild_id in self.guild_ids if holds_guild(self.bot, guild_id)]
+        if not guild_ids:
+            return
+        try:
+            async with connect_db(self.bot.db_path) as db:
+                async with db.execute(
+                    f'DELETE FROM stock_alerts WHERE guild_id IN ({",".join("?" * len(guild_ids))}) RETURNING guild_id, message',
+                    guild_ids
+                ) as cursor:
+                    alerts = await cursor.fetchall()
+                await db.commit()
+        except Exception:
+            log.exception("Could not read stock alerts", extra={'event': 'stock_alerts.error'})
+            return
+        for guild_id, message in alerts:
+            await self.notify_admins(guild_id, message)
 
-            return lines_to_send, remaining_lines
-        except:
-            return None, None
+    @deliver_stock_alerts.before_loop
+    async def before_deliver_stock_alerts(self):
+        await self.bot.wait_until_ready()
 
-    async def remove_lines(self, file_path, remaining_lines):
-        """Actually remove the lines from file"""
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.writelines(remaining_lines)
-            return True
-        except:
-            return False
+    def ensure_product_directory(self):
+        if not os.path.exists('products'):
+            os.makedirs('products')
 
     async def notify_stock_empty(self, product_name: str):
         """Send notification to all admins when stock reaches 0"""
-        # Send notifications to admins in all configured guilds
+        notification = f"⚠️ Alert: Stock for '{product_name}' has reached 0!"
+        # Send notifications to admins in all configured guilds, the process holding a guild sends its alerts
+        queued = [guild_id for guild_id in self.guild_ids if not holds_guild(self.bot, guild_id)]
+        if queued:
+            async with connect_db(self.bot.db_path) as db:
+                await db.executemany(
+                    'INSERT INTO stock_alerts (guild_id, message) VALUES (?, ?)',
+                    [(guild_id, notification) for guild_id in queued]
+                )
+                await db.commit()
         for guild_id in self.guild_ids:
-            guild = self.bot.get_guild(guild_id)
-            if not guild:
-                continue
-                
-            admin_role = discord.utils.get(guild.roles, name=ADMIN_ROLE_NAME)
-            if not admin_role:
-                continue
-                
-            # Get all members with admin role
-            admin_members = [member for member in guild.members if admin_role in member.roles]
-            
-            # Send DM to each admin
-            notification = f"⚠️ Alert: Stock for '{product_name}' has reached 0!"
-            for admin in admin_members:
-                try:
-                    await admin.send(notification)
-                except:
-                    pass  # Skip if can't DM
+            if guild_id not in queued:
+                await self.notify_admins(guild_id, notification)
+
+    def alert_stock_empty(self, product_name: str):
+        """Send the stock alert in the background, the buyer's reply doesn't wait on admin lookups and DMs"""
+        async def alert():
+            try:
+                await self.notify_stock_empty(product_name)
+            except Exception:
+                log.exception("Could not send stock alert", extra={'event': 'stock_alerts.error'})
+
+        task = asyncio.create_task(alert())
+        self.alerts.add(task)
+        task.add_done_callback(self.alerts.discard)
+
+    async def notify_admins(self, guild_id, notification):
+        guild = self.bot.get_guild(guild_id)
+        if not guild:
+            return
+
+        # The index holds IDs only, the members don't need to be cached
+        try:
+            admin_ids = await self.bot.get_cog('AdminIndex').admins_for(guild)
+        except discord.HTTPException:
+            log.exception("Could not fetch admins", extra={'event': 'admin_index.error', 'guild_id': guild_id})
+            return
+
+        # Send DM to each admin
+        for admin_id in admin_ids:
+            try:
+                channel = await self.bot.create_dm(discord.Object(id=admin_id))
+                await channel.send(notification)
+            except:
+                pass  # Skip if can't DM
 
     @app_commands.command(name="add_product", description="[Admin] Add a new product")
     @app_commands.checks.has_role(ADMIN_ROLE_NAME)
     async def add_product(self, interaction: discord.Interaction, name: str, price: int, stock: int = 0):
         # Defer the response since we'll be waiting for the file
-        await interaction.response.defer(ephemeral=True)
+        await defer_response(interaction, ephemeral=True)
         
         # Send a follow-up asking for the file
         await interaction.followup.send("Please upload the product file in your next message.", ephemeral=True)
@@ -103,9 +198,10 @@ class ProductManager(commands.Cog):
             await attachment.save(file_path)
             
             # Add to database
-            async with aiosqlite.connect(self.bot.db_path) as db:
+            cursor = None
+            async with connect_db(self.bot.db_path) as db:
                 try:
-                    await db.execute(
+                    cursor = await db.execute(
                         'INSERT INTO products (name, price, file_path, stock) VALUES (?, ?, ?, ?)',
                         (name, price, file_path, stock)
                     )
@@ -115,11 +211,13 @@ class ProductManager(commands.Cog):
                     if 'no column named stock' in str(e):
                         await db.execute('ALTER TABLE products ADD COLUMN stock INTEGER DEFAULT 0')
                         await db.commit()
-                        await db.execute(
+                        cursor = await db.execute(
                             'INSERT INTO products (name, price, file_path, stock) VALUES (?, ?, ?, ?)',
                             (name, price, file_path, stock)
                         )
                         await db.commit()
+            if cursor:
+                self.product_index.add(cursor.lastrowid, name)
             
             await interaction.followup.send(f"Added product {name} for {price} credits with {stock} stock!", ephemeral=True)
             
@@ -135,198 +233,216 @@ class ProductManager(commands.Cog):
     @app_commands.command(name="remove_product", description="[Admin] Remove a product")
     @app_commands.checks.has_role(ADMIN_ROLE_NAME)
     async def remove_product(self, interaction: discord.Interaction):
-        async with aiosqlite.connect(self.bot.db_path) as db:
+        async with connect_db(self.bot.db_path) as db:
             async with db.execute('SELECT id, name FROM products ORDER BY name') as cursor:
                 products = await cursor.fetchall()
 
         if not products:
-            await interaction.response.send_message("No products available to remove!", ephemeral=True)
+            await respond(interaction, "No products available to remove!", ephemeral=True)
             return
 
         # Create selection menu
         options = [discord.SelectOption(label=name, value=str(id)) for id, name in products]
-        
-        view = discord.ui.View()
-        select = discord.ui.Select(placeholder="Choose a product to remove", options=options)
 
-        async def select_callback(interaction: discord.Interaction):
-            product_id = int(select.values[0])
-            
-            async with aiosqlite.connect(self.bot.db_path) as db:
-                # Get product details first
-                async with db.execute('SELECT name, file_path FROM products WHERE id = ?', (product_id,)) as cursor:
-                    result = await cursor.fetchone()
-                    if not result:
-                        await interaction.response.send_message("Product not found!", ephemeral=True)
-                        return
-                    
-                    name, file_path = result
-                    
-                    # Remove from database
-                    await db.execute('DELETE FROM products WHERE id = ?', (product_id,))
-                    await db.commit()
-                    
-                    # Remove associated files
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    
-                    # Remove any stock files
-                    stock_dir = f"products/stock_{product_id}"
-                    if os.path.exists(stock_dir):
-                        shutil.rmtree(stock_dir)
-
-            await interaction.response.send_message(f"Successfully removed product: {name}", ephemeral=True)
+        view = discord.ui.View(timeout=None)
+        view.add_item(RemoveProductSelect(options[:25]))
+        await respond(
+            interaction, "Select a product to remove:" + more_products_hint(len(options)), view=view, ephemeral=True
+        )
 
-        select.callback = select_callback
-        view.add_item(select)
-        await interaction.response.send_message("Select a product to remove:", view=view, ephemeral=True)
+    async def remove_product_selected(self, interaction: discord.Interaction, product_id: int):
+        async with connect_db(self.bot.db_path) as db:
+            # Get product details first
+            async with db.execute('SELECT name, file_path FROM products WHERE id = ?', (product_id,)) as cursor:
+                result = await cursor.fetchone()
+                if not result:
+                    await respond(interaction, "Product not found!", ephemeral=True)
+                    return
+
+                name, file_path = result
+
+                # Remove from database
+                await db.execute('DELETE FROM products WHERE id = ?', (product_id,))
+                await db.commit()
+                self.product_index.remove(product_id)
+
+                # Remove associated files
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+                # Remove any stock files
+                stock_dir = f"products/stock_{product_id}"
+                if os.path.exists(stock_dir):
+                    shutil.rmtree(stock_dir)
+
+        await respond(interaction, f"Successfully removed product: {name}", ephemeral=True)
 
     @app_commands.command(name="stock", description="View available products and their stock")
     async def stock(self, interaction: discord.Interaction):
-        async with aiosqlite.connect(self.bot.db_path) as db:
-            # First, ensure the stock column exists
-            try:
-                await db.execute('ALTER TABLE products ADD COLUMN stock INTEGER DEFAULT 0')
-                await db.commit()
-            except:
-                pass  # Column already exists
-                
-            async with db.execute('SELECT name, price, stock FROM products ORDER BY name') as cursor:
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute('SELECT id, name, price, stock FROM products ORDER BY name') as cursor:
                 products = await cursor.fetchall()
 
         if not products:
-            await interaction.response.send_message("No products available!", ephemeral=True)
+            await respond(interaction, "No products available!", ephemeral=True)
             return
 
-        # Format the product list in the requested format
+        # Format the product list in the requested format, units held in open purchases aren't available
         product_list = []
-        for name, price, stock in products:
+        for product_id, name, price, stock in products:
             stock_count = stock if stock is not None else 0  # Handle NULL values
-            product_list.append(f"{name}:\nStock: {stock_count} | Credits: {price}")
+            held = self.reservations.held_for(product_id)
+            line = f"{name}:\nAvailable: {max(0, stock_count - held)}"
+            if held:
+                line += f" | Reserved: {held}"
+            product_list.append(f"{line} | Credits: {price}")
         
         formatted_list = "\n\n".join(product_list)
-        await interaction.response.send_message(f"Available Products:\n\n{formatted_list}", ephemeral=True)
+        await respond(interaction, f"Available Products:\n\n{formatted_list}", ephemeral=True)
 
     @app_commands.command(name="restock", description="[Admin] Restock a product with a stock file")
     @app_commands.checks.has_role(ADMIN_ROLE_NAME)
-    async def restock(self, interaction: discord.Interaction):
-        async with aiosqlite.connect(self.bot.db_path) as db:
+    async def restock(self, interaction: discord.Interaction, product: str = None):
+        if product:
+            product_id = self.product_index.resolve(product)
+            if product_id is None:
+                await respond(interaction, "Product not found!", ephemeral=True)
+                return
+            # Picked through autocomplete, no menu needed
+            await self.restock_selected(interaction, product_id)
+            return
+
+        async with connect_db(self.bot.db_path) as db:
             async with db.execute('SELECT id, name, stock FROM products ORDER BY name') as cursor:
                 products = await cursor.fetchall()
 
         if not products:
-            await interaction.response.send_message("No products available to restock!", ephemeral=True)
+            await respond(interaction, "No products available to restock!", ephemeral=True)
             return
 
         options = [discord.SelectOption(label=f"{name} (Current Stock: {stock})", value=str(id))
                   for id, name, stock in products]
+
+        view = discord.ui.View(timeout=None)
+        view.add_item(RestockSelect(options[:25]))
+        await respond(
+            interaction, "Select a product to restock:" + more_products_hint(len(options)), view=view, ephemeral=True
+        )
+
+    async def restock_selected(self, interaction: discord.Interaction, product_id: int):
+        await respond(
+            interaction, "Please upload the stock file. Each line in the file will count as 1 stock.",
+            ephemeral=True
+        )
         
-        view = discord.ui.View()
-        select = discord.ui.Select(placeholder="Choose a product to restock", options=options)
+        def check(m):
+            return m.author == interaction.user and len(m.attachments) > 0
+        
+        try:
+            message = await self.bot.wait_for('message', timeout=60.0, check=check)
+            attachment = message.attachments[0]
 
-        async def select_callback(interaction: discord.Interaction):
-            product_id = int(select.values[0])
+            # The write slot is taken once the file is in, not while waiting for it
+            with write_slot(self.bot, 'restock', interaction.user.id) as slot:
+                if not slot:
+                    await interaction.followup.send(
+                        "Too many writes are running right now. Upload the file again in a moment with `/restock`.",
+                        ephemeral=True
+                    )
+                    return
+                stock_count, same_product, other_product = await self.add_stock(product_id, attachment)
+            rejected = same_product + other_product
+            if rejected:
+                log.info("Rejected duplicate stock", extra={
+                    'event': 'stock.duplicates_rejected',
+                    'product_id': product_id,
+                    'same_product': same_product,
+                    'other_product': other_product
+                })
             
-            await interaction.response.send_message(
-                "Please upload the stock file. Each line in the file will count as 1 stock.",
-                ephemeral=True
-            )
+            if stock_count == 0:
+                if rejected:
+                    await interaction.followup.send(
+                        f"Every line was a duplicate, nothing was added! Rejected {rejected} duplicate lines.",
+                        ephemeral=True
+                    )
+                else:
+                    await interaction.followup.send("The file appears to be empty!", ephemeral=True)
+                return
+            
+            # Get updated stock and name
+            async with connect_db(self.bot.db_path) as db:
+                async with db.execute(
+                    'SELECT name, stock FROM products WHERE id = ?',
+                    (product_id,)
+                ) as cursor:
+                    name, new_stock = await cursor.fetchone()
             
-            def check(m):
-                return m.author == interaction.user and len(m.attachments) > 0
+            report = f"Successfully added {stock_count} stock to {name}! New total stock: {new_stock}"
+            if rejected:
+                report += (f"\nRejected {rejected} duplicate lines: {same_product} already stocked for this product "
+                           f"or repeated in the file, {other_product} already stocked for other products.")
+            await interaction.followup.send(report, ephemeral=True)
             
+            # Delete the message with the file
             try:
-                message = await self.bot.wait_for('message', timeout=60.0, check=check)
-                attachment = message.attachments[0]
-                
-                # Save the stock file
-                stock_file = f"products/stock_{product_id}.txt"
-                await attachment.save(stock_file)
-                
-                # Count lines (stock)
-                stock_count = await self.count_lines_in_file(stock_file)
-                
-                if stock_count == 0:
-                    await interaction.followup.send("The file appears to be empty!", ephemeral=True)
-                    os.remove(stock_file)
-                    return
-                
-                # Update database
-                async with aiosqlite.connect(self.bot.db_path) as db:
-                    await db.execute(
-                        'UPDATE products SET stock = stock + ? WHERE id = ?',
-                        (stock_count, product_id)
-                    )
-                    await db.commit()
-                    
-                    # Get updated stock and name
-                    async with db.execute(
-                        'SELECT name, stock FROM products WHERE id = ?',
-                        (product_id,)
-                    ) as cursor:
-                        name, new_stock = await cursor.fetchone()
-                
-                await interaction.followup.send(
-                    f"Successfully added {stock_count} stock to {name}! New total stock: {new_stock}",
-                    ephemeral=True
-                )
+                await message.delete()
+            except:
+                pass
                 
-                # Delete the message with the file
-                try:
-                    await message.delete()
-                except:
-                    pass
-                    
-            except TimeoutError:
-                await interaction.followup.send("Timeout: No file was uploaded.", ephemeral=True)
+        except TimeoutError:
+            await interaction.followup.send("Timeout: No file was uploaded.", ephemeral=True)
 
-        select.callback = select_callback
-        view.add_item(select)
-        await interaction.response.send_message("Select a product to restock:", view=view, ephemeral=True)
+    async def add_stock(self, product_id, attachment):
+        """Add the entries of an uploaded stock file that were never stocked before, returns
+        (entries added, duplicates of this product, duplicates of other products)"""
+        upload_file = f"products/upload_{product_id}.tmp"
+        await attachment.save(upload_file)
+        try:
+            stock_count, same_product, other_product = await self.stock_index.ingest(
+                read_entries(upload_file), product_id, StockStore(product_id).appender()
+            )
+        finally:
+            os.remove(upload_file)
+
+        if stock_count:
+            async with connect_db(self.bot.db_path) as db:
+                await db.execute(
+                    'UPDATE products SET stock = stock + ? WHERE id = ?',
+                    (stock_count, product_id)
+                )
+                await db.commit()
+        return stock_count, same_product, other_product
 
     @app_commands.command(name="purchase", description="Purchase a product")
-    async def purchase(self, interaction: discord.Interaction, quantity: int = 1, discount_code: str = None):
+    async def purchase(self, interaction: discord.Interaction, product: str = None, quantity: int = 1, discount_code: str = None):
         if quantity < 1:
-            await interaction.response.send_message("Quantity must be at least 1!", ephemeral=True)
+            await respond(interaction, "Quantity must be at least 1!", ephemeral=True)
             return
 
-        # Initialize discount variables
-        discount_amount = 0
-        discount_type = None
-        
-        # Check discount code if provided
+        product_id = None
+        if product:
+            product_id = self.product_index.resolve(product)
+            if product_id is None:
+                await respond(interaction, "Product not found!", ephemeral=True)
+                return
+
+        # Check discount code if provided, it travels in the menu's custom_id so it has to fit there
         if discount_code:
-            async with aiosqlite.connect(self.bot.db_path) as db:
-                async with db.execute('''
-                    SELECT discount_amount, discount_type, uses_left
-                    FROM discount_codes
-                    WHERE code = ?
-                    AND expiry_date > CURRENT_TIMESTAMP
-                    AND uses_left > 0
-                ''', (discount_code.upper(),)) as cursor:
-                    discount = await cursor.fetchone()
-                    
-                    if not discount:
-                        await interaction.response.send_message(
-                            "Invalid or expired discount code!",
-                            ephemeral=True
-                        )
-                        return
-                    
-                    discount_amount, discount_type, uses_left = discount
-
-        async with aiosqlite.connect(self.bot.db_path) as db:
-            # Check if user is blacklisted
-            async with db.execute('SELECT is_blacklisted FROM users WHERE user_id = ?', 
-                                (interaction.user.id,)) as cursor:
-                result = await cursor.fetchone()
-                if result and result[0]:
-                    await interaction.response.send_message(
-                        "You are blacklisted from using this bot.",
-                        ephemeral=True
-                    )
-                    return
+            if len(discount_code) > MAX_DISCOUNT_CODE_LENGTH or not self.discounts.get(discount_code.upper()):
+                await respond(
+                    interaction, "Invalid or expired discount code!",
+                    ephemeral=True
+                )
+                return
 
+        if product_id is not None:
+            # Picked through autocomplete, no menu needed
+            await self.purchase_selected(interaction, product_id, quantity, discount_code)
+            return
+
+        # Blacklisted users never get here, the command tree turns them away
+        async with connect_db(self.bot.db_path) as db:
             # Get available products with stock
             async with db.execute(
                 'SELECT id, name, price, stock FROM products ORDER BY name'
@@ -334,326 +450,707 @@ class ProductManager(commands.Cog):
                 products = await cursor.fetchall()
 
         if not products:
-            await interaction.response.send_message(
-                "No products available for purchase!",
+            await respond(
+                interaction, "No products available for purchase!",
                 ephemeral=True
             )
             return
 
-        # Create selection menu for products with stock
+        # Create selection menu for products with enough stock that isn't reserved by someone else
+        available = {
+            id: (stock if stock is not None else 0) - self.reservations.held_for(id)
+            for id, name, price, stock in products
+        }
         options = [
             discord.SelectOption(
                 label=f"{name} ({price} credits)",
-                description=f"Stock: {stock if stock is not None else 0}",
+                description=f"Stock: {available[id]}",
                 value=str(id)
-            ) for id, name, price, stock in products if (stock if stock is not None else 0) >= quantity
+            ) for id, name, price, stock in products if available[id] >= quantity
         ]
 
         if not options:
-            await interaction.response.send_message(
-                "No products have enough stock for your requested quantity!",
+            await respond(
+                interaction, "No products have enough stock for your requested quantity!",
                 ephemeral=True
             )
             return
 
-        view = discord.ui.View()
-        select = discord.ui.Select(
-            placeholder="Choose a product to purchase",
-            options=options
+        view = discord.ui.View(timeout=None)
+        view.add_item(PurchaseSelect(quantity, discount_code, options[:25]))
+        await respond(
+            interaction, "Select a product to purchase:" + more_products_hint(len(options)),
+            view=view,
+            ephemeral=True
         )
 
-        async def select_callback(interaction: discord.Interaction):
-            product_id = int(select.values[0])
-            
-            async with aiosqlite.connect(self.bot.db_path) as db:
-                # Get product details and check stock
+    def order_cost(self, costs, discount_code):
+        """(original cost, discount, final cost, discount per line) of an order with the given line costs,
+        None if the discount code can't be used.
+
+        The discount applies once, to the order total, and is shared over the lines for the records.
+        """
+        original_cost = sum(costs)
+        discount_saved = 0
+        if discount_code:
+            discount = self.discounts.get(discount_code.upper())
+            if not discount:
+                return None
+            discount_amount, discount_type, uses_left = discount
+            if discount_type == 'PERCENT':
+                discount_saved = int(original_cost * (discount_amount / 100))
+            else:  # FIXED
+                discount_saved = discount_amount
+        total_cost = max(0, original_cost - discount_saved)
+        return original_cost, discount_saved, total_cost, split_discount(costs, original_cost - total_cost)
+
+    async def purchase_selected(self, interaction: discord.Interaction, product_id: int, quantity: int, discount_code: str = None):
+        """Reserve the product and ask the user to confirm the purchase"""
+        async with connect_db(self.bot.db_path) as db:
+            # Get product details and check stock
+            async with db.execute(
+                'SELECT name, price, stock FROM products WHERE id = ?',
+                (product_id,)
+            ) as cursor:
+                product = await cursor.fetchone()
+
+            if not product:
+                await respond(
+                    interaction, "Product not found!",
+                    ephemeral=True
+                )
+                return
+
+            name, price, stock = product
+            stock = stock if stock is not None else 0
+            # A reservation of this user's is about to be replaced, it doesn't count against them
+            held = self.reservations.held_for(product_id) - self.reservations.held_by(interaction.user.id, product_id)
+
+            if stock - held < quantity:
+                await respond(
+                    interaction, f"Not enough stock! Available: {max(0, stock - held)}",
+                    ephemeral=True
+                )
+                return
+
+            # Calculate total cost with discount
+            costs = self.order_cost([price * quantity], discount_code)
+            if costs is None:
+                await respond(interaction, "Invalid or expired discount code!", ephemeral=True)
+                return
+            original_cost, discount_saved, total_cost, _ = costs
+
+            # Check user's balance
+            async with db.execute(
+                'SELECT credits FROM users WHERE user_id = ?',
+                (interaction.user.id,)
+            ) as cursor:
+                result = await cursor.fetchone()
+                balance = result[0] if result else 0
+
+        if balance < total_cost:
+            await respond(
+                interaction, f"Insufficient credits! You need {total_cost} credits, but have {balance}.",
+                ephemeral=True
+            )
+            return
+
+        # Hold the units until the reservation expires, so nobody else can buy them meanwhile
+        reservation_id = await self.reservations.reserve(product_id, interaction.user.id, quantity, stock)
+        if reservation_id is None:
+            await respond(
+                interaction, "Not enough stock! Someone else is purchasing the remaining stock.",
+                ephemeral=True
+            )
+            return
+
+        # Create confirmation message with discount info
+        confirm_message = f"Confirm purchase of {quantity}x {name}\n"
+        if discount_saved > 0:
+            confirm_message += f"Original cost: {original_cost} credits\n"
+            confirm_message += f"Discount: {discount_saved} credits\n"
+        confirm_message += f"Final cost: {total_cost} credits\n"
+        confirm_message += f"Your stock is reserved for {RESERVATION_SECONDS} seconds."
+
+        confirm_view = discord.ui.View(timeout=None)
+        confirm_view.add_item(PurchaseConfirm(reservation_id, total_cost, discount_code))
+        await respond(
+            interaction, confirm_message,
+            view=confirm_view,
+            ephemeral=True
+        )
+
+    async def confirm_purchase(self, interaction: discord.Interaction, button: PurchaseConfirm):
+        """Charge the user and deliver a reserved purchase"""
+        # The button runs outside the command, so it takes its own slot under the write ceiling
+        with write_slot(self.bot, 'purchase', interaction.user.id) as slot:
+            if not slot:
+                await self.turn_away_busy(interaction)
+                return
+            # The reservation is made once per confirm message, so its ID doubles as the nonce
+            await self.checkout(
+                interaction, button.reservation_id, [button.reservation_id], button.discount_code, button.total_cost,
+                button.item, button.view, 'purchase'
+            )
+
+    async def confirm_cart(self, interaction: discord.Interaction, button: CartConfirm):
+        """Charge the user and deliver a reserved cart checkout"""
+        with write_slot(self.bot, 'cart checkout', interaction.user.id) as slot:
+            if not slot:
+                await self.turn_away_busy(interaction)
+                return
+            if await self.checkout(
+                interaction, button.nonce, self.reservations.order(button.nonce), button.discount_code, button.total_cost,
+                button.item, button.view, 'cart checkout'
+            ):
+                self.carts.pop(interaction.user.id, None)
+
+    async def turn_away_busy(self, interaction: discord.Interaction):
+        await respond(
+            interaction, "Too many purchases are being processed right now. Try again in a moment, "
+            "your stock stays reserved.",
+            ephemeral=True
+        )
+
+    async def deliver_order(self, user, order_id, lines, purchase_ids, taken):
+        """DM the taken entries of an order, large orders as attachments"""
+        if sum(quantity for _, _, _, quantity in lines) > 10:  # Threshold for sending as file
+            if len(lines) == 1:
+                product_id, name, _, quantity = lines[0]
+                # Streamed from the taken entries, large orders are compressed and split
+                await send_order(user, order_id, name, quantity, taken[product_id])
+            else:
+                order = CombinedOrder([
+                    (f"\nProduct: {name} (Quantity: {quantity}) - {purchase_id}\n", taken[product_id])
+                    for purchase_id, (product_id, name, _, quantity) in zip(purchase_ids, lines)
+                ])
+                await send_attachments(user, order_id, f"Purchase ID: {order_id}\n", order)
+            return
+
+        # For smaller quantities, send as regular message
+        stock_message = f"Purchase ID: {order_id}\n"
+        if len(lines) == 1:
+            product_id, name, _, quantity = lines[0]
+            stock_message += f"Product: {name} (Quantity: {quantity})\n\n"
+            stock_message += "```\n" + "".join(taken[product_id].lines()) + "```"
+        else:
+            for purchase_id, (product_id, name, _, quantity) in zip(purchase_ids, lines):
+                stock_message += f"\nProduct: {name} (Quantity: {quantity}) - {purchase_id}\n"
+                stock_message += "```\n" + "".join(taken[product_id].lines()) + "```"
+        stock_message += "\nKeep this Purchase ID for reference if you need support!"
+        await user.send(stock_message)
+
+    async def checkout(self, interaction: discord.Interaction, nonce, reservation_ids, discount_code, agreed_total,
+                       confirm_button, confirm_view, command):
+        """Charge the user for reserved products and deliver them, True once the order went through.
+
+        Purchases and cart checkouts both end here. A purchase is an order of one
+        line recorded under the order's ID, the lines of a cart are recorded under
+        the order's ID with a -<line> suffix each.
+        """
+        reservations = self.reservations
+        confirmations = self.confirmations
+        user = interaction.user
+
+        # A double click or a retried interaction only gets the first confirmation's answer
+        if not confirmations.begin(nonce):
+            await respond(
+                interaction, confirmations.result(nonce) or "Your purchase is already being processed.",
+                ephemeral=True
+            )
+            return False
+
+        started_at = time.perf_counter()
+        taken = {}
+        held = False
+        order_id = None
+        try:
+            # Defer the response since we'll be doing file operations
+            await defer_response(interaction, ephemeral=True)
+
+            # Disable the button
+            confirm_button.disabled = True
+            try:
+                await interaction.message.edit(view=confirm_view)
+            except:
+                pass
+
+            # What is being bought comes from the reservations, which are kept across restarts
+            order = [reservations.get(reservation_id) for reservation_id in reservation_ids]
+            if not order or any(entry is None or entry[1] != user.id for entry in order):
+                purchase_id = await confirmations.find(nonce)
+                if purchase_id:
+                    await interaction.followup.send(
+                        f"This purchase was already completed. Purchase ID: `{purchase_id}`",
+                        ephemeral=True
+                    )
+                else:
+                    await interaction.followup.send(
+                        "Your reservation has expired. Please start the purchase again.",
+                        ephemeral=True
+                    )
+                return False
+            held = True
+
+            # Keep the holds for as long as the purchase runs, unless they already ran out
+            if not all([reservations.claim(reservation_id) for reservation_id in reservation_ids]):
+                await interaction.followup.send(
+                    "Your reservation has expired. Please start the purchase again.",
+                    ephemeral=True
+                )
+                return False
+
+            async with connect_db(self.bot.db_path) as db:
                 async with db.execute(
-                    'SELECT name, price, stock FROM products WHERE id = ?',
-                    (product_id,)
+                    f"SELECT id, name, price FROM products WHERE id IN ({','.join('?' * len(order))})",
+                    tuple(product_id for product_id, _, _ in order)
                 ) as cursor:
-                    product = await cursor.fetchone()
-                    
-                    if not product:
-                        await interaction.response.send_message(
-                            "Product not found!",
+                    products = {id: (name, price) for id, name, price in await cursor.fetchall()}
+            if any(product_id not in products for product_id, _, _ in order):
+                await interaction.followup.send("Product not found!", ephemeral=True)
+                return False
+            lines = [(product_id, *products[product_id], quantity) for product_id, _, quantity in order]
+
+            # Charge what the user agreed to, or nothing
+            line_costs = [price * quantity for _, _, price, quantity in lines]
+            costs = self.order_cost(line_costs, discount_code)
+            if costs is None:
+                await interaction.followup.send(
+                    "This discount code is no longer valid. No credits were charged.",
+                    ephemeral=True
+                )
+                return False
+            original_cost, discount_saved, total_cost, line_discounts = costs
+            if total_cost != agreed_total:
+                await interaction.followup.send(
+                    "The price changed since you selected the product. No credits were charged, please start the purchase again.",
+                    ephemeral=True
+                )
+                return False
+
+            # Take the entries from the stock stores but don't remove them yet.
+            # In product order, so two orders sharing products can't each hold a lock the other waits for
+            for product_id, _, _, quantity in sorted(lines, key=lambda line: line[0]):
+                taken[product_id] = await StockStore(product_id).take(quantity)
+                if not taken[product_id]:
+                    await interaction.followup.send(
+                        "Error: Could not retrieve stock. Please contact an administrator.",
+                        ephemeral=True
+                    )
+                    return False
+
+            order_id = await self.generate_purchase_id()
+            purchase_ids = [order_id] if len(lines) == 1 else [f"{order_id}-{n}" for n in range(1, len(lines) + 1)]
+            ledger = self.bot.ledger
+            sales = self.bot.sales
+
+            # Process the transaction FIRST
+            async with connect_db(self.bot.db_path) as db:
+                committed = False
+                # Products whose stock store already gave up the delivered entries
+                stores_committed = set()
+                # The rollup day each line went into, an undo comes off the same days
+                sale_days = []
+
+                async def undo_order():
+                    """Compensate a committed order that could not be delivered"""
+                    # Entries already removed from a store go back to its front, to be sold next
+                    for product_id in sorted(stores_committed):
+                        try:
+                            await taken[product_id].restore()
+                            stores_committed.discard(product_id)
+                        except OSError:
+                            log.exception("Could not put stock back", extra={
+                                'event': 'purchase.restore_failed', 'purchase_id': order_id, 'product_id': product_id
+                            })
+                    await ledger.move(db, user.id, total_cost, 'purchase_rollback', order_id, ACCOUNT_SALES)
+                    await db.executemany(
+                        'UPDATE products SET stock = stock + ? WHERE id = ?',
+                        [(quantity, product_id) for product_id, _, _, quantity in lines
+                         if product_id not in stores_committed]
+                    )
+                    released = None
+                    if discount_code:
+                        released = await self.discounts.release(db, discount_code.upper())
+                    for (product_id, _, _, quantity), cost, line_discount, sale_day in zip(lines, line_costs, line_discounts, sale_days):
+                        await sales.record(db, product_id, -quantity, -cost, -line_discount, line_discount - cost, sale_day)
+                    await db.executemany('DELETE FROM transactions WHERE purchase_id = ?', [(pid,) for pid in purchase_ids])
+                    await db.execute('DELETE FROM purchase_nonces WHERE nonce = ?', (nonce,))
+                    await db.commit()
+                    if released:
+                        self.discounts.apply(discount_code.upper(), released)
+
+                try:
+                    # The nonce's primary key stops a second commit of the same confirmation
+                    if not await confirmations.record(db, nonce, order_id):
+                        await db.rollback()
+                        await interaction.followup.send(
+                            f"This purchase was already completed. Purchase ID: `{await confirmations.find(nonce)}`",
                             ephemeral=True
                         )
-                        return
-                    
-                    name, price, stock = product
-                    stock = stock if stock is not None else 0
-                    
-                    if stock < quantity:
-                        await interaction.response.send_message(
-                            f"Not enough stock! Available: {stock}",
+                        return False
+
+                    # One debit and one commit for the whole order
+                    await ledger.move(db, user.id, -total_cost, 'purchase', order_id, ACCOUNT_SALES)
+                    # Conditional, so the count can't go below zero when several processes sell the same product
+                    cursor = await db.executemany(
+                        'UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?',
+                        [(quantity, product_id, quantity) for product_id, _, _, quantity in lines]
+                    )
+                    if cursor.rowcount != len(lines):
+                        await db.rollback()
+                        await interaction.followup.send(
+                            "Not enough stock! Someone else bought the remaining stock. No credits were charged.",
                             ephemeral=True
                         )
-                        return
+                        return False
 
-                    # Calculate total cost with discount
-                    total_cost = price * quantity
-                    original_cost = total_cost
-                    discount_saved = 0
+                    # Update discount code usage if used, the code may have run out since selection
+                    discount_row = None
+                    if discount_code:
+                        discount_row = await self.discounts.consume(db, discount_code.upper())
+                        if discount_row is None:
+                            await db.rollback()
+                            await interaction.followup.send(
+                                "This discount code is no longer valid. No credits were charged.",
+                                ephemeral=True
+                            )
+                            return False
 
-                    if discount_amount and discount_type:
-                        if discount_type == 'PERCENT':
-                            discount_saved = int(total_cost * (discount_amount / 100))
-                        else:  # FIXED
-                            discount_saved = discount_amount
-                        total_cost = max(0, total_cost - discount_saved)
+                    # Add transactions with discount info
+                    await db.executemany('''
+                        INSERT INTO transactions
+                        (purchase_id, user_id, product_id, amount, original_cost, discount_amount, discount_code)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', [
+                        (purchase_id, user.id, product_id, quantity, cost, line_discount, discount_code)
+                        for purchase_id, (product_id, _, _, quantity), cost, line_discount
+                        in zip(purchase_ids, lines, line_costs, line_discounts)
+                    ])
+                    for (product_id, _, _, quantity), cost, line_discount in zip(lines, line_costs, line_discounts):
+                        sale_days.append(await sales.record(db, product_id, quantity, cost, line_discount, cost - line_discount))
+                    # The units are now counted out of stock, the holds go in the same commit
+                    for reservation_id in reservation_ids:
+                        await reservations.release(reservation_id, db)
 
-                    # Check user's balance
-                    async with db.execute(
-                        'SELECT credits FROM users WHERE user_id = ?',
-                        (interaction.user.id,)
-                    ) as cursor:
-                        result = await cursor.fetchone()
-                        balance = result[0] if result else 0
+                    await db.commit()
+                    committed = True
+                    if discount_row:
+                        self.discounts.apply(discount_code.upper(), discount_row)
+
+                    # Remove the entries from the stock stores before the DM, which lets the next sale of
+                    # each product in without waiting for the delivery
+                    try:
+                        for product_id, entries in taken.items():
+                            entries.commit()
+                            stores_committed.add(product_id)
+                    except (OSError, StockConflict):
+                        # If removing entries fails, rollback everything
+                        await undo_order()
+
+                        await interaction.followup.send(
+                            "Error: Could not process purchase. Please try again.",
+                            ephemeral=True
+                        )
+                        return False
+
+                    # Only after successful transaction, send the DM
+                    try:
+                        await self.deliver_order(user, order_id, lines, purchase_ids, taken)
+                    except Exception as e:
+                        # If DM fails, rollback the transaction and put the entries back
+                        log.warning("Could not DM purchase, rolling back", extra={
+                            'event': 'purchase.dm_failed',
+                            'user_id': user.id,
+                            'purchase_id': order_id,
+                            'error': str(e)
+                        })
+                        await undo_order()
 
-                    if balance < total_cost:
-                        await interaction.response.send_message(
-                            f"Insufficient credits! You need {total_cost} credits, but have {balance}.",
+                        await interaction.followup.send(
+                            "Error: Could not send DM. Please make sure your DMs are open and try again.",
                             ephemeral=True
                         )
-                        return
+                        return False
 
-                    # Create confirmation message with discount info
-                    confirm_message = f"Confirm purchase of {quantity}x {name}\n"
+                    # Create success message with discount info
+                    if len(lines) == 1:
+                        success_message = f"Purchase successful! {lines[0][3]}x {lines[0][1]}"
+                    else:
+                        success_message = f"Purchase successful! {len(lines)} products"
                     if discount_saved > 0:
-                        confirm_message += f"Original cost: {original_cost} credits\n"
-                        confirm_message += f"Discount: {discount_saved} credits\n"
-                    confirm_message += f"Final cost: {total_cost} credits"
-
-                    # Create confirmation button
-                    confirm_view = discord.ui.View(timeout=30)  # 30 second timeout
-                    
-                    class ConfirmButton(discord.ui.Button):
-                        def __init__(self):
-                            super().__init__(
-                                label="Confirm Purchase",
-                                style=discord.ButtonStyle.green
-                            )
-                        
-                        async def callback(self, interaction: discord.Interaction):
-                            try:
-                                # Defer the response since we'll be doing file operations
-                                await interaction.response.defer(ephemeral=True)
-                                
-                                # Disable the button
-                                self.disabled = True
-                                try:
-                                    await interaction.message.edit(view=self.view)
-                                except:
-                                    pass
-                                
-                                stock_file = f"products/stock_{product_id}.txt"
-                                
-                                # Get the lines from stock file but don't remove them yet
-                                lines_to_send, remaining_lines = await self.view.cog.get_and_remove_lines(stock_file, quantity)
-                                
-                                if not lines_to_send:
-                                    await interaction.followup.send(
-                                        "Error: Could not retrieve stock. Please contact an administrator.",
-                                        ephemeral=True
-                                    )
-                                    return
-                                
-                                # Generate purchase ID
-                                purchase_id = await self.view.cog.generate_purchase_id()
-                                
-                                # Process the transaction FIRST
-                                async with aiosqlite.connect(self.view.cog.bot.db_path) as db:
-                                    try:
-                                        # Process purchase
-                                        await db.execute(
-                                            'UPDATE users SET credits = credits - ? WHERE user_id = ?',
-                                            (total_cost, interaction.user.id)
-                                        )
-                                        await db.execute(
-                                            'UPDATE products SET stock = stock - ? WHERE id = ?',
-                                            (quantity, product_id)
-                                        )
-                                        
-                                        # Update discount code usage if used
-                                        if discount_code:
-                                            await db.execute('''
-                                                UPDATE discount_codes 
-                                                SET uses_left = uses_left - 1 
-                                                WHERE code = ? AND uses_left > 0
-                                            ''', (discount_code.upper(),))
-                                        
-                                        # Add transaction with discount info
-                                        await db.execute('''
-                                            INSERT INTO transactions 
-                                            (purchase_id, user_id, product_id, amount, original_cost, discount_amount, discount_code) 
-                                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                                        ''', (purchase_id, interaction.user.id, product_id, quantity, original_cost, discount_saved, discount_code))
-                                        
-                                        await db.commit()
-                                        
-                                        # Only after successful transaction, send the DM
-                                        if quantity > 10:  # Threshold for sending as file
-                                            stock_content = f"Purchase ID: {purchase_id}\n"
-                                            stock_content += f"Product: {name} (Quantity: {quantity})\n\n"
-                                            stock_content += "".join(lines_to_send)
-                                            
-                                            file = discord.File(
-                                                io.StringIO(stock_content),
-                                                filename=f"purchase_{purchase_id}.txt"
-                                            )
-                                            
-                                            try:
-                                                await interaction.user.send(
-                                                    "Your purchase details are in the attached file:",
-                                                    file=file
-                                                )
-                                            except Exception as e:
-                                                # If DM fails, rollback the transaction
-                                                await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?',
-                                                    (total_cost, interaction.user.id))
-                                                await db.execute('UPDATE products SET stock = stock + ? WHERE id = ?',
-                                                    (quantity, product_id))
-                                                if discount_code:
-                                                    await db.execute('UPDATE discount_codes SET uses_left = uses_left + 1 WHERE code = ?',
-                                                        (discount_code.upper(),))
-                                                await db.execute('DELETE FROM transactions WHERE purchase_id = ?', (purchase_id,))
-                                                await db.commit()
-                                                
-                                                await interaction.followup.send(
-                                                    "Error: Could not send DM. Please make sure your DMs are open and try again.",
-                                                    ephemeral=True
-                                                )
-                                                return
-                                        else:
-                                            # For smaller quantities, send as regular message
-                                            stock_message = f"Purchase ID: {purchase_id}\n"
-                                            stock_message += f"Product: {name} (Quantity: {quantity})\n\n"
-                                            stock_message += "```\n" + "".join(lines_to_send) + "```"
-                                            stock_message += "\nKeep this Purchase ID for reference if you need support!"
-                                            
-                                            try:
-                                                await interaction.user.send(stock_message)
-                                            except Exception as e:
-                                                # If DM fails, rollback the transaction
-                                                await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?',
-                                                    (total_cost, interaction.user.id))
-                                                await db.execute('UPDATE products SET stock = stock + ? WHERE id = ?',
-                                                    (quantity, product_id))
-                                                if discount_code:
-                                                    await db.execute('UPDATE discount_codes SET uses_left = uses_left + 1 WHERE code = ?',
-                                                        (discount_code.upper(),))
-                                                await db.execute('DELETE FROM transactions WHERE purchase_id = ?', (purchase_id,))
-                                                await db.commit()
-                                                
-                                                await interaction.followup.send(
-                                                    "Error: Could not send DM. Please make sure your DMs are open and try again.",
-                                                    ephemeral=True
-                                                )
-                                                return
-                                        
-                                        # Only remove the lines from stock file after successful DM
-                                        if not await self.view.cog.remove_lines(stock_file, remaining_lines):
-                                            # If removing lines fails, rollback everything
-                                            await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?',
-                                                (total_cost, interaction.user.id))
-                                            await db.execute('UPDATE products SET stock = stock + ? WHERE id = ?',
-                                                (quantity, product_id))
-                                            if discount_code:
-                                                await db.execute('UPDATE discount_codes SET uses_left = uses_left + 1 WHERE code = ?',
-                                                    (discount_code.upper(),))
-                                            await db.execute('DELETE FROM transactions WHERE purchase_id = ?', (purchase_id,))
-                                            await db.commit()
-                                            
-                                            await interaction.followup.send(
-                                                "Error: Could not process purchase. Please try again.",
-                                                ephemeral=True
-                                            )
-                                            return
-                                        
-                                        # Check if stock is now 0
-                                        async with db.execute('SELECT stock FROM products WHERE id = ?', (product_id,)) as cursor:
-                                            new_stock = (await cursor.fetchone())[0]
-                                            if new_stock == 0:
-                                                await self.view.cog.notify_stock_empty(name)
-                                        
-                                        # Create success message with discount info
-                                        success_message = f"Purchase successful! {quantity}x {name}"
-                                        if discount_saved > 0:
-                                            success_message += f"\nOriginal cost: {original_cost} credits"
-                                            success_message += f"\nDiscount applied: {discount_saved} credits"
-                                        success_message += f"\nFinal cost: {total_cost} credits"
-                                        success_message += f"\nPurchase ID: `{purchase_id}`"
-                                        success_message += "\nStock has been sent to your DMs!"
-                                        
-                                        await interaction.followup.send(
-                                            success_message,
-                                            ephemeral=True
-                                        )
-                                    except Exception as e:
-                                        print(f"Transaction error: {str(e)}")
-                                        # Rollback everything if any error occurs
-                                        await db.execute('UPDATE users SET credits = credits + ? WHERE user_id = ?',
-                                            (total_cost, interaction.user.id))
-                                        await db.execute('UPDATE products SET stock = stock + ? WHERE id = ?',
-                                            (quantity, product_id))
-                                        if discount_code:
-                                            await db.execute('UPDATE discount_codes SET uses_left = uses_left + 1 WHERE code = ?',
-                                                (discount_code.upper(),))
-                                        await db.execute('DELETE FROM transactions WHERE purchase_id = ?', (purchase_id,))
-                                        await db.commit()
-                                        
-                                        await interaction.followup.send(
-                                            "Error: Could not process purchase. Please try again.",
-                                            ephemeral=True
-                                        )
-                                        return
-                            except Exception as e:
-                                print(f"Error in purchase confirmation: {str(e)}")
-                                await interaction.followup.send(
-                                    "An error occurred during purchase confirmation. Please try again.",
-                                    ephemeral=True
-                                )
-                                return
-                    
-                    # Add the button to the view
-                    confirm_button = ConfirmButton()
-                    confirm_view.add_item(confirm_button)
-                    confirm_view.cog = self  # Store reference to cog for access in button callback
-                    
-                    # Add timeout handler
-                    async def on_timeout():
-                        for item in confirm_view.children:
-                            item.disabled = True
-                        try:
-                            await interaction.edit_original_message(view=confirm_view)
-                        except:
-                            pass
-                    
-                    confirm_view.on_timeout = on_timeout
-                    
-                    await interaction.response.send_message(
-                        confirm_message,
-                        view=confirm_view,
+                        success_message += f"\nOriginal cost: {original_cost} credits"
+                        success_message += f"\nDiscount applied: {discount_saved} credits"
+                    success_message += f"\nFinal cost: {total_cost} credits"
+                    success_message += f"\nPurchase ID: `{order_id}`"
+                    success_message += "\nStock has been sent to your DMs!"
+                    confirmations.finish(nonce, success_message)
+
+                    await interaction.followup.send(
+                        success_message,
                         ephemeral=True
                     )
 
+                    # Check if stock is now 0, the admins are told after the buyer got their answer
+                    async with db.execute(
+                        f"SELECT name FROM products WHERE stock = 0 AND id IN ({','.join('?' * len(lines))})",
+                        tuple(product_id for product_id, _, _, _ in lines)
+                    ) as cursor:
+                        for (name,) in await cursor.fetchall():
+                            self.alert_stock_empty(name)
+
+                    log.info("Purchase completed", extra={
+                        'event': 'purchase.completed',
+                        'command': command,
+                        'user_id': user.id,
+                        'purchase_id': order_id,
+                        'product_ids': [product_id for product_id, _, _, _ in lines],
+                        'quantity': sum(quantity for _, _, _, quantity in lines),
+                        'total_cost': total_cost,
+                        'discount_code': discount_code,
+                        'duration_ms': round((time.perf_counter() - started_at) * 1000, 2)
+                    })
+                    return True
+                except Exception:
+                    log.exception("Transaction error", extra={
+                        'event': 'purchase.rollback',
+                        'command': command,
+                        'user_id': user.id,
+                        'purchase_id': order_id
+                    })
+                    # Rollback everything if any error occurs
+                    if committed:
+                        await undo_order()
+                    else:
+                        await db.rollback()
+
+                    await interaction.followup.send(
+                        "Error: Could not process purchase. Please try again.",
+                        ephemeral=True
+                    )
+                    return False
+        except Exception:
+            log.exception("Error in purchase confirmation", extra={
+                'event': 'purchase.error',
+                'command': command,
+                'user_id': user.id,
+                'purchase_id': order_id,
+                'duration_ms': round((time.perf_counter() - started_at) * 1000, 2)
+            })
+            await interaction.followup.send(
+                "An error occurred during purchase confirmation. Please try again.",
+                ephemeral=True
+            )
+            return False
+        finally:
+            # Drops the sold entries and any head blocks that were never swapped in
+            for entries in taken.values():
+                if entries:
+                    entries.close()
+            # An order that didn't go through gives its reserved units back
+            if held:
+                for reservation_id in reservation_ids:
+                    await reservations.release(reservation_id)
+            # and may be confirmed again
+            if confirmations.result(nonce) is None:
+                confirmations.forget(nonce)
+
+    @cart.command(name="add", description="Add a product to your cart")
+    async def cart_add(self, interaction: discord.Interaction, quantity: int = 1):
+        if quantity < 1:
+            await respond(interaction, "Quantity must be at least 1!", ephemeral=True)
+            return
+
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute('SELECT id, name, price, stock FROM products ORDER BY name') as cursor:
+                products = await cursor.fetchall()
+
+        cart = self.carts.get(interaction.user.id, {})
+        available = {
+            id: (stock if stock is not None else 0) - self.reservations.held_for(id)
+            for id, name, price, stock in products
+        }
+        options = [
+            discord.SelectOption(
+                label=f"{name} ({price} credits)",
+                description=f"Stock: {available[id]}" + (f" | In cart: {cart[id]}" if id in cart else ""),
+                value=str(id)
+            ) for id, name, price, stock in products if available[id] >= cart.get(id, 0) + quantity
+        ]
+
+        if not options:
+            await respond(
+                interaction, "No products have enough stock for your requested quantity!",
+                ephemeral=True
+            )
+            return
+
+        view = discord.ui.View()
+        select = discord.ui.Select(placeholder="Choose a product to add to your cart", options=options[:25])
+
+        async def select_callback(interaction: discord.Interaction):
+            product_id = int(select.values[0])
+            cart = self.carts.setdefault(interaction.user.id, {})
+            if product_id not in cart and len(cart) >= MAX_CART_PRODUCTS:
+                await respond(
+                    interaction, f"Your cart can hold at most {MAX_CART_PRODUCTS} different products!",
+                    ephemeral=True
+                )
+                return
+
+            cart[product_id] = cart.get(product_id, 0) + quantity
+            name = next(name for id, name, price, stock in products if id == product_id)
+            await respond(
+                interaction, f"Added {quantity}x {name} to your cart. Your cart now holds {len(cart)} products, "
+                f"check out with `/cart checkout`.",
+                ephemeral=True
+            )
+
         select.callback = select_callback
         view.add_item(select)
-        await interaction.response.send_message(
-            "Select a product to purchase:",
-            view=view,
+        await respond(interaction, "Select a product to add to your cart:", view=view, ephemeral=True)
+
+    async def cart_lines(self, user_id):
+        """The user's cart as (product_id, name, price, quantity, stock), dropping products that were removed"""
+        cart = self.carts.get(user_id)
+        if not cart:
+            return []
+
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute(
+                f"SELECT id, name, price, stock FROM products WHERE id IN ({','.join('?' * len(cart))})",
+                tuple(cart)
+            ) as cursor:
+                products = {id: (name, price, stock if stock is not None else 0)
+                            for id, name, price, stock in await cursor.fetchall()}
+
+        for product_id in [product_id for product_id in cart if product_id not in products]:
+            del cart[product_id]
+        return [(product_id, products[product_id][0], products[product_id][1], quantity, products[product_id][2])
+                for product_id, quantity in cart.items()]
+
+    @cart.command(name="view", description="Show the products in your cart")
+    async def cart_view(self, interaction: discord.Interaction):
+        lines = await self.cart_lines(interaction.user.id)
+        if not lines:
+            await respond(interaction, "Your cart is empty! Add products with `/cart add`.", ephemeral=True)
+            return
+
+        cart_list = [f"{quantity}x {name}: {price * quantity} credits" for _, name, price, quantity, _ in lines]
+        total = sum(price * quantity for _, _, price, quantity, _ in lines)
+        await respond(
+            interaction, "Your cart:\n\n" + "\n".join(cart_list) + f"\n\nTotal: {total} credits",
             ephemeral=True
         )
 
+    @cart.command(name="remove", description="Remove a product from your cart")
+    async def cart_remove(self, interaction: discord.Interaction):
+        lines = await self.cart_lines(interaction.user.id)
+        if not lines:
+            await respond(interaction, "Your cart is empty!", ephemeral=True)
+            return
+
+        options = [discord.SelectOption(label=f"{quantity}x {name}", value=str(product_id))
+                   for product_id, name, _, quantity, _ in lines]
+        view = discord.ui.View()
+        select = discord.ui.Select(placeholder="Choose a product to remove from your cart", options=options)
+
+        async def select_callback(interaction: discord.Interaction):
+            self.carts.get(interaction.user.id, {}).pop(int(select.values[0]), None)
+            await respond(interaction, "Removed the product from your cart.", ephemeral=True)
+
+        select.callback = select_callback
+        view.add_item(select)
+        await respond(interaction, "Select a product to remove:", view=view, ephemeral=True)
+
+    @cart.command(name="clear", description="Empty your cart")
+    async def cart_clear(self, interaction: discord.Interaction):
+        self.carts.pop(interaction.user.id, None)
+        await respond(interaction, "Your cart has been emptied.", ephemeral=True)
+
+    @cart.command(name="checkout", description="Purchase everything in your cart at once")
+    async def cart_checkout(self, interaction: discord.Interaction, discount_code: str = None):
+        # The discount code travels in the confirm button's custom_id so it has to fit there
+        if discount_code:
+            if len(discount_code) > MAX_DISCOUNT_CODE_LENGTH or not self.discounts.get(discount_code.upper()):
+                await respond(interaction, "Invalid or expired discount code!", ephemeral=True)
+                return
+
+        lines = await self.cart_lines(interaction.user.id)
+        if not lines:
+            await respond(interaction, "Your cart is empty! Add products with `/cart add`.", ephemeral=True)
+            return
+
+        reservations = self.reservations
+        short = [name for product_id, name, _, quantity, stock in lines
+                 if stock - reservations.held_for(product_id) + reservations.held_by(interaction.user.id, product_id) < quantity]
+        if short:
+            await respond(
+                interaction, f"Not enough stock for: {', '.join(short)}. Remove them from your cart or lower the quantity.",
+                ephemeral=True
+            )
+            return
+
+        costs = self.order_cost([price * quantity for _, _, price, quantity, _ in lines], discount_code)
+        if costs is None:
+            await respond(interaction, "Invalid or expired discount code!", ephemeral=True)
+            return
+        original_cost, discount_saved, total_cost, _ = costs
+
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute('SELECT credits FROM users WHERE user_id = ?', (interaction.user.id,)) as cursor:
+                result = await cursor.fetchone()
+                balance = result[0] if result else 0
+
+        if balance < total_cost:
+            await respond(
+                interaction, f"Insufficient credits! You need {total_cost} credits, but have {balance}.",
+                ephemeral=True
+            )
+            return
+
+        # Every product is held at once or none is, the confirm button finds the holds by the nonce
+        nonce = self.confirmations.new()
+        reservation_ids = await reservations.reserve_many(
+            interaction.user.id, [(product_id, quantity, stock) for product_id, _, _, quantity, stock in lines], nonce
+        )
+        if reservation_ids is None:
+            await respond(
+                interaction, "Not enough stock! Someone else is purchasing the remaining stock.",
+                ephemeral=True
+            )
+            return
+
+        confirm_message = "Confirm purchase of:\n"
+        confirm_message += "\n".join(f"{quantity}x {name}" for _, name, _, quantity, _ in lines) + "\n"
+        if discount_saved > 0:
+            confirm_message += f"Original cost: {original_cost} credits\n"
+            confirm_message += f"Discount: {discount_saved} credits\n"
+        confirm_message += f"Final cost: {total_cost} credits\n"
+        confirm_message += f"Your stock is reserved for {RESERVATION_SECONDS} seconds."
+
+        confirm_view = discord.ui.View(timeout=None)
+        confirm_view.add_item(CartConfirm(nonce, total_cost, discount_code))
+        await respond(interaction, confirm_message, view=confirm_view, ephemeral=True)
+
     @app_commands.command(name="manage_stock", description="[Admin] View and manage product stock")
     @app_commands.checks.has_role(ADMIN_ROLE_NAME)
-    async def manage_stock(self, interaction: discord.Interaction):
-        async with aiosqlite.connect(self.bot.db_path) as db:
+    async def manage_stock(self, interaction: discord.Interaction, product: str = None):
+        if product:
+            product_id = self.product_index.resolve(product)
+            if product_id is None:
+                await respond(interaction, "Product not found!", ephemeral=True)
+                return
+            # Picked through autocomplete, no menu needed
+            await self.show_stock_page(interaction, product_id, 0)
+            return
+
+        async with connect_db(self.bot.db_path) as db:
             async with db.execute('SELECT id, name, stock FROM products ORDER BY name') as cursor:
                 products = await cursor.fetchall()
 
         if not products:
-            await interaction.response.send_message("No products available!", ephemeral=True)
+            await respond(interaction, "No products available!", ephemeral=True)
             return
 
         # Create selection menu
@@ -663,106 +1160,69 @@ class ProductManager(commands.Cog):
                 value=str(id)
             ) for id, name, stock in products
         ]
-        
-        view = discord.ui.View()
-        select = discord.ui.Select(placeholder="Choose a product to manage stock", options=options)
 
-        async def select_callback(interaction: discord.Interaction):
-            product_id = int(select.values[0])
-            stock_file = f"products/stock_{product_id}.txt"
-            
-            if not os.path.exists(stock_file):
-                await interaction.response.send_message("No stock file found for this product!", ephemeral=True)
-                return
-            
-            # Read all stock entries
-            with open(stock_file, 'r', encoding='utf-8') as f:
-                stock_lines = [line.strip() for line in f.readlines() if line.strip()]
-            
-            total_stock = len(stock_lines)
-            if total_stock == 0:
-                await interaction.response.send_message("No stock entries found!", ephemeral=True)
-                return
-            
-            # Create pages of stock (10 entries per page)
-            page_size = 10
-            total_pages = math.ceil(total_stock / page_size)
-            current_page = 0
-            
-            async def update_stock_message(page_num):
-                start_idx = page_num * page_size
-                end_idx = min(start_idx + page_size, total_stock)
-                current_entries = stock_lines[start_idx:end_idx]
-                
-                # Format the stock entries with numbers
-                formatted_entries = []
-                for i, entry in enumerate(current_entries, start=start_idx + 1):
-                    formatted_entries.append(f"{i}. {entry}")
-                
-                content = f"Stock entries (Page {page_num + 1}/{total_pages}):\n```\n"
-                content += "\n".join(formatted_entries)
-                content += "\n```\n\nTo remove specific entries, use `/remove_stock [product] [entry_numbers]`"
-                return content
-            
-            # Create navigation buttons
-            nav_view = discord.ui.View()
-            
-            prev_button = discord.ui.Button(
-                label="Previous",
-                style=discord.ButtonStyle.gray,
-                disabled=True
-            )
-            next_button = discord.ui.Button(
-                label="Next",
-                style=discord.ButtonStyle.gray,
-                disabled=total_pages <= 1
-            )
-            
-            async def prev_callback(interaction: discord.Interaction):
-                nonlocal current_page
-                current_page = max(0, current_page - 1)
-                prev_button.disabled = current_page == 0
-                next_button.disabled = current_page >= total_pages - 1
-                content = await update_stock_message(current_page)
-                await interaction.response.edit_message(content=content, view=nav_view)
-            
-            async def next_callback(interaction: discord.Interaction):
-                nonlocal current_page
-                current_page = min(total_pages - 1, current_page + 1)
-                prev_button.disabled = current_page == 0
-                next_button.disabled = current_page >= total_pages - 1
-                content = await update_stock_message(current_page)
-                await interaction.response.edit_message(content=content, view=nav_view)
-            
-            prev_button.callback = prev_callback
-            next_button.callback = next_callback
-            
-            nav_view.add_item(prev_button)
-            nav_view.add_item(next_button)
-            
-            content = await update_stock_message(current_page)
-            await interaction.response.send_message(content, view=nav_view, ephemeral=True)
+        view = discord.ui.View(timeout=None)
+        view.add_item(ManageStockSelect(options[:25]))
+        await respond(
+            interaction, "Select a product to manage stock:" + more_products_hint(len(options)), view=view, ephemeral=True
+        )
 
-        select.callback = select_callback
-        view.add_item(select)
-        await interaction.response.send_message("Select a product to manage stock:", view=view, ephemeral=True)
+    async def show_stock_page(self, interaction: discord.Interaction, product_id: int, page: int, edit: bool = False):
+        """Show one page of a product's stock entries, read from the store every time"""
+        store = StockStore(product_id)
+
+        if not store.exists():
+            await respond(interaction, "No stock file found for this product!", ephemeral=True)
+            return
+
+        total_stock = store.count()
+        if total_stock == 0:
+            await respond(interaction, "No stock entries found!", ephemeral=True)
+            return
+
+        # Create pages of stock (10 entries per page), the stock may have shrunk since the buttons were made
+        page_size = 10
+        total_pages = math.ceil(total_stock / page_size)
+        page = min(page, total_pages - 1)
+        start_idx = page * page_size
+        # Only the blocks holding this page are decompressed
+        current_entries = await asyncio.to_thread(store.page, start_idx, page_size)
+
+        # Format the stock entries with numbers
+        formatted_entries = []
+        for i, entry in enumerate(current_entries, start=start_idx + 1):
+            formatted_entries.append(f"{i}. {entry}")
+
+        content = f"Stock entries (Page {page + 1}/{total_pages}):\n```\n"
+        content += "\n".join(formatted_entries)
+        content += "\n```\n\nTo remove specific entries, use `/remove_stock [product] [entry_numbers]`"
+
+        # The navigation buttons carry the product and the page they lead to
+        nav_view = stock_page_view(product_id, page, total_pages)
+        if edit:
+            await edit_response(interaction, content=content, view=nav_view)
+        else:
+            await respond(interaction, content, view=nav_view, ephemeral=True)
 
     @app_commands.command(name="remove_stock", description="[Admin] Remove specific stock entries")
     @app_commands.checks.has_role(ADMIN_ROLE_NAME)
     async def remove_stock(self, interaction: discord.Interaction, product: str, entries: str):
-        async with aiosqlite.connect(self.bot.db_path) as db:
-            async with db.execute('SELECT id, name, stock FROM products WHERE name = ?', (product,)) as cursor:
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute(
+                'SELECT id, name, stock FROM products WHERE id = ?',
+                (self.product_index.resolve(product),)
+            ) as cursor:
                 result = await cursor.fetchone()
                 
                 if not result:
-                    await interaction.response.send_message("Product not found!", ephemeral=True)
+                    await respond(interaction, "Product not found!", ephemeral=True)
                     return
                 
                 product_id, name, current_stock = result
                 
-        stock_file = f"products/stock_{product_id}.txt"
-        if not os.path.exists(stock_file):
-            await interaction.response.send_message("No stock file found for this product!", ephemeral=True)
+        store = StockStore(product_id)
+        if not store.exists():
+            await respond(interaction, "No stock file found for this product!", ephemeral=True)
             return
             
         # Parse entry numbers (format: "1,2,3" or "1-3" or "1,2,4-6")
@@ -775,36 +1235,29 @@ class ProductManager(commands.Cog):
                 else:
                     entry_numbers.add(int(part))
         except ValueError:
-            await interaction.response.send_message(
-                "Invalid entry format! Use numbers separated by commas or ranges (e.g., '1,2,3' or '1-3' or '1,2,4-6')",
+            await respond(
+                interaction, "Invalid entry format! Use numbers separated by commas or ranges (e.g., '1,2,3' or '1-3' or '1,2,4-6')",
                 ephemeral=True
             )
             return
             
-        # Read all stock entries
-        with open(stock_file, 'r', encoding='utf-8') as f:
-            stock_lines = [line.strip() for line in f.readlines() if line.strip()]
-            
         # Validate entry numbers
-        invalid_entries = [n for n in entry_numbers if n < 1 or n > len(stock_lines)]
+        total_stock = store.count()
+        invalid_entries = [n for n in entry_numbers if n < 1 or n > total_stock]
         if invalid_entries:
-            await interaction.response.send_message(
-                f"Invalid entry numbers: {', '.join(map(str, invalid_entries))}",
+            await respond(
+                interaction, f"Invalid entry numbers: {', '.join(map(str, invalid_entries))}",
                 ephemeral=True
             )
             return
             
-        # Remove the specified entries (convert to 0-based index)
-        entries_to_remove = {n - 1 for n in entry_numbers}
-        new_stock_lines = [line for i, line in enumerate(stock_lines) if i not in entries_to_remove]
-        
-        # Write back the remaining stock
-        with open(stock_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(new_stock_lines) + '\n' if new_stock_lines else '')
+        # Remove the specified entries (convert to 0-based index), only the blocks holding them are rewritten.
+        # Waits for any sale in progress, which may be holding the blocks being rewritten
+        async with store.sale_lock:
+            removed_count = await asyncio.to_thread(store.remove, {n - 1 for n in entry_numbers})
             
         # Update the stock count in the database
-        removed_count = len(stock_lines) - len(new_stock_lines)
-        async with aiosqlite.connect(self.bot.db_path) as db:
+        async with connect_db(self.bot.db_path) as db:
             await db.execute(
                 'UPDATE products SET stock = stock - ? WHERE id = ?',
                 (removed_count, product_id)
@@ -815,24 +1268,34 @@ class ProductManager(commands.Cog):
             async with db.execute('SELECT stock FROM products WHERE id = ?', (product_id,)) as cursor:
                 new_stock = (await cursor.fetchone())[0]
                 if new_stock == 0:
-                    await self.notify_stock_empty(name)
+                    self.alert_stock_empty(name)
             
-        await interaction.response.send_message(
-            f"Successfully removed {removed_count} stock entries from {name}!",
+        await respond(
+            interaction, f"Successfully removed {removed_count} stock entries from {name}!",
             ephemeral=True
         )
 
+    @purchase.autocomplete('product')
+    @restock.autocomplete('product')
+    @manage_stock.autocomplete('product')
+    @remove_stock.autocomplete('product')
+    async def product_autocomplete(self, interaction: discord.Interaction, current: str):
+        # Served from memory, Discord drops suggestions that take longer than 3 seconds
+        return [
+            app_commands.Choice(name=name[:100], value=str(product_id))
+            for product_id, name in self.product_index.search(current)
+        ]
+
     async def generate_purchase_id(self):
         """Generate a unique purchase ID"""
         # Format: PUR-XXXXX where X is alphanumeric
         while True:
             purchase_id = 'PUR-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
             
-            # Check if ID already exists
-            async with aiosqlite.connect(self.bot.db_path) as db:
-                async with db.execute('SELECT 1 FROM transactions WHERE purchase_id = ?', (purchase_id,)) as cursor:
-                    if not await cursor.fetchone():
-                        return purchase_id
+            # Check if ID already exists, archived purchases included.
+            # Cart checkouts use the ID with a -<line> suffix for each of their line items
+            if not await self.bot.transaction_archive.purchase_id_taken(purchase_id):
+                return purchase_id
 
 async def setup(bot):
     # Store config in bot instance for access
@@ -840,15 +1303,6 @@ async def setup(bot):
     with open('config.json', 'r') as f:
         bot.config = json.load(f)
     
-    # Add commands to all configured guilds
+    # Add commands to all configured guilds, they are synced once the bot is ready
     cog = ProductManager(bot)
-    await bot.add_cog(cog)
-    
-    # Sync commands for each guild
-    for guild_id in bot.config['guild_ids']:
-        guild = discord.Object(id=int(guild_id))
-        try:
-            bot.tree.copy_global_to(guild=guild)
-            await bot.tree.sync(guild=guild)
-        except Exception as e:
-            print(f"Failed to sync commands in product manager for guild {guild_id}: {e}") 
\ No newline at end of file
+    await bot.add_cog(cog)
\ No newline at end of file
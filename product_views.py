@@ -0,0 +1,179 @@
+import discord
+from latency import respond
+
+ADMIN_ROLE_NAME = "Admin"
+
+# Menus and buttons are routed by custom_id to handlers registered once at startup.
+# Everything a handler needs is in the custom_id, so open menus hold no state in
+# memory and keep working after a restart. Custom IDs are at most 100 characters.
+
+def _cog(interaction):
+    return interaction.client.get_cog('ProductManager')
+
+def _is_admin(interaction):
+    return discord.utils.get(getattr(interaction.user, 'roles', []), name=ADMIN_ROLE_NAME) is not None
+
+async def admins_only(interaction):
+    """Admin menus outlive the command that sent them, anyone else who uses one is told why nothing happens"""
+    if _is_admin(interaction):
+        return True
+    await respond(interaction, f"You need the '{ADMIN_ROLE_NAME}' role to use this.", ephemeral=True)
+    return False
+
+async def turn_away_blacklisted(interaction):
+    """Components don't go through the command tree's check, purchase items turn blacklisted users away here"""
+    if interaction.user.id in interaction.client.blacklist:
+        await respond(interaction, "You are blacklisted from using this bot.", ephemeral=True)
+        return False
+    return True
+
+class PurchaseSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'purchase:select:(?P<quantity>\d+):(?P<code>.*)'):
+    def __init__(self, quantity, discount_code=None, options=()):
+        super().__init__(discord.ui.Select(
+            placeholder="Choose a product to purchase",
+            options=list(options),
+            custom_id=f"purchase:select:{quantity}:{discount_code or ''}"
+        ))
+        self.quantity = quantity
+        self.discount_code = discount_code
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match['quantity']), match['code'] or None, item.options)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await turn_away_blacklisted(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).purchase_selected(interaction, int(self.item.values[0]), self.quantity, self.discount_code)
+
+class PurchaseConfirm(discord.ui.DynamicItem[discord.ui.Button],
+                      template=r'purchase:confirm:(?P<reservation>[0-9a-f]+):(?P<total>\d+):(?P<code>.*)'):
+    """The reservation says what is being bought, the total is what the user agreed to pay"""
+    def __init__(self, reservation_id, total_cost, discount_code=None):
+        super().__init__(discord.ui.Button(
+            label="Confirm Purchase",
+            style=discord.ButtonStyle.green,
+            custom_id=f"purchase:confirm:{reservation_id}:{total_cost}:{discount_code or ''}"
+        ))
+        self.reservation_id = reservation_id
+        self.total_cost = total_cost
+        self.discount_code = discount_code
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['reservation'], int(match['total']), match['code'] or None)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await turn_away_blacklisted(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).confirm_purchase(interaction, self)
+
+class CartConfirm(discord.ui.DynamicItem[discord.ui.Button],
+                  template=r'cart:confirm:(?P<nonce>[0-9a-f]+):(?P<total>\d+):(?P<code>.*)'):
+    """The checkout's reservations are found by its nonce, the total is what the user agreed to pay"""
+    def __init__(self, nonce, total_cost, discount_code=None):
+        super().__init__(discord.ui.Button(
+            label="Confirm Purchase",
+            style=discord.ButtonStyle.green,
+            custom_id=f"cart:confirm:{nonce}:{total_cost}:{discount_code or ''}"
+        ))
+        self.nonce = nonce
+        self.total_cost = total_cost
+        self.discount_code = discount_code
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['nonce'], int(match['total']), match['code'] or None)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await turn_away_blacklisted(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).confirm_cart(interaction, self)
+
+class RestockSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'restock:select'):
+    def __init__(self, options=()):
+        super().__init__(discord.ui.Select(
+            placeholder="Choose a product to restock",
+            options=list(options),
+            custom_id="restock:select"
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item.options)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await admins_only(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).restock_selected(interaction, int(self.item.values[0]))
+
+class RemoveProductSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'remove_product:select'):
+    def __init__(self, options=()):
+        super().__init__(discord.ui.Select(
+            placeholder="Choose a product to remove",
+            options=list(options),
+            custom_id="remove_product:select"
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item.options)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await admins_only(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).remove_product_selected(interaction, int(self.item.values[0]))
+
+class ManageStockSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'manage_stock:select'):
+    def __init__(self, options=()):
+        super().__init__(discord.ui.Select(
+            placeholder="Choose a product to manage stock",
+            options=list(options),
+            custom_id="manage_stock:select"
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item.options)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await admins_only(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).show_stock_page(interaction, int(self.item.values[0]), 0)
+
+class StockPageButton(discord.ui.DynamicItem[discord.ui.Button],
+                      template=r'manage_stock:page:(?P<product_id>\d+):(?P<page>\d+):(?P<label>Previous|Next)'):
+    def __init__(self, product_id, page, label, disabled=False):
+        super().__init__(discord.ui.Button(
+            label=label,
+            style=discord.ButtonStyle.gray,
+            disabled=disabled,
+            custom_id=f"manage_stock:page:{product_id}:{page}:{label}"
+        ))
+        self.product_id = product_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match['product_id']), int(match['page']), match['label'])
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await admins_only(interaction)
+
+    async def callback(self, interaction: discord.Interaction):
+        await _cog(interaction).show_stock_page(interaction, self.product_id, self.page, edit=True)
+
+def stock_page_view(product_id, page, total_pages):
+    view = discord.ui.View(timeout=None)
+    view.add_item(StockPageButton(product_id, max(0, page - 1), "Previous", disabled=page == 0))
+    view.add_item(StockPageButton(product_id, min(total_pages - 1, page + 1), "Next", disabled=page >= total_pages - 1))
+    return view
+
+DYNAMIC_ITEMS = (PurchaseSelect, PurchaseConfirm, CartConfirm, RestockSelect, RemoveProductSelect, ManageStockSelect,
+                 StockPageButton)
@@ -0,0 +1,355 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+import asyncio
+import cProfile
+import gc
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+import types
+from collections import Counter
+from datetime import datetime
+from bot_logging import get_logger
+from latency import respond, defer_response
+
+ADMIN_ROLE_NAME = "Admin"
+
+log = get_logger('profiler')
+
+MAX_PROFILE_SECONDS = 300
+MAX_PROFILE_INVOCATIONS = 100
+
+class SamplingProfiler:
+    """Periodically samples the event loop thread's stack from a background thread"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def render(self, limit=40):
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+
+        samples = max(self.sample_count, 1)
+        report = io.StringIO()
+        report.write(f"{self.sample_count} samples every {self.interval * 1000:.1f}ms\n\n")
+        report.write("Top functions by own samples:\n")
+        for frame, count in own.most_common(limit):
+            report.write(f"{count:8d} {count / samples:7.2%}  {frame}\n")
+        report.write("\nTop functions by total samples:\n")
+        for frame, count in total.most_common(limit):
+            report.write(f"{count:8d} {count / samples:7.2%}  {frame}\n")
+
+        # Collapsed stacks can be fed straight into flamegraph tools
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        return [("report.txt", report.getvalue()), ("collapsed.txt", collapsed)]
+
+class CProfileProfiler:
+    """Deterministic profiler wrapping cProfile"""
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def render(self, limit=40):
+        report = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(limit)
+        stats.sort_stats('tottime').print_stats(limit)
+        # Raw stats in the same format as pstats.dump_stats, for snakeviz and friends
+        return [("report.txt", report.getvalue()), ("stats.prof", marshal.dumps(stats.stats))]
+
+class ProfileSession:
+    """A single profiling run, either timed or bound to a command's next invocations"""
+    def __init__(self, mode, owner, command_name=None, invocations=0):
+        self.mode = mode
+        self.owner = owner
+        self.command_name = command_name
+        self.remaining = invocations
+        self.active = 0
+        self.started_at = datetime.now()
+        self.profiler = SamplingProfiler() if mode == 'sampling' else CProfileProfiler()
+
+    def files(self):
+        stamp = self.started_at.strftime('%Y%m%d_%H%M%S')
+        header = f"Mode: {self.mode}\nStarted: {self.started_at}\nFinished: {datetime.now()}\n"
+        if self.command_name:
+            header += f"Command: /{self.command_name}\n"
+            header += "Note: other work running on the event loop during these invocations is included.\n"
+        files = []
+        for suffix, content in self.profiler.render():
+            if suffix.endswith('.txt'):
+                content = (header + "\n" + content).encode('utf-8')
+            files.append(discord.File(io.BytesIO(content), filename=f"profile_{stamp}_{suffix}"))
+        return files
+
+class Profiler(commands.Cog):
+    profile = app_commands.Group(name="profile", description="[Admin] Profile the running bot")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.session = None
+        self.timer_task = None
+        self.memory_baseline = None
+
+    async def cog_load(self):
+        self.bot.tree.before_invoke_hooks.append(self.before_invoke)
+        self.bot.tree.after_invoke_hooks.append(self.after_invoke)
+
+    async def cog_unload(self):
+        self.bot.tree.before_invoke_hooks.remove(self.before_invoke)
+        self.bot.tree.after_invoke_hooks.remove(self.after_invoke)
+        if self.session and self.session.active:
+            self.session.profiler.disable()
+        self.session = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    async def before_invoke(self, interaction: discord.Interaction):
+        session = self.session
+        if not session or not session.command_name or session.remaining <= 0:
+            return
+        if not interaction.command or interaction.command.qualified_name != session.command_name:
+            return
+
+        session.remaining -= 1
+        session.active += 1
+        if session.active == 1:
+            session.profiler.enable()
+        interaction.extras['profile_session'] = session
+
+    async def after_invoke(self, interaction: discord.Interaction):
+        session = interaction.extras.pop('profile_session', None)
+        # The session may have been stopped while this invocation was running
+        if not session or session is not self.session:
+            return
+
+        session.active -= 1
+        if session.active == 0:
+            session.profiler.disable()
+            if session.remaining == 0:
+                self.session = None
+                await self.deliver(session)
+
+    async def deliver(self, session):
+        """DM the report to the admin who started the session"""
+        try:
+            await session.owner.send("Profiling session finished:", files=session.files())
+        except Exception:
+            log.exception("Failed to deliver profile report", extra={'user_id': session.owner.id})
+
+    def validate_mode(self, mode):
+        mode = mode.lower()
+        return mode if mode in ('cprofile', 'sampling') else None
+
+    @profile.command(name="start", description="[Admin] Profile the whole bot for a number of seconds")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def profile_start(self, interaction: discord.Interaction, seconds: int, mode: str = 'sampling'):
+        mode = self.validate_mode(mode)
+        if not mode:
+            await respond(interaction, "Mode must be either 'cprofile' or 'sampling'", ephemeral=True)
+            return
+        if seconds < 1 or seconds > MAX_PROFILE_SECONDS:
+            await respond(
+                interaction, f"Please profile for between 1 and {MAX_PROFILE_SECONDS} seconds.", ephemeral=True
+            )
+            return
+        if self.session:
+            await respond(interaction, "A profiling session is already running.", ephemeral=True)
+            return
+
+        session = ProfileSession(mode, interaction.user)
+        self.session = session
+        session.active = 1
+        session.profiler.enable()
+
+        await respond(
+            interaction, f"Profiling ({mode}) for {seconds} seconds. The report will be sent to your DMs.", ephemeral=True
+        )
+
+        async def finish():
+            await asyncio.sleep(seconds)
+            if self.session is session:
+                await self.stop_session()
+
+        self.timer_task = asyncio.create_task(finish())
+
+    @profile.command(name="command", description="[Admin] Profile the next invocations of a command")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def profile_command(self, interaction: discord.Interaction, name: str, invocations: int = 1, mode: str = 'cprofile'):
+        mode = self.validate_mode(mode)
+        if not mode:
+            await respond(interaction, "Mode must be either 'cprofile' or 'sampling'", ephemeral=True)
+            return
+        if invocations < 1 or invocations > MAX_PROFILE_INVOCATIONS:
+            await respond(
+                interaction, f"Please profile between 1 and {MAX_PROFILE_INVOCATIONS} invocations.", ephemeral=True
+            )
+            return
+        name = name.strip().lstrip('/')
+        if not self.bot.tree.get_command(name.split(' ')[0]):
+            await respond(interaction, f"Unknown command: /{name}", ephemeral=True)
+            return
+        if self.session:
+            await respond(interaction, "A profiling session is already running.", ephemeral=True)
+            return
+
+        self.session = ProfileSession(mode, interaction.user, command_name=name, invocations=invocations)
+        await respond(
+            interaction, f"Profiling ({mode}) the next {invocations} invocation(s) of /{name}. "
+            "The report will be sent to your DMs.",
+            ephemeral=True
+        )
+
+    @profile.command(name="stop", description="[Admin] Stop the running profiling session and get its report")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def profile_stop(self, interaction: discord.Interaction):
+        if not self.session:
+            await respond(interaction, "No profiling session is running.", ephemeral=True)
+            return
+
+        await respond(interaction, "Profiling stopped. The report will be sent to your DMs.", ephemeral=True)
+        await self.stop_session()
+
+    async def stop_session(self):
+        session = self.session
+        self.session = None
+        if self.timer_task and self.timer_task is not asyncio.current_task():
+            self.timer_task.cancel()
+        self.timer_task = None
+        if session.active:
+            session.profiler.disable()
+            session.active = 0
+        await self.deliver(session)
+
+    @profile.command(name="memory", description="[Admin] Take tracemalloc snapshots and diff them")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def profile_memory(self, interaction: discord.Interaction, action: str, top: int = 50, group_by: str = 'lineno'):
+        action = action.lower()
+        if action not in ('start', 'diff', 'stop'):
+            await respond(interaction, "Action must be 'start', 'diff' or 'stop'", ephemeral=True)
+            return
+        if group_by not in ('lineno', 'filename', 'traceback'):
+            await respond(
+                interaction, "Group by must be 'lineno', 'filename' or 'traceback'", ephemeral=True
+            )
+            return
+
+        if action == 'start':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            self.memory_baseline = self.take_snapshot()
+            await respond(
+                interaction, "Memory tracing started and baseline snapshot taken. Use `/profile memory diff` to compare.",
+                ephemeral=True
+            )
+            return
+
+        if action == 'stop':
+            tracemalloc.stop()
+            self.memory_baseline = None
+            await respond(interaction, "Memory tracing stopped.", ephemeral=True)
+            return
+
+        if not tracemalloc.is_tracing() or not self.memory_baseline:
+            await respond(
+                interaction, "Memory tracing is not running. Use `/profile memory start` first.", ephemeral=True
+            )
+            return
+
+        await defer_response(interaction, ephemeral=True)
+        snapshot = self.take_snapshot()
+        report = self.render_memory_report(snapshot, max(1, min(top, 500)), group_by)
+        self.memory_baseline = snapshot
+
+        file = discord.File(
+            io.BytesIO(report.encode('utf-8')),
+            filename=f"memory_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        )
+        await interaction.followup.send(
+            "Memory diff against the previous snapshot (the new snapshot is now the baseline):",
+            file=file,
+            ephemeral=True
+        )
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    def render_memory_report(self, snapshot, top, group_by):
+        current, peak = tracemalloc.get_traced_memory()
+        report = io.StringIO()
+        report.write(f"Traced memory: current {current / 1024 / 1024:.2f} MiB, peak {peak / 1024 / 1024:.2f} MiB\n")
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report.write(f"Max RSS: {max_rss / 1024:.2f} MiB\n")
+        except ImportError:
+            pass
+
+        # Live objects that tend to pile up: open views and the closures their callbacks capture
+        views = closures = 0
+        for obj in gc.get_objects():
+            if isinstance(obj, discord.ui.View):
+                views += 1
+            elif isinstance(obj, types.FunctionType) and obj.__closure__:
+                closures += 1
+        report.write(f"Live views: {views}\nLive closures: {closures}\n")
+
+        report.write(f"\nTop {top} differences by {group_by}:\n")
+        for stat in snapshot.compare_to(self.memory_baseline, group_by)[:top]:
+            report.write(f"{stat}\n")
+            if group_by == 'traceback':
+                for line in stat.traceback.format():
+                    report.write(f"    {line}\n")
+
+        report.write(f"\nTop {top} allocations by {group_by}:\n")
+        for stat in snapshot.statistics(group_by)[:top]:
+            report.write(f"{stat}\n")
+        return report.getvalue()
+
+async def setup(bot):
+    await bot.add_cog(Profiler(bot))
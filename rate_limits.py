@@ -0,0 +1,241 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+import contextlib
+import time
+from collections import OrderedDict
+from bot_logging import get_logger
+from latency import respond
+from db_writer import connect_db
+
+ADMIN_ROLE_NAME = "Admin"
+
+DEFAULT_RATE_LIMIT_CONFIG = {
+    "default": {"per_minute": 20, "burst": 5},
+    "commands": {
+        "purchase": {"per_minute": 6, "burst": 3},
+        "redeem": {"per_minute": 6, "burst": 3},
+        "redeem_bulk": {"per_minute": 2, "burst": 1},
+        "cart checkout": {"per_minute": 6, "burst": 3}
+    },
+    # Commands that write to the database share a global ceiling on concurrent runs. Purchase and checkout
+    # confirmations and restock uploads write after their command returned, they take a slot with write_slot
+    "write_commands": [
+        "purchase", "cart checkout", "redeem", "redeem_bulk", "add_credits", "generate_code", "create_discount",
+        "remove_discount", "blacklist", "unblacklist", "remove_stock", "verify_balance"
+    ],
+    "write_concurrency": 8,
+    "max_buckets": 50000
+}
+
+# Retry hint when a write is shed for lack of a concurrency slot
+SHED_RETRY_SECONDS = 1.0
+
+log = get_logger('rate_limits')
+
+@contextlib.contextmanager
+def write_slot(bot, command, user_id):
+    """Hold a slot under the write ceiling for writes that run outside a command, like a confirm button.
+
+    Yields False when every slot is taken, the caller should turn the user away.
+    """
+    rate_limits = bot.get_cog('RateLimits')
+    if rate_limits is None:
+        yield True
+        return
+    if not rate_limits.acquire_write(command, user_id):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        rate_limits.release_write()
+
+class TokenBuckets:
+    """Per (command, user) token buckets in least recently used order.
+
+    A bucket is ``[tokens, last_refill]``. Buckets that have been idle long enough
+    to refill completely carry no state worth keeping, they are evicted from the
+    front as new requests come in.
+    """
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        # Longest time any limit takes to refill a bucket from empty
+        self.idle_seconds = 0
+        self.buckets = OrderedDict()
+
+    def take(self, key, per_minute, burst, now):
+        """Spend a token, returns 0 on success or the seconds until one is available"""
+        rate = per_minute / 60
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+
+        retry_after = 0.0
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+        else:
+            retry_after = (1 - bucket[0]) / rate
+        self.evict(now)
+        return retry_after
+
+    def evict(self, now):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket[1] < self.idle_seconds and len(self.buckets) <= self.max_buckets:
+                break
+            del self.buckets[key]
+
+class RateLimits(commands.Cog):
+    """Token-bucket limits per user and command, and a concurrency ceiling for database writes"""
+    ratelimit = app_commands.Group(name="ratelimit", description="[Admin] Manage command rate limits")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = {**DEFAULT_RATE_LIMIT_CONFIG, **bot.config.get('rate_limits', {})}
+        self.buckets = TokenBuckets(self.settings['max_buckets'])
+        self.write_commands = set(self.settings['write_commands'])
+        self.writes_running = 0
+        # command -> (per_minute, burst), set by admins and kept in the database
+        self.overrides = {}
+
+    async def cog_load(self):
+        async with connect_db(self.bot.db_path) as db:
+            async with db.execute('SELECT command, per_minute, burst FROM rate_limit_overrides') as cursor:
+                self.overrides = {command: (per_minute, burst) for command, per_minute, burst in await cursor.fetchall()}
+        self.update_idle_seconds()
+        # After the latency hook, so shed commands still show up in its timings
+        self.bot.tree.before_invoke_hooks.append(self.before_invoke)
+        self.bot.tree.after_invoke_hooks.append(self.after_invoke)
+
+    async def cog_unload(self):
+        self.bot.tree.before_invoke_hooks.remove(self.before_invoke)
+        self.bot.tree.after_invoke_hooks.remove(self.after_invoke)
+
+    def update_idle_seconds(self):
+        limits = [(limit['per_minute'], limit['burst']) for limit in self.settings['commands'].values()]
+        limits += [(self.settings['default']['per_minute'], self.settings['default']['burst'])]
+        limits += list(self.overrides.values())
+        self.buckets.idle_seconds = max((60 * burst / per_minute for per_minute, burst in limits if per_minute > 0), default=0)
+
+    def limit_for(self, command):
+        if command in self.overrides:
+            return self.overrides[command]
+        limit = self.settings['commands'].get(command, self.settings['default'])
+        return limit['per_minute'], limit['burst']
+
+    async def before_invoke(self, interaction: discord.Interaction):
+        command = interaction.command.qualified_name
+        per_minute, burst = self.limit_for(command)
+        if per_minute > 0:
+            retry_after = self.buckets.take((command, interaction.user.id), per_minute, burst, time.monotonic())
+            if retry_after:
+                log.info("Rate limited command", extra={
+                    'event': 'ratelimit.limited', 'command': command, 'user_id': interaction.user.id
+                })
+                raise app_commands.CommandOnCooldown(app_commands.Cooldown(burst, 60 * burst / per_minute), retry_after)
+
+        if command in self.write_commands:
+            if not self.acquire_write(command, interaction.user.id):
+                raise app_commands.CommandOnCooldown(app_commands.Cooldown(1, SHED_RETRY_SECONDS), SHED_RETRY_SECONDS)
+            interaction.extras['ratelimit_write_slot'] = True
+
+    async def after_invoke(self, interaction: discord.Interaction):
+        if interaction.extras.pop('ratelimit_write_slot', False):
+            self.release_write()
+
+    def acquire_write(self, command, user_id):
+        """Take a slot under the write ceiling, False if every slot is in use"""
+        if self.writes_running >= self.settings['write_concurrency']:
+            log.warning("Shed write command at the concurrency ceiling", extra={
+                'event': 'ratelimit.shed', 'command': command, 'user_id': user_id
+            })
+            return False
+        self.writes_running += 1
+        return True
+
+    def release_write(self):
+        self.writes_running -= 1
+
+    def command_names(self):
+        return {command.qualified_name for command in self.bot.tree.walk_commands()
+                if isinstance(command, app_commands.Command)}
+
+    @ratelimit.command(name="set", description="[Admin] Override the rate limit of a command (0 per minute disables it)")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def ratelimit_set(self, interaction: discord.Interaction, command: str, per_minute: float, burst: int = 1):
+        command = command.strip().lstrip('/')
+        if command not in self.command_names():
+            await respond(interaction, f"Unknown command: /{command}", ephemeral=True)
+            return
+        if per_minute < 0 or burst < 1:
+            await respond(interaction, "The rate can't be negative and the burst must be at least 1.", ephemeral=True)
+            return
+
+        async with connect_db(self.bot.db_path) as db:
+            await db.execute('''
+                INSERT INTO rate_limit_overrides (command, per_minute, burst) VALUES (?, ?, ?)
+                ON CONFLICT(command) DO UPDATE SET per_minute = excluded.per_minute, burst = excluded.burst
+            ''', (command, per_minute, burst))
+            await db.commit()
+        self.overrides[command] = (per_minute, burst)
+        self.update_idle_seconds()
+
+        log.info("Rate limit overridden", extra={
+            'event': 'ratelimit.override', 'command': command, 'per_minute': per_minute,
+            'burst': burst, 'user_id': interaction.user.id
+        })
+        if per_minute == 0:
+            await respond(interaction, f"/{command} is no longer rate limited.", ephemeral=True)
+        else:
+            await respond(
+                interaction, f"/{command} is now limited to {per_minute:g} per minute with bursts of {burst}.", ephemeral=True
+            )
+
+    @ratelimit.command(name="clear", description="[Admin] Go back to the configured rate limit of a command")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def ratelimit_clear(self, interaction: discord.Interaction, command: str):
+        command = command.strip().lstrip('/')
+        if command not in self.overrides:
+            await respond(interaction, f"/{command} has no override.", ephemeral=True)
+            return
+
+        async with connect_db(self.bot.db_path) as db:
+            await db.execute('DELETE FROM rate_limit_overrides WHERE command = ?', (command,))
+            await db.commit()
+        del self.overrides[command]
+        self.update_idle_seconds()
+
+        per_minute, burst = self.limit_for(command)
+        await respond(
+            interaction, f"/{command} is back to {per_minute:g} per minute with bursts of {burst}.", ephemeral=True
+        )
+
+    @ratelimit.command(name="show", description="[Admin] Show rate limits and current load")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def ratelimit_show(self, interaction: discord.Interaction):
+        default = self.settings['default']
+        embed = discord.Embed(
+            title="Rate Limits",
+            description=f"Default: {default['per_minute']:g} per minute, bursts of {default['burst']}\n"
+                        f"Writes running: {self.writes_running}/{self.settings['write_concurrency']}\n"
+                        f"Active buckets: {len(self.buckets.buckets)}",
+            color=discord.Color.blue()
+        )
+        commands_shown = sorted(set(self.settings['commands']) | set(self.overrides))
+        for command in commands_shown[:25]:
+            per_minute, burst = self.limit_for(command)
+            source = "override" if command in self.overrides else "config"
+            embed.add_field(
+                name=f"/{command}",
+                value=f"{per_minute:g} per minute, bursts of {burst} ({source})" if per_minute else f"Unlimited ({source})",
+                inline=False
+            )
+        await respond(interaction, embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(RateLimits(bot))
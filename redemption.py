@@ -0,0 +1,204 @@
+import asyncio
+import re
+import time
+from bloom_filter import BloomFilter
+from bot_logging import get_logger
+from ledger import ACCOUNT_CODES
+from db_writer import connect_db
+
+MAX_BULK_CODES = 100
+
+# Minimum filter size, so generating a handful of codes doesn't force a rebuild
+MIN_FILTER_CAPACITY = 10000
+
+log = get_logger('redemption')
+
+def parse_codes(text):
+    """Split pasted codes on whitespace and commas, keeping the first occurrence of each"""
+    codes = []
+    seen = set()
+    for code in re.split(r'[\s,;]+', text):
+        code = code.strip().upper()
+        if code and code not in seen:
+            seen.add(code)
+            codes.append(code)
+    return codes
+
+class AttemptTracker:
+    """Counts failed redemptions per user and locks out repeat guessers with growing delays"""
+    def __init__(self, free_attempts=3, base_delay=5, max_delay=3600, reset_after=900, max_users=10000):
+        self.free_attempts = free_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.max_users = max_users
+        # user_id -> [failures, locked_until, last_failure]
+        self.users = {}
+
+    def retry_after(self, user_id):
+        """Seconds until the user may try again, 0 if they are not locked out"""
+        entry = self.users.get(user_id)
+        if not entry:
+            return 0
+        return max(0, entry[1] - time.monotonic())
+
+    def record_failures(self, user_id, failures):
+        now = time.monotonic()
+        entry = self.users.get(user_id)
+        if not entry or now - entry[2] > self.reset_after:
+            if len(self.users) >= self.max_users:
+                self.prune(now)
+            entry = self.users[user_id] = [0, 0, now]
+
+        entry[0] += failures
+        entry[2] = now
+        over = entry[0] - self.free_attempts
+        if over > 0:
+            # Each failure past the free attempts doubles the lockout
+            entry[1] = now + min(self.max_delay, self.base_delay * 2 ** (over - 1))
+
+    def record_success(self, user_id):
+        entry = self.users.get(user_id)
+        if entry and self.retry_after(user_id) == 0:
+            del self.users[user_id]
+
+    def prune(self, now):
+        for user_id in [uid for uid, entry in self.users.items()
+                        if now - entry[2] > self.reset_after and entry[1] <= now]:
+            del self.users[user_id]
+
+class RedemptionEngine:
+    """Claims redeem codes and credits users in a single write transaction.
+
+    An in-memory Bloom filter of unused codes answers most invalid attempts
+    without opening a database connection.
+    """
+    def __init__(self, db_path, ledger, use_filter=True):
+        self.db_path = db_path
+        self.ledger = ledger
+        # Off when other processes generate codes too, a filter would reject the codes it never saw
+        self.use_filter = use_filter
+        self.filter = None
+        # Redeemed codes can't be removed from a Bloom filter, they are dropped on the next rebuild
+        self.redeemed_since_load = 0
+        self.rebuild_lock = asyncio.Lock()
+        self.rebuild_task = None
+        # Codes added while a rebuild scans the table, merged into the new filter before it's swapped in
+        self.pending = None
+        self.attempts = AttemptTracker()
+
+    async def load_filter(self):
+        """(Re)build the filter from every unused code in the database"""
+        if not self.use_filter:
+            return
+        async with self.rebuild_lock:
+            self.pending = []
+            try:
+                async with connect_db(self.db_path) as db:
+                    async with db.execute('SELECT COUNT(*) FROM codes WHERE is_used = 0') as cursor:
+                        count = (await cursor.fetchone())[0]
+
+                    code_filter = BloomFilter(max(MIN_FILTER_CAPACITY, count * 2))
+                    async with db.execute('SELECT code FROM codes WHERE is_used = 0') as cursor:
+                        async for (code,) in cursor:
+                            code_filter.add(code)
+            finally:
+                pending, self.pending = self.pending, None
+
+            for code in pending:
+                code_filter.add(code)
+            self.filter = code_filter
+            self.redeemed_since_load = 0
+        log.info("Loaded redeem code filter", extra={'event': 'redemption.filter_loaded', 'count': count})
+
+    async def rebuild(self):
+        try:
+            await self.load_filter()
+        except Exception:
+            log.exception("Could not rebuild redeem code filter", extra={'event': 'redemption.error'})
+
+    def schedule_rebuild(self):
+        """Rebuild the filter in the background, unless a rebuild is already running"""
+        if self.rebuild_task is None or self.rebuild_task.done():
+            self.rebuild_task = asyncio.create_task(self.rebuild())
+
+    def add_codes(self, codes):
+        """Register newly generated codes, call after they are committed and before they are handed out"""
+        if self.filter is None:
+            return
+        for code in codes:
+            self.filter.add(code)
+        if self.pending is not None:
+            self.pending.extend(codes)
+        if self.filter.is_full():
+            # The false positive rate degrades past capacity, start over at a bigger size
+            self.schedule_rebuild()
+
+    def might_exist(self, code):
+        return self.filter is None or code in self.filter
+
+    async def claim(self, db, code):
+        """Mark a code as used and return its credits, or None if it was already used or never existed"""
+        async with db.execute(
+            'UPDATE codes SET is_used = 1 WHERE code = ? AND is_used = 0 RETURNING credits',
+            (code,)
+        ) as cursor:
+            result = await cursor.fetchone()
+        return result[0] if result else None
+
+    async def credit(self, db, user_id, credits, codes):
+        await self.ledger.move(db, user_id, credits, 'redeem', ','.join(codes), ACCOUNT_CODES)
+
+    async def redeem(self, user_id, code):
+        """Redeem a single code, returns the credited amount or None"""
+        credited, redeemed, rejected = await self.redeem_many(user_id, [code])
+        return credited if redeemed else None
+
+    async def redeem_many(self, user_id, codes):
+        """Redeem a batch of codes in one transaction.
+
+        Returns (total credited, redeemed codes, rejected codes).
+        """
+        candidates = []
+        rejected = []
+        for code in codes:
+            (candidates if self.might_exist(code) else rejected).append(code)
+        redeemed = []
+        total = 0
+
+        if candidates:
+            async with connect_db(self.db_path, isolation_level=None) as db:
+                # Take the write lock up front so claims and the balance update commit together
+                await db.execute('BEGIN IMMEDIATE')
+                try:
+                    for code in candidates:
+                        credits = await self.claim(db, code)
+                        if credits is None:
+                            rejected.append(code)
+                            continue
+                        redeemed.append(code)
+                        total += credits
+
+                    if redeemed:
+                        await self.credit(db, user_id, total, redeemed)
+                    await db.execute('COMMIT')
+                except Exception:
+                    await db.execute('ROLLBACK')
+                    raise
+
+        if rejected:
+            self.attempts.record_failures(user_id, len(rejected))
+            log.info("Rejected redeem codes", extra={
+                'event': 'redemption.rejected',
+                'user_id': user_id,
+                'count': len(rejected),
+                'filtered': len(codes) - len(candidates)
+            })
+        elif redeemed:
+            self.attempts.record_success(user_id)
+
+        if redeemed and self.filter is not None:
+            self.redeemed_since_load += len(redeemed)
+            if self.redeemed_since_load > self.filter.capacity // 2:
+                self.schedule_rebuild()
+        return total, redeemed, rejected
@@ -0,0 +1,198 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+import csv
+import io
+from datetime import datetime, timedelta
+from bot_logging import get_logger
+from latency import respond
+from db_writer import connect_db
+
+ADMIN_ROLE_NAME = "Admin"
+
+log = get_logger('reports')
+
+class SalesRollups:
+    """Daily per-product sales totals, kept up to date by the purchase path"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    async def record(self, db, product_id, units, gross, discount, revenue, day=None):
+        """Add a sale to a day's rollup inside the caller's transaction, returns the day.
+
+        Negative values undo a sale, pass the day recording it returned so an
+        undo after midnight comes off the right day. Defaults to today.
+        """
+        async with db.execute('''
+            INSERT INTO sales_daily (day, product_id, orders, units, gross, discounts, revenue)
+            VALUES (COALESCE(?, date('now')), ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, product_id) DO UPDATE SET
+                orders = orders + excluded.orders,
+                units = units + excluded.units,
+                gross = gross + excluded.gross,
+                discounts = discounts + excluded.discounts,
+                revenue = revenue + excluded.revenue
+            RETURNING day
+        ''', (day, product_id, 1 if units > 0 else -1, units, gross, discount, revenue)) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def backfill(self, transaction_archive):
+        """Build the rollups from existing transactions, until one backfill has run to the end"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('SELECT 1 FROM sales_backfills LIMIT 1') as cursor:
+                if await cursor.fetchone():
+                    return
+
+            query = '''
+                INSERT INTO sales_daily (day, product_id, orders, units, gross, discounts, revenue)
+                SELECT
+                    date(timestamp),
+                    product_id,
+                    COUNT(*),
+                    SUM(amount),
+                    SUM(original_cost),
+                    SUM(discount_amount),
+                    SUM(original_cost - discount_amount)
+                FROM {schema}.transactions
+                WHERE true
+                GROUP BY date(timestamp), product_id
+                ON CONFLICT (day, product_id) DO UPDATE SET
+                    orders = orders + excluded.orders,
+                    units = units + excluded.units,
+                    gross = gross + excluded.gross,
+                    discounts = discounts + excluded.discounts,
+                    revenue = revenue + excluded.revenue
+            '''
+            # A backfill that stopped part way left some days counted, start over from the transactions.
+            # Sales recorded since are in the transactions too
+            await db.execute('DELETE FROM sales_daily')
+            await db.execute(query.format(schema='main'))
+            await db.commit()
+
+        # Archived months are disjoint from the main table, fold them in one at a time
+        for path in transaction_archive.partitions():
+            async with transaction_archive.connect() as db:
+                await transaction_archive.attach(db, path)
+                await db.execute(query.format(schema='part'))
+                await db.commit()
+
+        async with connect_db(self.db_path) as db:
+            await db.execute('INSERT INTO sales_backfills DEFAULT VALUES')
+            await db.commit()
+        log.info("Backfilled sales rollups", extra={'event': 'reports.backfilled'})
+
+    async def by_product(self, start_day, end_day):
+        """(product_id, product name, orders, units, gross, discounts, revenue) per product for the range"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('''
+                SELECT
+                    s.product_id,
+                    COALESCE(p.name, 'Deleted product #' || s.product_id),
+                    SUM(s.orders),
+                    SUM(s.units),
+                    SUM(s.gross),
+                    SUM(s.discounts),
+                    SUM(s.revenue)
+                FROM sales_daily s
+                LEFT JOIN products p ON p.id = s.product_id
+                WHERE s.day BETWEEN ? AND ?
+                GROUP BY s.product_id
+                ORDER BY SUM(s.revenue) DESC
+            ''', (start_day, end_day)) as cursor:
+                return await cursor.fetchall()
+
+    async def by_day(self, start_day, end_day):
+        """(day, product name, orders, units, gross, discounts, revenue) per day and product for the range"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('''
+                SELECT
+                    s.day,
+                    COALESCE(p.name, 'Deleted product #' || s.product_id),
+                    s.orders,
+                    s.units,
+                    s.gross,
+                    s.discounts,
+                    s.revenue
+                FROM sales_daily s
+                LEFT JOIN products p ON p.id = s.product_id
+                WHERE s.day BETWEEN ? AND ?
+                ORDER BY s.day, s.product_id
+            ''', (start_day, end_day)) as cursor:
+                return await cursor.fetchall()
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+class Reports(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def cog_load(self):
+        await self.bot.sales.backfill(self.bot.transaction_archive)
+
+    @app_commands.command(name="sales_report", description="[Admin] Revenue per product for a date range")
+    @app_commands.checks.has_role(ADMIN_ROLE_NAME)
+    async def sales_report(
+        self,
+        interaction: discord.Interaction,
+        start_date: str = None,
+        end_date: str = None,
+        output: str = 'embed'
+    ):
+        output = output.lower()
+        if output not in ('embed', 'csv'):
+            await respond(interaction, "Output must be either 'embed' or 'csv'", ephemeral=True)
+            return
+
+        try:
+            end_day = parse_day(end_date) if end_date else datetime.utcnow().date()
+            start_day = parse_day(start_date) if start_date else end_day - timedelta(days=29)
+        except ValueError:
+            await respond(interaction, "Dates must be in the format YYYY-MM-DD", ephemeral=True)
+            return
+        if start_day > end_day:
+            await respond(interaction, "The start date must be before the end date.", ephemeral=True)
+            return
+
+        if output == 'csv':
+            rows = await self.bot.sales.by_day(start_day.isoformat(), end_day.isoformat())
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['day', 'product', 'orders', 'units', 'gross', 'discounts', 'revenue'])
+            writer.writerows(rows)
+            file = discord.File(
+                io.BytesIO(buffer.getvalue().encode('utf-8')),
+                filename=f"sales_{start_day}_{end_day}.csv"
+            )
+            await respond(
+                interaction, f"Sales from {start_day} to {end_day}:", file=file, ephemeral=True
+            )
+            return
+
+        rows = await self.bot.sales.by_product(start_day.isoformat(), end_day.isoformat())
+        if not rows:
+            await respond(interaction, f"No sales from {start_day} to {end_day}.", ephemeral=True)
+            return
+
+        embed = discord.Embed(
+            title="Sales Report",
+            description=f"{start_day} to {end_day}",
+            color=discord.Color.blue()
+        )
+        for product_id, name, orders, units, gross, discounts, revenue in rows[:24]:
+            embed.add_field(
+                name=name,
+                value=f"Orders: {orders}\nUnits: {units}\nDiscounts: {discounts} credits\nRevenue: {revenue} credits",
+                inline=True
+            )
+        embed.add_field(
+            name="Total",
+            value=f"Orders: {sum(row[2] for row in rows)}\n"
+                  f"Units: {sum(row[3] for row in rows)}\n"
+                  f"Revenue: {sum(row[6] for row in rows)} credits",
+            inline=False
+        )
+        await respond(interaction, embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Reports(bot))
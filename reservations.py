@@ -0,0 +1,248 @@
+import math
+import secrets
+import time
+from bot_logging import get_logger
+from db_writer import connect_db
+
+# How long a selected product is held, the confirm button stops working once the hold is gone
+RESERVATION_SECONDS = 30
+# One slot per second, reservations further out than this go around the wheel more than once
+WHEEL_SLOTS = 64
+# Rows this long past their expiry were left by a process that went away, any process may delete them
+ORPHANED_AFTER_SECONDS = 300
+
+log = get_logger('reservations')
+
+class StockReservations:
+    """Units held for users between selecting a product and confirming the purchase.
+
+    Held counts live in memory so menus can show what is actually free without a
+    query. Every reservation is also written to ``stock_reservations``, which is
+    what a new reservation is checked against, so a restart doesn't forget them
+    and processes sharing the database see each other's holds. Expiry runs on a
+    timing wheel of one slot per second, ``tick`` only looks at the slots for the
+    seconds that passed since the last tick. Each process deletes the expired rows
+    it made, a reservation may still be claimed by a purchase in that process.
+    """
+    def __init__(self, db_path, ttl=RESERVATION_SECONDS):
+        self.db_path = db_path
+        self.ttl = ttl
+        # reservation id -> [product_id, user_id, quantity, expires_at, order_id]
+        self.active = {}
+        self.by_user = {}
+        self.held = {}
+        self.wheel = [set() for _ in range(WHEEL_SLOTS)]
+        self.swept_until = int(time.time())
+        # Reservations made by this process, whose rows it deletes when they expire
+        self.owned = set()
+
+    def _schedule(self, reservation_id, expires_at):
+        # Rounded up, so by the time the slot's second is swept the reservation is due.
+        # Claimed reservations don't expire
+        if expires_at != math.inf:
+            self.wheel[math.ceil(expires_at) % WHEEL_SLOTS].add(reservation_id)
+
+    def _add(self, reservation_id, product_id, user_id, quantity, expires_at, order_id):
+        self.active[reservation_id] = [product_id, user_id, quantity, expires_at, order_id]
+        self.by_user[(user_id, product_id)] = reservation_id
+        self.held[product_id] = self.held.get(product_id, 0) + quantity
+        self._schedule(reservation_id, expires_at)
+
+    def _forget(self, reservation_id):
+        entry = self.active.pop(reservation_id, None)
+        if entry is None:
+            return False
+        product_id, user_id, quantity, _, _ = entry
+        if self.by_user.get((user_id, product_id)) == reservation_id:
+            del self.by_user[(user_id, product_id)]
+        self.held[product_id] -= quantity
+        if not self.held[product_id]:
+            del self.held[product_id]
+        return True
+
+    async def prune(self):
+        """Delete rows left behind by processes that went away"""
+        async with connect_db(self.db_path) as db:
+            await db.execute(
+                'DELETE FROM stock_reservations WHERE expires_at <= ?', (time.time() - ORPHANED_AFTER_SECONDS,)
+            )
+            await db.commit()
+
+    async def load(self):
+        """Rebuild the in-memory state from ``stock_reservations``, also after other processes changed it"""
+        now = time.time()
+        claimed = {reservation_id for reservation_id, entry in self.active.items() if entry[3] == math.inf}
+        async with connect_db(self.db_path) as db:
+            async with db.execute(
+                'SELECT id, product_id, user_id, quantity, expires_at, COALESCE(order_id, id) FROM stock_reservations'
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+        self.active = {}
+        self.by_user = {}
+        self.held = {}
+        self.wheel = [set() for _ in range(WHEEL_SLOTS)]
+        self.swept_until = int(now)
+        for reservation_id, product_id, user_id, quantity, expires_at, order_id in rows:
+            if reservation_id in claimed:
+                expires_at = math.inf
+            elif expires_at <= now:
+                if reservation_id in self.owned:
+                    # Swept on the next tick, which deletes the row
+                    self.wheel[(self.swept_until + 1) % WHEEL_SLOTS].add(reservation_id)
+                else:
+                    continue
+            self._add(reservation_id, product_id, user_id, quantity, expires_at, order_id)
+        self.owned &= set(self.active)
+
+    def held_for(self, product_id):
+        return self.held.get(product_id, 0)
+
+    def get(self, reservation_id):
+        """(product_id, user_id, quantity) of an active reservation, None once it's gone"""
+        entry = self.active.get(reservation_id)
+        return tuple(entry[:3]) if entry else None
+
+    def order(self, order_id):
+        """Ids of the active reservations made together under ``order_id``"""
+        return [reservation_id for reservation_id, entry in self.active.items() if entry[4] == order_id]
+
+    def held_by(self, user_id, product_id):
+        """Units of a product the user already holds, they are given back by the user's next reservation"""
+        entry = self.active.get(self.by_user.get((user_id, product_id)))
+        return entry[2] if entry else 0
+
+    async def reserve(self, product_id, user_id, quantity, stock):
+        """Hold ``quantity`` units of a product with ``stock`` units in total.
+
+        Returns the reservation id, or None if not enough units are free.
+        """
+        reservation_ids = await self.reserve_many(user_id, [(product_id, quantity, stock)])
+        return reservation_ids[0] if reservation_ids else None
+
+    async def reserve_many(self, user_id, lines, order_id=None):
+        """Hold several products at once, all or nothing.
+
+        ``lines`` are (product_id, quantity, stock) tuples. A user holds one
+        reservation per product, a new one replaces the old. The reservations
+        can be found again by ``order_id``, without one each is its own order.
+        Returns the reservation ids in the order of ``lines``, or None if any
+        product doesn't have enough free units.
+        """
+        replaced = {self.by_user[(user_id, product_id)]: self.active[self.by_user[(user_id, product_id)]]
+                    for product_id, _, _ in lines if (user_id, product_id) in self.by_user}
+        # Checked and held in memory before the first await so concurrent selections see it
+        if any(stock - self.held_for(product_id) + self.held_by(user_id, product_id) < quantity
+               for product_id, quantity, stock in lines):
+            return None
+        for reservation_id in replaced:
+            self._forget(reservation_id)
+
+        now = time.time()
+        expires_at = now + self.ttl
+        rows = []
+        for product_id, quantity, _ in lines:
+            reservation_id = secrets.token_hex(8)
+            self._add(reservation_id, product_id, user_id, quantity, expires_at, order_id or reservation_id)
+            rows.append((reservation_id, product_id, user_id, quantity, expires_at, order_id))
+
+        reserved = False
+        try:
+            reserved = await self._insert(user_id, lines, rows, now)
+        finally:
+            if not reserved:
+                for row in rows:
+                    self._forget(row[0])
+                for reservation_id, entry in replaced.items():
+                    if reservation_id not in self.active:
+                        self._add(reservation_id, *entry)
+        if not reserved:
+            return None
+        for reservation_id in replaced:
+            self.owned.discard(reservation_id)
+        self.owned.update(row[0] for row in rows)
+        return [row[0] for row in rows]
+
+    async def _insert(self, user_id, lines, rows, now):
+        """Write the reservations if the database agrees the units are free, other processes' holds included"""
+        product_ids = [product_id for product_id, _, _ in lines]
+        marks = ','.join('?' * len(product_ids))
+        async with connect_db(self.db_path) as db:
+            # The write lock, or the writer's turn, is held from the check to the commit
+            await db.execute('BEGIN IMMEDIATE')
+            try:
+                # The user's earlier holds on these products are given back by the new ones
+                await db.execute(
+                    f'DELETE FROM stock_reservations WHERE user_id = ? AND product_id IN ({marks})',
+                    (user_id, *product_ids)
+                )
+                async with db.execute(f'''
+                    SELECT id, COALESCE(stock, 0) - (
+                        SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+                        WHERE product_id = products.id AND expires_at > ?
+                    )
+                    FROM products WHERE id IN ({marks})
+                ''', (now - ORPHANED_AFTER_SECONDS, *product_ids)) as cursor:
+                    free = dict(await cursor.fetchall())
+                if any(free.get(product_id, 0) < quantity for product_id, quantity, _ in lines):
+                    await db.rollback()
+                    return False
+                await db.executemany(
+                    'INSERT INTO stock_reservations (id, product_id, user_id, quantity, expires_at, order_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return True
+
+    def claim(self, reservation_id):
+        """Stop a reservation from expiring while its purchase runs, False if it already expired"""
+        entry = self.active.get(reservation_id)
+        if entry is None:
+            return False
+        entry[3] = math.inf
+        return True
+
+    async def release(self, reservation_id, db=None):
+        """Give the units back. With ``db`` the row is deleted inside the caller's transaction"""
+        self.owned.discard(reservation_id)
+        if not self._forget(reservation_id):
+            return
+        if db is not None:
+            await db.execute('DELETE FROM stock_reservations WHERE id = ?', (reservation_id,))
+            return
+        async with connect_db(self.db_path) as db:
+            await db.execute('DELETE FROM stock_reservations WHERE id = ?', (reservation_id,))
+            await db.commit()
+
+    async def tick(self):
+        """Expire reservations whose time is up, returns how many expired"""
+        now = time.time()
+        second = int(now)
+        expired = []
+        # After a long pause every slot is due once
+        for current in range(max(self.swept_until + 1, second - WHEEL_SLOTS + 1), second + 1):
+            slot = self.wheel[current % WHEEL_SLOTS]
+            for reservation_id in list(slot):
+                entry = self.active.get(reservation_id)
+                if entry is None or entry[3] == math.inf:
+                    slot.discard(reservation_id)
+                elif entry[3] <= now:
+                    slot.discard(reservation_id)
+                    expired.append(reservation_id)
+                # Otherwise it's due on a later turn of the wheel
+        self.swept_until = second
+
+        expired = [reservation_id for reservation_id in expired if self._forget(reservation_id)]
+        # Other processes' rows only leave memory, the process that made them deletes them
+        owned = [reservation_id for reservation_id in expired if reservation_id in self.owned]
+        self.owned.difference_update(owned)
+        if owned:
+            async with connect_db(self.db_path) as db:
+                await db.executemany('DELETE FROM stock_reservations WHERE id = ?', [(rid,) for rid in owned])
+                await db.commit()
+            log.info("Expired reservations", extra={'event': 'reservations.expired', 'count': len(owned)})
+        return len(expired)
@@ -0,0 +1,131 @@
+from discord.ext import commands
+import math
+import time
+from bot_logging import get_logger
+
+DEFAULT_SHARDING_CONFIG = {
+    "enabled": False,
+    # None lets Discord recommend the number of shards
+    "shard_count": None,
+    # Shards this process runs, None for all of them. Only the process running shard 0 syncs commands
+    "shard_ids": None
+}
+
+log = get_logger('sharding')
+
+def sharding_settings(config):
+    return {**DEFAULT_SHARDING_CONFIG, **config.get('sharding', {})}
+
+def bot_base(config):
+    """The bot class to build on, AutoShardedBot when sharding is enabled"""
+    return commands.AutoShardedBot if sharding_settings(config)['enabled'] else commands.Bot
+
+def shard_options(config):
+    """Keyword arguments for the bot constructor that apply the sharding config"""
+    settings = sharding_settings(config)
+    if not settings['enabled']:
+        return {}
+    return {'shard_count': settings['shard_count'], 'shard_ids': settings['shard_ids']}
+
+def runs_first_shard(bot):
+    """Work done once per deployment, like command sync, runs in the process that holds shard 0"""
+    shard_ids = getattr(bot, 'shard_ids', None)
+    return shard_ids is None or 0 in shard_ids
+
+def splits_shards(bot):
+    """Whether other processes run some of the shards, and with them some of the guilds"""
+    return getattr(bot, 'shard_ids', None) is not None
+
+def holds_guild(bot, guild_id):
+    """Whether this process runs the shard a guild is on"""
+    if not splits_shards(bot) or not bot.shard_count:
+        return True
+    return (guild_id >> 22) % bot.shard_count in bot.shard_ids
+
+class ShardState:
+    __slots__ = ('ready', 'disconnects', 'resumes', 'changed_at')
+
+    def __init__(self):
+        self.ready = False
+        self.disconnects = 0
+        self.resumes = 0
+        self.changed_at = time.monotonic()
+
+class ShardHealth(commands.Cog):
+    """Readiness, disconnects and resumes per shard. Without sharding the one connection is shard 0"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.sharded = isinstance(bot, commands.AutoShardedBot)
+        self.shards = {}
+
+    def state(self, shard_id):
+        state = self.shards.get(shard_id)
+        if state is None:
+            state = self.shards[shard_id] = ShardState()
+        return state
+
+    def mark(self, shard_id, ready, event):
+        state = self.state(shard_id)
+        if ready != state.ready:
+            state.ready = ready
+            state.changed_at = time.monotonic()
+        if event == 'disconnect':
+            state.disconnects += 1
+        elif event == 'resumed':
+            state.resumes += 1
+        log.info("Shard state changed", extra={'event': f'shard.{event}', 'shard_id': shard_id})
+
+    def latency_for(self, shard_id):
+        if self.sharded:
+            shard = self.bot.get_shard(shard_id)
+            return shard.latency if shard else math.nan
+        return self.bot.latency
+
+    def snapshot(self):
+        now = time.monotonic()
+        rows = []
+        for shard_id, state in sorted(self.shards.items()):
+            latency = self.latency_for(shard_id)
+            rows.append({
+                'shard_id': shard_id,
+                'ready': state.ready,
+                # NaN until the first heartbeat is acknowledged
+                'latency_ms': round(latency * 1000, 1) if math.isfinite(latency) else None,
+                'disconnects': state.disconnects,
+                'resumes': state.resumes,
+                'state_seconds': round(now - state.changed_at),
+                'guilds': sum(1 for guild in self.bot.guilds if guild.shard_id == shard_id)
+            })
+        return rows
+
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id):
+        self.mark(shard_id, True, 'ready')
+
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id):
+        self.mark(shard_id, True, 'resumed')
+
+    @commands.Cog.listener()
+    async def on_shard_disconnect(self, shard_id):
+        self.mark(shard_id, False, 'disconnect')
+
+    # Without sharding only the plain connection events are dispatched
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.sharded:
+            self.mark(0, True, 'ready')
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        if not self.sharded:
+            self.mark(0, True, 'resumed')
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        if not self.sharded:
+            self.mark(0, False, 'disconnect')
+
+async def setup(bot):
+    await bot.add_cog(ShardHealth(bot))
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+from bloom_filter import BloomFilter
+from bot_logging import get_logger
+from stock_store import StockStore
+from db_writer import connect_db
+
+# 64 bit digests: a few bytes per entry on disk, and collisions stay negligible at millions of entries
+DIGEST_SIZE = 8
+CHUNK_SIZE = 500
+MIN_FILTER_CAPACITY = 100000
+
+log = get_logger('stock_index')
+
+def entry_digest(entry):
+    return hashlib.blake2b(entry.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+class StockIndex:
+    """Digests of every stock entry ever ingested, across all products.
+
+    Entries are never stored in plain text, only their digests. An in-memory
+    Bloom filter answers most lookups for new entries, the database is only
+    queried for the rare entries the filter reports as possibly seen. Without
+    the filter every lookup goes to the database.
+    """
+    def __init__(self, db_path, use_filter=True):
+        self.db_path = db_path
+        # Off when other processes ingest stock too, a filter would miss the digests it never saw
+        self.use_filter = use_filter
+        self.filter = None
+
+    async def load(self):
+        """(Re)build the filter, indexing the current stock files the first time"""
+        async with connect_db(self.db_path) as db:
+            async with db.execute('SELECT COUNT(*) FROM stock_digests') as cursor:
+                count = (await cursor.fetchone())[0]
+
+            if self.use_filter:
+                digest_filter = BloomFilter(max(MIN_FILTER_CAPACITY, count * 2))
+                async with db.execute('SELECT digest FROM stock_digests') as cursor:
+                    async for (digest,) in cursor:
+                        digest_filter.add(digest.hex())
+                self.filter = digest_filter
+
+        if not count:
+            await self.backfill()
+        log.info("Loaded stock index", extra={'event': 'stock_index.loaded', 'count': count})
+
+    async def backfill(self):
+        for store in StockStore.all():
+            await self.ingest(store.entries(), store.product_id)
+
+    async def ingest(self, entries, product_id, appender=None):
+        """Index ``entries``, adding the ones never seen before to the stock ``appender``.
+
+        Returns (added, rejected as already stocked for this product,
+        rejected as stocked for another product).
+        """
+        totals = [0, 0, 0]
+        # Digests committed so far, taken out again if their entries never make it into the store
+        recorded = []
+        try:
+            async with connect_db(self.db_path) as db:
+                chunk = []
+                for entry in entries:
+                    chunk.append(entry)
+                    if len(chunk) >= CHUNK_SIZE:
+                        recorded += await self._ingest_chunk(db, chunk, product_id, appender, totals)
+                        chunk = []
+                if chunk:
+                    recorded += await self._ingest_chunk(db, chunk, product_id, appender, totals)
+            if appender:
+                # A sale in progress may hold the tail block a commit would merge into
+                async with appender.store.sale_lock:
+                    await asyncio.to_thread(appender.commit)
+        except BaseException:
+            if appender:
+                # Drop the blocks written for the entries
+                appender.discard()
+            if recorded:
+                await self._forget(recorded, product_id)
+            raise
+
+        if self.filter is not None and self.filter.is_full():
+            # The false positive rate degrades past capacity, start over at a bigger size
+            await self.load()
+        return tuple(totals)
+
+    async def _forget(self, digests, product_id):
+        """Delete digests of entries that were never added to the store, the filter keeps them as false positives"""
+        async with connect_db(self.db_path) as db:
+            await db.executemany(
+                'DELETE FROM stock_digests WHERE digest = ? AND product_id = ?',
+                [(digest, product_id) for digest in digests]
+            )
+            await db.commit()
+
+    async def _ingest_chunk(self, db, entries, product_id, appender, totals):
+        """Look up and record one chunk's digests in a transaction of its own, returns the digests added.
+
+        Each chunk holds the write lock only for its own lookups and inserts, so a
+        large restock doesn't keep purchases waiting until the whole file is in.
+        """
+        digests = [entry_digest(entry) for entry in entries]
+        if self.filter is None:
+            candidates = digests
+        else:
+            candidates = [digest for digest in digests if digest.hex() in self.filter]
+        # Lookups and inserts run under one write lock, so no one else adds a digest in between
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            known = {}
+            if candidates:
+                placeholders = ','.join('?' * len(candidates))
+                async with db.execute(
+                    f'SELECT digest, product_id FROM stock_digests WHERE digest IN ({placeholders})',
+                    candidates
+                ) as cursor:
+                    known = dict(await cursor.fetchall())
+
+            added = []
+            for entry, digest in zip(entries, digests):
+                owner = known.get(digest)
+                if owner is None:
+                    # Also catches repeats further down the same chunk
+                    known[digest] = product_id
+                    added.append(digest)
+                    if self.filter is not None:
+                        self.filter.add(digest.hex())
+                    if appender:
+                        appender.add(entry)
+                elif owner == product_id:
+                    totals[1] += 1
+                else:
+                    totals[2] += 1
+
+            await db.executemany(
+                'INSERT INTO stock_digests (digest, product_id) VALUES (?, ?)',
+                [(digest, product_id) for digest in added]
+            )
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        totals[0] += len(added)
+        return added
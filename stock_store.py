@@ -0,0 +1,424 @@
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows runs a single process, the in-process locks are all there is to coordinate
+    fcntl = None
+
+STOCK_DIRECTORY = 'products'
+BLOCK_ENTRIES = 256
+COMPRESSION_LEVEL = 6
+# Sold entries are kept in memory up to this size, then spooled to a temp file on disk
+SPOOL_MAX_BYTES = 1024 * 1024
+# How often a sale waiting on another process's sale lock checks again
+SALE_LOCK_POLL_SECONDS = 0.01
+
+# One lock per stock directory, held only while an index is read, checked and swapped
+_locks = {}
+_locks_guard = threading.Lock()
+# One sale lock per stock directory, held by a sale from take() until the reservation commits or closes
+_sale_locks = {}
+
+def _open_lock_file(path, name):
+    os.makedirs(path, exist_ok=True)
+    return open(os.path.join(path, name), 'a')
+
+@contextlib.contextmanager
+def _file_lock(path, name):
+    """Exclusive flock on a file in the store's directory, shared by every process using the store"""
+    if fcntl is None:
+        yield
+        return
+    with _open_lock_file(path, name) as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+class SaleLock:
+    """Lets one sale at a time take entries from a store, across processes.
+
+    The asyncio lock queues this process's sales, an flock on ``sale.lock`` in
+    the store's directory keeps other processes out. Several workers in writer
+    mode share the stock directories, without it two of them could take the
+    same head blocks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.file = None
+
+    def locked(self):
+        return self.lock.locked()
+
+    async def acquire(self):
+        await self.lock.acquire()
+        if fcntl is None:
+            return
+        try:
+            self.file = await asyncio.to_thread(_open_lock_file, self.path, 'sale.lock')
+            # Polled, a thread blocked in flock couldn't be cancelled
+            while True:
+                try:
+                    fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return
+                except BlockingIOError:
+                    await asyncio.sleep(SALE_LOCK_POLL_SECONDS)
+        except BaseException:
+            self._close_file()
+            self.lock.release()
+            raise
+
+    def _close_file(self):
+        # Closing the file drops the flock
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def release(self):
+        self._close_file()
+        self.lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class StockConflict(Exception):
+    """The stock changed between taking entries and committing the sale"""
+    pass
+
+def read_entries(file_path):
+    """Stripped, non-empty lines of an uploaded stock file"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = line.strip()
+            if entry:
+                yield entry
+
+class StockStore:
+    """Stock entries for one product, kept in independently compressed blocks.
+
+    ``products/stock_<id>/index.json`` lists the blocks in order with their entry
+    counts. Block files are never modified: every change writes new blocks and
+    then swaps the index, so readers only ever decompress the blocks they need
+    and a failed change leaves the old index intact.
+    """
+    def __init__(self, product_id, directory=STOCK_DIRECTORY):
+        self.product_id = product_id
+        self.path = os.path.join(directory, f"stock_{product_id}")
+        key = os.path.abspath(self.path)
+        with _locks_guard:
+            self.lock = _locks.setdefault(key, threading.Lock())
+            # Also taken by anything that rewrites blocks a sale may be holding, like restocks and removals
+            self.sale_lock = _sale_locks.setdefault(key, SaleLock(self.path))
+
+    @classmethod
+    def all(cls, directory=STOCK_DIRECTORY):
+        stores = []
+        for path in glob.glob(os.path.join(directory, 'stock_*')):
+            match = re.fullmatch(r'stock_(\d+)', os.path.basename(path))
+            if match and os.path.isdir(path):
+                stores.append(cls(int(match.group(1)), directory))
+        return stores
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'index.json'))
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        """Held while an index is read, checked and swapped, by threads of this process and by other processes"""
+        with self.lock, _file_lock(self.path, 'index.lock'):
+            yield
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'blocks': []}
+
+    def _write_index(self, index):
+        os.makedirs(self.path, exist_ok=True)
+        temp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, os.path.join(self.path, 'index.json'))
+
+    def _read_block(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return zlib.decompress(f.read()).decode('utf-8').split('\n')
+
+    def _write_block(self, entries):
+        """Write a new block file, returns its [name, count] index entry"""
+        os.makedirs(self.path, exist_ok=True)
+        name = f"block_{os.urandom(8).hex()}.z"
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(zlib.compress('\n'.join(entries).encode('utf-8'), COMPRESSION_LEVEL))
+        return [name, len(entries)]
+
+    def _delete_blocks(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def count(self):
+        return sum(count for _, count in self._read_index()['blocks'])
+
+    def entries(self):
+        """Every entry in order, one block in memory at a time"""
+        for name, _ in self._read_index()['blocks']:
+            yield from self._read_block(name)
+
+    def page(self, start, size):
+        """Entries ``start`` to ``start + size``, decompressing only the blocks they live in"""
+        entries = []
+        offset = 0
+        for name, count in self._read_index()['blocks']:
+            if offset + count > start and offset < start + size:
+                block = self._read_block(name)
+                entries.extend(block[max(0, start - offset):start + size - offset])
+            offset += count
+            if offset >= start + size:
+                break
+        return entries
+
+    def appender(self):
+        return StockAppender(self)
+
+    def import_file(self, file_path):
+        """Move a plain text stock file into the store"""
+        appender = self.appender()
+        try:
+            for entry in read_entries(file_path):
+                appender.add(entry)
+            appender.commit()
+        except Exception:
+            appender.discard()
+            raise
+        os.remove(file_path)
+
+    def remove(self, positions):
+        """Remove entries by 0-based position, rewriting only the blocks that hold them"""
+        positions = set(positions)
+        with self.locked_index():
+            index = self._read_index()
+            blocks = []
+            stale = []
+            offset = 0
+            removed = 0
+            for name, count in index['blocks']:
+                hit = {position - offset for position in positions if offset <= position < offset + count}
+                if hit:
+                    kept = [entry for i, entry in enumerate(self._read_block(name)) if i not in hit]
+                    if kept:
+                        blocks.append(self._write_block(kept))
+                    stale.append(name)
+                    removed += count - len(kept)
+                else:
+                    blocks.append([name, count])
+                offset += count
+            index['blocks'] = blocks
+            self._write_index(index)
+        self._delete_blocks(stale)
+        return removed
+
+    def _take(self, quantity):
+        index = self._read_index()
+        sold = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        reservation = StockReservation(self, sold)
+        try:
+            for name, count in index['blocks']:
+                if reservation.count >= quantity:
+                    break
+                block = self._read_block(name)
+                needed = quantity - reservation.count
+                for entry in block[:needed]:
+                    sold.write(entry.encode('utf-8') + b'\n')
+                reservation.count += min(needed, count)
+                reservation.consumed.append(name)
+                if needed < count:
+                    # The rest of a partly sold block becomes the new head block
+                    reservation.head = self._write_block(block[needed:])
+        except Exception:
+            reservation.close()
+            raise
+
+        if reservation.count < quantity:
+            reservation.close()
+            return None
+        return reservation
+
+    async def take(self, quantity):
+        """Reserve the next ``quantity`` entries, None if there aren't enough.
+
+        The store's sale lock is held until the reservation is committed or
+        closed, so a second sale can't take the same entries while the first
+        is being charged.
+        """
+        await self.sale_lock.acquire()
+        try:
+            reservation = await asyncio.to_thread(self._take, quantity)
+        except BaseException:
+            self.sale_lock.release()
+            raise
+        if reservation is None:
+            self.sale_lock.release()
+        else:
+            reservation.locked = True
+        return reservation
+
+    def link_to(self, destination):
+        """Pin the store's current blocks under ``destination``, for backups.
+
+        Blocks are never modified, so hard links to them stay a consistent snapshot
+        after the store moves on. The caller holds the sale lock, nothing deletes
+        the blocks of the index being linked.
+        """
+        index = self._read_index()
+        os.makedirs(destination, exist_ok=True)
+        for name, _ in index['blocks']:
+            try:
+                os.link(os.path.join(self.path, name), os.path.join(destination, name))
+            except OSError:
+                # Filesystems without hard links get a copy
+                shutil.copy2(os.path.join(self.path, name), os.path.join(destination, name))
+        with open(os.path.join(destination, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+class StockAppender:
+    """Buffers new entries into blocks, which only become visible on ``commit``"""
+    def __init__(self, store):
+        self.store = store
+        self.buffer = []
+        self.blocks = []
+
+    def add(self, entry):
+        self.buffer.append(entry)
+        if len(self.buffer) >= BLOCK_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.blocks.append(self.store._write_block(self.buffer))
+            self.buffer = []
+
+    def commit(self):
+        self.flush()
+        if not self.blocks:
+            return
+        stale = []
+        with self.store.locked_index():
+            index = self.store._read_index()
+            blocks = index['blocks']
+            new_blocks = self.blocks
+            # Fold a small tail block into the first new one so repeated small restocks don't fragment the store
+            if blocks and blocks[-1][1] + new_blocks[0][1] <= BLOCK_ENTRIES:
+                merged = self.store._read_block(blocks[-1][0]) + self.store._read_block(new_blocks[0][0])
+                stale = [blocks[-1][0], new_blocks[0][0]]
+                blocks[-1] = self.store._write_block(merged)
+                new_blocks = new_blocks[1:]
+            blocks.extend(new_blocks)
+            self.store._write_index(index)
+        self.store._delete_blocks(stale)
+        self.blocks = []
+
+    def discard(self):
+        self.store._delete_blocks(name for name, _ in self.blocks)
+        self.buffer = []
+        self.blocks = []
+
+class StockReservation:
+    """Entries taken off the front of a store.
+
+    The sold entries sit in a spooled file. The store is only changed by
+    ``commit``, which comes once the sale is paid for and before it is
+    delivered, so the sale lock isn't held through the DM. An order that
+    can't be delivered puts its entries back with ``restore``.
+    """
+    def __init__(self, store, sold):
+        self.store = store
+        self.sold = sold
+        self.count = 0
+        self.consumed = []
+        self.head = None
+        self.committed = False
+        self.locked = False
+
+    def size(self):
+        self.sold.seek(0, os.SEEK_END)
+        return self.sold.tell()
+
+    def lines(self):
+        self.sold.seek(0)
+        for line in self.sold:
+            yield line.decode('utf-8')
+
+    def commit(self):
+        """Remove the entries from the store and let the next sale in"""
+        with self.store.locked_index():
+            index = self.store._read_index()
+            blocks = index['blocks']
+            if [name for name, _ in blocks[:len(self.consumed)]] != self.consumed:
+                raise StockConflict("Stock was changed between taking the entries and committing the sale")
+            index['blocks'] = ([self.head] if self.head else []) + blocks[len(self.consumed):]
+            self.store._write_index(index)
+            self.committed = True
+        self.store._delete_blocks(self.consumed)
+        self._unlock()
+
+    def _restore(self):
+        blocks = []
+        try:
+            entries = []
+            for line in self.lines():
+                entries.append(line[:-1])
+                if len(entries) >= BLOCK_ENTRIES:
+                    blocks.append(self.store._write_block(entries))
+                    entries = []
+            if entries:
+                blocks.append(self.store._write_block(entries))
+        except Exception:
+            self.store._delete_blocks(name for name, _ in blocks)
+            raise
+        with self.store.locked_index():
+            index = self.store._read_index()
+            index['blocks'] = blocks + index['blocks']
+            self.store._write_index(index)
+
+    async def restore(self):
+        """Put committed entries back at the front of the store, for an order that couldn't be delivered"""
+        async with self.store.sale_lock:
+            await asyncio.to_thread(self._restore)
+
+    def _unlock(self):
+        if self.locked:
+            self.locked = False
+            self.store.sale_lock.release()
+
+    def close(self):
+        self.sold.close()
+        if self.head and not self.committed:
+            self.store._delete_blocks([self.head[0]])
+        self._unlock()
+
+def migrate_stock_files(directory=STOCK_DIRECTORY):
+    """Move plain text stock files from before the block store into it"""
+    migrated = []
+    for path in glob.glob(os.path.join(directory, 'stock_*.txt')):
+        match = re.fullmatch(r'stock_(\d+)\.txt', os.path.basename(path))
+        if match:
+            StockStore(int(match.group(1)), directory).import_file(path)
+            migrated.append(int(match.group(1)))
+    return migrated
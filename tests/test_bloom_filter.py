@@ -0,0 +1,26 @@
+from bloom_filter import BloomFilter
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(1000)
+    codes = [f"CODE-{n}" for n in range(1000)]
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+    assert bloom.is_full()
+
+
+def test_false_positive_rate_stays_near_the_target():
+    bloom = BloomFilter(5000, error_rate=0.01)
+    for n in range(5000):
+        bloom.add(f"CODE-{n}")
+    false_positives = sum(f"OTHER-{n}" in bloom for n in range(20000))
+    assert false_positives / 20000 < 0.02
+
+
+def test_sizing():
+    bloom = BloomFilter(1000, error_rate=0.001)
+    # About 14.4 bits and 10 hashes per item at a 0.1% error rate
+    assert bloom.size == 14378
+    assert bloom.hash_count == 10
+    assert len(bloom.bits) == (bloom.size + 7) // 8
@@ -0,0 +1,142 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+import pytest
+
+from db_writer import DEFAULT_DB_WRITER_CONFIG, WriterService, WriterSession
+
+
+def run_with_service(tmp_path, test, **settings):
+    db_path = str(tmp_path / 'writer.db')
+    with sqlite3.connect(db_path) as db:
+        db.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+
+    async def main():
+        service = WriterService({**DEFAULT_DB_WRITER_CONFIG, 'db_path': db_path, **settings})
+        service.db = await aiosqlite.connect(db_path, isolation_level=None)
+        try:
+            await test(service)
+        finally:
+            await service.db.close()
+
+    asyncio.run(main())
+    with sqlite3.connect(db_path) as db:
+        return [name for (name,) in db.execute('SELECT name FROM items ORDER BY id')]
+
+
+def insert(name):
+    return {'op': 'execute', 'sql': 'INSERT INTO items (name) VALUES (?)', 'params': [name], 'many': False}
+
+
+def count_flushes(service):
+    flushes = []
+    flush = service.flush
+
+    async def counted():
+        flushes.append(len(service.batch))
+        await flush()
+
+    service.flush = counted
+    return flushes
+
+
+def test_alone_a_transaction_commits_right_away(tmp_path):
+    async def test(service):
+        flushes = count_flushes(service)
+        session = WriterSession(service)
+        await session.run({'op': 'begin'})
+        await session.run(insert('a'))
+        await session.run({'op': 'commit'})
+        assert flushes == [1]
+        assert service.versions == {'items': 1}
+
+    assert run_with_service(tmp_path, test) == ['a']
+
+
+def test_waiting_transactions_share_a_commit(tmp_path):
+    async def test(service):
+        flushes = count_flushes(service)
+        first, second = WriterSession(service), WriterSession(service)
+        await first.run({'op': 'begin'})
+        # Queued behind the first transaction's turn
+        second_begun = asyncio.create_task(second.run({'op': 'begin'}))
+        await asyncio.sleep(0)
+        assert service.waiting == 1
+
+        await first.run(insert('a'))
+        # Someone is waiting, so the commit is left to the batch and answered when it lands
+        first_committed = asyncio.create_task(first.run({'op': 'commit'}))
+        await second_begun
+        assert not first_committed.done()
+        assert flushes == []
+
+        await second.run(insert('b'))
+        await second.run({'op': 'commit'})
+        await first_committed
+        assert flushes == [2]
+        assert service.versions == {'items': 2}
+
+    assert run_with_service(tmp_path, test) == ['a', 'b']
+
+
+def test_a_full_batch_commits_with_waiters_left(tmp_path):
+    async def test(service):
+        flushes = count_flushes(service)
+        sessions = [WriterSession(service) for _ in range(3)]
+
+        async def write(session, name):
+            await session.run({'op': 'begin'})
+            await session.run(insert(name))
+            await session.run({'op': 'commit'})
+
+        await asyncio.gather(*(write(session, name) for session, name in zip(sessions, 'abc')))
+        assert flushes == [2, 1]
+
+    assert run_with_service(tmp_path, test, batch_size=2) == ['a', 'b', 'c']
+
+
+def test_rollback_only_undoes_its_own_savepoint(tmp_path):
+    async def test(service):
+        first, second = WriterSession(service), WriterSession(service)
+        await first.run({'op': 'begin'})
+        second_begun = asyncio.create_task(second.run({'op': 'begin'}))
+        await asyncio.sleep(0)
+        await first.run(insert('a'))
+        first_committed = asyncio.create_task(first.run({'op': 'commit'}))
+        await second_begun
+
+        # Same batch, the failed transaction rolls back to its savepoint and keeps the first one's row
+        await second.run(insert('b'))
+        with pytest.raises(sqlite3.IntegrityError):
+            await second.run(insert('a'))
+        await second.run({'op': 'rollback'})
+
+        await first_committed
+        assert service.versions == {'items': 1}
+        assert not service.in_batch
+
+    assert run_with_service(tmp_path, test) == ['a']
+
+
+def test_autocommit_statement_rolls_back_on_error(tmp_path):
+    async def test(service):
+        session = WriterSession(service)
+        await session.run({**insert('a'), 'autocommit': True})
+        with pytest.raises(sqlite3.IntegrityError):
+            await session.run({**insert('a'), 'autocommit': True})
+        assert session.savepoint is None
+        assert not service.turn.locked()
+
+    assert run_with_service(tmp_path, test) == ['a']
+
+
+def test_a_turn_times_out_like_a_locked_database(tmp_path):
+    async def test(service):
+        holder, waiter = WriterSession(service), WriterSession(service)
+        await holder.run({'op': 'begin'})
+        with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+            await waiter.run({'op': 'begin'})
+        await holder.run({'op': 'rollback'})
+
+    assert run_with_service(tmp_path, test, busy_timeout_seconds=0.05) == []
@@ -0,0 +1,21 @@
+from product_manager import split_discount
+
+
+def test_shares_are_proportional_to_cost():
+    assert split_discount([100, 300], 40) == [10, 30]
+
+
+def test_rounding_leftover_goes_to_the_first_lines():
+    shares = split_discount([1, 1, 1], 2)
+    assert shares == [1, 1, 0]
+    assert sum(shares) == 2
+
+
+def test_no_line_gets_more_than_it_costs():
+    costs = [5, 7, 11]
+    shares = split_discount(costs, sum(costs))
+    assert shares == costs
+
+
+def test_free_lines_get_nothing():
+    assert split_discount([0, 0], 10) == [0, 0]
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from stock_store import BLOCK_ENTRIES, StockConflict, StockStore
+
+
+def stocked_store(tmp_path, entries, product_id=1):
+    store = StockStore(product_id, str(tmp_path))
+    appender = store.appender()
+    for entry in entries:
+        appender.add(entry)
+    appender.commit()
+    return store
+
+
+def test_commit_removes_the_taken_entries(tmp_path):
+    entries = [f"entry-{n}" for n in range(BLOCK_ENTRIES + 10)]
+    store = stocked_store(tmp_path, entries)
+
+    async def sell():
+        reservation = await store.take(BLOCK_ENTRIES + 3)
+        try:
+            assert [line.rstrip('\n') for line in reservation.lines()] == entries[:BLOCK_ENTRIES + 3]
+            # Nothing changes until the sale is committed
+            assert store.count() == len(entries)
+            reservation.commit()
+            assert not store.sale_lock.locked()
+        finally:
+            reservation.close()
+
+    asyncio.run(sell())
+    assert list(store.entries()) == entries[BLOCK_ENTRIES + 3:]
+
+
+def test_take_returns_none_when_short(tmp_path):
+    store = stocked_store(tmp_path, ['a', 'b'])
+
+    async def sell():
+        assert await store.take(3) is None
+        assert not store.sale_lock.locked()
+
+    asyncio.run(sell())
+    assert store.count() == 2
+
+
+def test_a_second_sale_waits_for_the_first(tmp_path):
+    store = stocked_store(tmp_path, ['a', 'b', 'c'])
+
+    async def sell():
+        first = await store.take(2)
+        second = asyncio.create_task(store.take(1))
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        first.commit()
+        first.close()
+        reservation = await second
+        try:
+            assert list(reservation.lines()) == ['c\n']
+        finally:
+            reservation.close()
+
+    asyncio.run(sell())
+
+
+def test_commit_after_the_stock_changed_conflicts(tmp_path):
+    store = stocked_store(tmp_path, ['a', 'b', 'c'])
+
+    async def sell():
+        reservation = await store.take(2)
+        try:
+            # A removal that bypassed the sale lock rewrote the block the sale took from
+            store.remove({2})
+            with pytest.raises(StockConflict):
+                reservation.commit()
+            assert not reservation.committed
+        finally:
+            reservation.close()
+        assert not store.sale_lock.locked()
+
+    asyncio.run(sell())
+    # The removal stands and nothing was sold
+    assert list(store.entries()) == ['a', 'b']
+    # The sale's unused head block was cleaned up
+    blocks = sorted(path.name for path in (tmp_path / 'stock_1').glob('block_*'))
+    assert blocks == sorted(name for name, _ in store._read_index()['blocks'])
+
+
+def test_restore_puts_committed_entries_back_in_front(tmp_path):
+    store = stocked_store(tmp_path, ['a', 'b', 'c'])
+
+    async def sell_and_undo():
+        reservation = await store.take(2)
+        try:
+            reservation.commit()
+            assert list(store.entries()) == ['c']
+            await reservation.restore()
+        finally:
+            reservation.close()
+
+    asyncio.run(sell_and_undo())
+    assert list(store.entries()) == ['a', 'b', 'c']
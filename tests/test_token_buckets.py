@@ -0,0 +1,39 @@
+import pytest
+
+from rate_limits import TokenBuckets
+
+
+def test_burst_then_wait_for_a_token():
+    buckets = TokenBuckets(max_buckets=10)
+    buckets.idle_seconds = 60
+    assert buckets.take('a', per_minute=60, burst=2, now=0) == 0
+    assert buckets.take('a', per_minute=60, burst=2, now=0) == 0
+    assert buckets.take('a', per_minute=60, burst=2, now=0) == pytest.approx(1.0)
+    # A token a second refills
+    assert buckets.take('a', per_minute=60, burst=2, now=1) == 0
+
+
+def test_refill_is_capped_at_the_burst():
+    buckets = TokenBuckets(max_buckets=10)
+    buckets.idle_seconds = 5000
+    buckets.take('a', per_minute=60, burst=2, now=0)
+    buckets.take('a', per_minute=60, burst=2, now=1000)
+    assert buckets.buckets['a'][0] == 1
+
+
+def test_least_recently_used_buckets_are_evicted_over_the_limit():
+    buckets = TokenBuckets(max_buckets=2)
+    buckets.idle_seconds = 60
+    buckets.take('a', per_minute=60, burst=1, now=0)
+    buckets.take('b', per_minute=60, burst=1, now=1)
+    buckets.take('a', per_minute=60, burst=1, now=2)
+    buckets.take('c', per_minute=60, burst=1, now=3)
+    assert list(buckets.buckets) == ['a', 'c']
+
+
+def test_idle_buckets_are_evicted():
+    buckets = TokenBuckets(max_buckets=10)
+    buckets.idle_seconds = 5
+    buckets.take('a', per_minute=60, burst=1, now=0)
+    buckets.take('b', per_minute=60, burst=1, now=10)
+    assert list(buckets.buckets) == ['b']